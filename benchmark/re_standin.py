@@ -0,0 +1,350 @@
+# in-process stand-in for the Relation Engine query API, for benchmarks only
+"""
+Evaluates the AQL queries the service sends against a synthetic dataset, without
+ArangoDB. Only the query templates of the service are understood: they are recognised
+by their text, and the compiled filter expressions are parsed and evaluated with the
+AQL comparison rules the filters rely on (type order null < bool < number < string <
+array < object). Strings are compared by code point, not with ArangoDB's collation.
+"""
+import hashlib
+import itertools
+import json
+import math
+import re
+import threading
+
+from utils.facets import AQL_facet_query, AQL_facet_sketch_query
+from utils.filter_samples import (
+    AQL_count_return,
+    AQL_exists_return,
+    AQL_query_template,
+    AQL_stream_return,
+    SAMPLE_NODE_COLLECTION
+)
+from utils.local_filter import AQL_load_template
+from utils.meta_manager import META_AQL_TEMPLATE
+
+
+class UnsupportedQuery(Exception):
+    '''raised for queries the stand-in does not understand'''
+
+
+_LEAF = re.compile(
+    r"FIRST\(node\.(cmeta|ucmeta)\[\* FILTER CURRENT\.ok == @(field[\w]+) AND "
+    r"CURRENT\.k == 'value' LIMIT 1 RETURN CURRENT\.v\]\) "
+    r"(==|!=|<=|>=|<|>|NOT IN|IN) @(value[\w]+)"
+)
+_TOKEN = re.compile(r"\s*(\(|\)|AND\b|OR\b|true\b|false\b)")
+_GROUP_FILTER = re.compile(r"for node in nodes\s+FILTER (.*?)\n\s*LIMIT 1\n\s*RETURN 1", re.DOTALL)
+_STREAM_RETURNS = {
+    AQL_stream_return: 'ids',
+    AQL_count_return: 'count',
+    AQL_exists_return: 'exists'
+}
+
+
+def _type_rank(value):
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, list):
+        return 4
+    return 5
+
+
+def aql_compare(left, right):
+    '''-1, 0 or 1 like AQL's ordering of the two values'''
+    left_rank, right_rank = _type_rank(left), _type_rank(right)
+    if left_rank != right_rank:
+        return -1 if left_rank < right_rank else 1
+    if left_rank >= 4:
+        return 0 if left == right else (-1 if repr(left) < repr(right) else 1)
+    return (left > right) - (left < right)
+
+
+def _compare(operator, left, right):
+    if operator == 'IN':
+        return any(aql_compare(left, value) == 0 for value in right)
+    if operator == 'NOT IN':
+        return not any(aql_compare(left, value) == 0 for value in right)
+    order = aql_compare(left, right)
+    return {'==': order == 0, '!=': order != 0, '<': order < 0, '<=': order <= 0,
+            '>': order > 0, '>=': order >= 0}[operator]
+
+
+def _hash(value):
+    '''a stand-in for AQL HASH(), equal for numbers AQL considers equal'''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    text = json.dumps(value, sort_keys=True, separators=(',', ':'))
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def _meta_value(node, meta, field):
+    return next((entry['v'] for entry in node.get(meta, [])
+                 if entry['ok'] == field and entry['k'] == 'value'), None)
+
+
+def compile_filter(expression, params):
+    '''
+    Parses a filter expression generated by SampleFilterer into a predicate over
+    sample nodes, the bind parameters are resolved from 'params'.
+    '''
+    position = 0
+
+    def parse_or():
+        nonlocal position
+        terms = [parse_and()]
+        while True:
+            match = _TOKEN.match(expression, position)
+            if not match or match.group(1) != 'OR':
+                break
+            position = match.end()
+            terms.append(parse_and())
+        return terms[0] if len(terms) == 1 else \
+            (lambda node: any(term(node) for term in terms))
+
+    def parse_and():
+        nonlocal position
+        terms = [parse_term()]
+        while True:
+            match = _TOKEN.match(expression, position)
+            if not match or match.group(1) != 'AND':
+                break
+            position = match.end()
+            terms.append(parse_term())
+        return terms[0] if len(terms) == 1 else \
+            (lambda node: all(term(node) for term in terms))
+
+    def parse_term():
+        nonlocal position
+        while expression[position:position + 1].isspace():
+            position += 1
+        leaf = _LEAF.match(expression, position)
+        if leaf:
+            position = leaf.end()
+            meta, field, operator, value = leaf.groups()
+            field, value = params[field], params[value]
+            return lambda node: _compare(operator, _meta_value(node, meta, field), value)
+        match = _TOKEN.match(expression, position)
+        if not match:
+            raise UnsupportedQuery(f"Unexpected filter text: {expression[position:][:80]}")
+        position = match.end()
+        if match.group(1) == 'true':
+            return lambda node: True
+        if match.group(1) == 'false':
+            return lambda node: False
+        if match.group(1) != '(':
+            raise UnsupportedQuery(f"Unexpected filter text: {expression[position:][:80]}")
+        term = parse_or()
+        match = _TOKEN.match(expression, position)
+        if not match or match.group(1) != ')':
+            raise UnsupportedQuery("Unbalanced parentheses in filter")
+        position = match.end()
+        return term
+
+    predicate = parse_or()
+    if expression[position:].strip():
+        raise UnsupportedQuery(f"Unexpected filter text: {expression[position:][:80]}")
+    return predicate
+
+
+class RelationEngineStandIn:
+    '''
+    Answers /api/v1/query_results requests for the queries of the service from a
+    SyntheticDataset, paging results through cursors like the Relation Engine API.
+    '''
+    def __init__(cls, dataset):
+        cls.dataset = dataset
+        cls._cursors = {}
+        cls._cursor_ids = itertools.count(1)
+        cls._lock = threading.Lock()
+        cls.queries = 0
+
+    def query_results(self, body, batch_size=None, cursor_id=None):
+        '''the response body of a query_results request'''
+        if cursor_id is not None:
+            with self._lock:
+                results = self._cursors.pop(cursor_id, None)
+            if results is None:
+                raise UnsupportedQuery(f"Unknown cursor {cursor_id}")
+        else:
+            with self._lock:
+                self.queries += 1
+            params = dict(body)
+            results = self.run(params.pop('query'), params)
+        if batch_size is None or len(results) <= batch_size:
+            return {'results': results, 'count': len(results), 'has_more': False,
+                    'cursor_id': None, 'stats': {}}
+        cursor_id = str(next(self._cursor_ids))
+        with self._lock:
+            self._cursors[cursor_id] = results[batch_size:]
+        return {'results': results[:batch_size], 'count': batch_size, 'has_more': True,
+                'cursor_id': cursor_id, 'stats': {}}
+
+    def collection_spec(self, name):
+        '''the collection spec of /api/v1/specs/collections, declaring the indexes used'''
+        indexes = [{'type': 'persistent', 'fields': ['uuidver']}] \
+            if name == SAMPLE_NODE_COLLECTION else []
+        return {'name': name, 'type': 'vertex', 'indexes': indexes}
+
+    def run(self, query, params):
+        if query == META_AQL_TEMPLATE:
+            return self._field_sets(params)
+        if query == AQL_load_template:
+            return self._load(params)
+        if query == AQL_facet_query:
+            return self._facets(params)
+        if query == AQL_facet_sketch_query:
+            return self._facet_sketches(params)
+        if query.startswith(AQL_query_template):
+            return self._stream(query[len(AQL_query_template):], params)
+        if query.lstrip().startswith('let sample_rows'):
+            return self._grouped(query, params)
+        raise UnsupportedQuery(f"Query not supported by the stand-in: {query[:120]}")
+
+    def _nodes(self, sample_id):
+        return self.dataset.nodes(sample_id.get('id'), sample_id.get('version'))
+
+    def _field_sets(self, params):
+        results = []
+        for sample_id in params['sample_ids']:
+            fields = {}
+            for node in self._nodes(sample_id):
+                for entry in node['cmeta']:
+                    fields[entry['ok']] = None
+                for entry in node['ucmeta']:
+                    fields['custom:' + entry['ok']] = None
+            results.append({
+                'id': sample_id['id'],
+                'version': sample_id['version'],
+                'found': self.dataset.version_uuid(sample_id['id'],
+                                                   sample_id['version']) is not None,
+                'fields': list(fields)
+            })
+        return results
+
+    def _load(self, params):
+        results = []
+        for sample_id in params['sample_ids']:
+            results.append({
+                'id': sample_id['id'],
+                'version': sample_id['version'],
+                'found': self.dataset.version_uuid(sample_id['id'],
+                                                   sample_id['version']) is not None,
+                'nodes': [{
+                    'cmeta': [[e['ok'], e['v']] for e in node['cmeta'] if e['k'] == 'value'],
+                    'ucmeta': [[e['ok'], e['v']] for e in node['ucmeta'] if e['k'] == 'value'],
+                    'custom_fields': list(dict.fromkeys(e['ok'] for e in node['ucmeta']))
+                } for node in self._nodes(sample_id)]
+            })
+        return results
+
+    def _sample_values(self, params):
+        '''the distinct (field, id, version, (type rank, value)) of the facet queries'''
+        fields = set(params['fields'])
+        sample_values = set()
+        for sample_id in params['sample_ids']:
+            for node in self._nodes(sample_id):
+                entries = [(e['ok'], e['v']) for e in node['cmeta'] if e['k'] == 'value'] + \
+                    [('custom:' + e['ok'], e['v']) for e in node['ucmeta'] if e['k'] == 'value']
+                for field, value in entries:
+                    if value is not None and (params['all_fields'] or field in fields):
+                        sample_values.add((field, sample_id['id'], sample_id['version'],
+                                           (_type_rank(value), value)))
+        return sample_values
+
+    def _facets(self, params):
+        sample_values = self._sample_values(params)
+        field_counts = {}
+        value_counts = {}
+        for field, id_, version, value in sample_values:
+            field_counts.setdefault(field, set()).add((id_, version))
+            value_counts[(field, value)] = value_counts.get((field, value), 0) + 1
+        return [{'field': field, 'count': len(samples)}
+                for field, samples in field_counts.items()] + \
+            [{'field': field, 'value': value[1], 'count': count}
+             for (field, value), count in value_counts.items()]
+
+    def _facet_sketches(self, params):
+        field_rows = {}
+        for field, id_, version, value in self._sample_values(params):
+            field_rows.setdefault(field, []).append((id_, version, value))
+        results = []
+        for field, rows in field_rows.items():
+            value_counts = {}
+            registers = {}
+            for _, _, value in rows:
+                value_counts[value] = value_counts.get(value, 0) + 1
+                hashed = _hash(value[1]) % params['hash_range']
+                register = hashed % params['num_registers']
+                rank = params['rank_bits'] + 1 - (hashed // params['num_registers']).bit_length()
+                registers[register] = max(registers.get(register, 0), rank)
+            values = sorted(value_counts.items(), key=lambda item: -item[1])
+            numbers = sorted(value[1] for _, _, value in rows if value[0] == 2)
+            centroids = {}
+            for idx, number in enumerate(numbers):
+                bin_ = math.floor(params['compression'] / (2 * math.pi) *
+                                  math.asin(2 * (idx + 0.5) / len(numbers) - 1))
+                centroids.setdefault(bin_, []).append(number)
+            results.append({
+                'field': field,
+                'count': len({(id_, version) for id_, version, _ in rows}),
+                'value_count': len(rows),
+                'values': [[value[1], count]
+                           for value, count in values[:params['max_values']]],
+                'registers': [[register, rank] for register, rank in registers.items()],
+                'numbers': len(numbers),
+                'min': numbers[0] if numbers else None,
+                'max': numbers[-1] if numbers else None,
+                'centroids': [[sum(members) / len(members), len(members)]
+                              for _, members in sorted(centroids.items())]
+            })
+        return results
+
+    def _stream(self, rest, params):
+        for return_clause, return_mode in _STREAM_RETURNS.items():
+            if rest.endswith(return_clause):
+                break
+        else:
+            raise UnsupportedQuery("Unknown return clause of the stream query")
+        predicate = compile_filter(rest[:-len(return_clause)], params)
+        results = []
+        seen = set()
+        for sample_id in params['sample_ids']:
+            for node in self._nodes(sample_id):
+                if predicate(node):
+                    address = (node['id'], node['ver'])
+                    if address not in seen:
+                        seen.add(address)
+                        results.append({'id': node['id'], 'version': node['ver']})
+                    if return_mode == 'exists':
+                        return [True]
+        if return_mode == 'count':
+            return [len(results)]
+        return [] if return_mode == 'exists' else results
+
+    def _grouped(self, query, params):
+        predicates = [compile_filter(expression, params)
+                      for expression in _GROUP_FILTER.findall(query)]
+        if len(predicates) != params['num_groups']:
+            raise UnsupportedQuery("Could not parse the groups of the grouped query")
+        custom_fields = set(params['custom_fields'])
+        present = set()
+        groups = [[] for _ in predicates]
+        for sample_id in params['sample_ids']:
+            nodes = self._nodes(sample_id)
+            for node in nodes:
+                present.update(e['ok'] for e in node['ucmeta'] if e['ok'] in custom_fields)
+            for group, predicate in zip(groups, predicates):
+                if any(predicate(node) for node in nodes):
+                    group.append({'id': sample_id['id'], 'version': sample_id['version']})
+        missing = [field for field in params['custom_fields'] if field not in present]
+        if params.get('require_custom_fields') and missing:
+            groups = []
+        return [{'missing_custom_fields': missing, 'groups': groups}]
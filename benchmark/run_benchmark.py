@@ -0,0 +1,306 @@
+# end to end benchmark of the service methods against local stand-in services
+"""
+Starts the Relation Engine, SampleService and Workspace stand-ins of standin_server.py
+in a separate process, serving a synthetic dataset, and drives the service
+implementation in this process with a mix of representative calls. For every scenario
+the throughput and p50/p95/p99 latency of the successful calls are reported, along with
+the peak resident set size of this process, so the numbers cover the service side only.
+The exit status is 1 if any call failed.
+
+Results are written as JSON; given a previous result file with --baseline, scenarios
+whose p95 latency grew, or whose throughput fell, by more than --max-regression, or
+with more failed calls, are reported and the exit status is 1.
+
+    python benchmark/run_benchmark.py --samples 100000 --keys 100 \\
+        --output results.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'lib'))
+
+from sample_search_api.sample_search_apiImpl import sample_search_api  # noqa: E402
+from utils.re_utils import get_session_stats  # noqa: E402
+
+from service_stubs import SAMPLE_SET_WORKSPACE  # noqa: E402
+from standin_server import serve  # noqa: E402
+from synthetic import SyntheticDataset  # noqa: E402
+
+QUANTILES = {'p50': 0.5, 'p95': 0.95, 'p99': 0.99}
+
+
+def _condition(field, comp_op, values, logical_op=None, paren_position=None):
+    condition = {'metadata_field': field, 'comparison_operator': comp_op,
+                 'metadata_values': [str(value) for value in values]}
+    if logical_op:
+        condition['logical_operator'] = logical_op
+    if paren_position:
+        condition['paren_position'] = paren_position
+    return condition
+
+
+def _keys_of_type(dataset, key_type):
+    '''the exactly validated controlled keys of the type, most frequent first'''
+    return [spec for spec in dataset.keys if spec['type'] == key_type and not spec['prefix']]
+
+
+def _fraction(spec, fraction):
+    '''the value a 'fraction' of the way through the range of a number key'''
+    return spec['minimum'] + fraction * (spec['maximum'] - spec['minimum'])
+
+
+def scenarios(dataset):
+    '''
+    The benchmark scenarios, name to (method, params of a sample set), covering the
+    filter shapes seen in practice: a numeric range, an enum membership test, nested
+    and/or groups, an uncontrolled field, the count return mode, the metadata fields
+    and the facets of a sample set.
+    '''
+    numbers = _keys_of_type(dataset, 'number')
+    enums = _keys_of_type(dataset, 'enum')
+    strings = _keys_of_type(dataset, 'string')
+    number, enum, string = numbers[0], enums[0], strings[0]
+    options = enum['enum']
+    filters = {
+        'filter_numeric_range': [
+            _condition(number['key'], '>=', [_fraction(number, 0.25)], 'and'),
+            _condition(number['key'], '<', [_fraction(number, 0.75)])
+        ],
+        'filter_enum_in': [
+            _condition(enum['key'], 'in', options[:3])
+        ],
+        'filter_nested': [
+            _condition(number['key'], '>', [_fraction(number, 0.5)], 'and', 1),
+            _condition(enum['key'], '==', [options[-1]], 'or'),
+            _condition(numbers[-1]['key'], '<=', [_fraction(numbers[-1], 0.1)], 'and'),
+            _condition(string['key'], '!=', ['none'], paren_position=-1)
+        ],
+        'filter_count': [
+            _condition(number['key'], '<', [_fraction(number, 0.5)], 'or'),
+            _condition(enum['key'], 'not in', options[:1])
+        ]
+    }
+    custom_numbers = [spec for spec in dataset.custom_keys if spec['type'] == 'number']
+    if custom_numbers:
+        filters['filter_custom'] = [
+            _condition('custom:' + custom_numbers[0]['key'], '>', [50])
+        ]
+    cases = {}
+    for name, conditions in filters.items():
+        def params(sample_ids, ref, conditions=conditions, name=name):
+            params = {'sample_ids': sample_ids, 'filter_conditions': conditions}
+            if name == 'filter_count':
+                params['return_mode'] = 'count'
+            return params
+        cases[name] = ('filter_samples', params)
+    cases['get_sampleset_meta'] = ('get_sampleset_meta',
+                                   lambda sample_ids, ref: {'sample_set_refs': [ref]})
+    cases['get_sampleset_facets'] = ('get_sampleset_facets',
+                                     lambda sample_ids, ref: {'sample_set_refs': [ref]})
+    return cases
+
+
+def deploy_config(path=os.path.join(ROOT_DIR, 'deploy.cfg')):
+    '''the settings of deploy.cfg, leaving out the ones set at deployment time'''
+    config = ConfigParser()
+    config.read(path)
+    return {key: value for key, value in config.items('sample_search_api')
+            if '{{' not in value}
+
+
+def _percentile(latencies, q):
+    '''nearest rank percentile of the sorted latencies'''
+    idx = max(0, min(len(latencies) - 1, int(round(q * len(latencies) + 0.5)) - 1))
+    return latencies[idx]
+
+
+def _format_ms(milliseconds):
+    return 'n/a' if milliseconds is None else f"{milliseconds:.1f}ms"
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_scenario(impl, ctx, method, make_params, dataset, set_size, iterations,
+                 concurrency, warmup):
+    '''
+    runs 'iterations' calls, cycling through the sample sets, and summarizes them. The
+    throughput and latencies only cover the successful calls, failing calls return early.
+    '''
+    num_sets = max(1, dataset.num_samples // set_size)
+
+    def call(idx):
+        set_idx = idx % num_sets
+        params = make_params(dataset.sample_addresses(set_size, set_idx * set_size),
+                             f"{SAMPLE_SET_WORKSPACE}/{set_idx + 1}/1")
+        start = time.perf_counter()
+        try:
+            getattr(impl, method)(ctx, params)
+        except Exception as error:
+            return time.perf_counter() - start, f"{type(error).__name__}: {error}"
+        return time.perf_counter() - start, None
+
+    for idx in range(warmup):
+        call(idx)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(call, range(iterations)))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for latency, error in results if not error)
+    errors = [error for _, error in results if error]
+    summary = {
+        'method': method,
+        'calls': iterations,
+        'errors': len(errors),
+        'throughput': round(len(latencies) / elapsed, 3),
+        'mean_ms': round(1000 * sum(latencies) / len(latencies), 3) if latencies else None,
+        'peak_rss_mb': _peak_rss_mb()
+    }
+    summary.update({f"{name}_ms": round(1000 * _percentile(latencies, q), 3)
+                    if latencies else None for name, q in QUANTILES.items()})
+    if errors:
+        summary['first_error'] = errors[0][:500]
+    return summary
+
+
+def compare(results, baseline, max_regression):
+    '''the regressions of 'results' against 'baseline', as readable strings'''
+    regressions = []
+    for name, summary in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        if summary['errors'] > previous.get('errors', 0):
+            regressions.append(f"{name}: errors {previous.get('errors', 0)} -> "
+                               f"{summary['errors']}")
+        if summary['p95_ms'] is not None and previous['p95_ms'] is not None and \
+                summary['p95_ms'] > previous['p95_ms'] * (1 + max_regression):
+            regressions.append(f"{name}: p95 {previous['p95_ms']}ms -> {summary['p95_ms']}ms")
+        if summary['throughput'] < previous['throughput'] * (1 - max_regression):
+            regressions.append(f"{name}: throughput {previous['throughput']}/s -> "
+                               f"{summary['throughput']}/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=10000,
+                        help="samples in the synthetic dataset (1k to 1M)")
+    parser.add_argument('--keys', type=int, default=50,
+                        help="controlled metadata keys (10 to 500)")
+    parser.add_argument('--custom-keys', type=int, default=5,
+                        help="uncontrolled metadata keys")
+    parser.add_argument('--versions', type=int, default=1, help="versions per sample")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--key-skew', type=float, default=0.7,
+                        help="how fast the presence of less frequent keys falls off")
+    parser.add_argument('--set-size', type=int, default=1000,
+                        help="samples per sample set, each call filters one set")
+    parser.add_argument('--iterations', type=int, default=50, help="calls per scenario")
+    parser.add_argument('--warmup', type=int, default=2,
+                        help="untimed calls per scenario before the timed ones")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="concurrent calls per scenario")
+    parser.add_argument('--scenario', action='append', dest='scenarios',
+                        help="only run this scenario, may be repeated")
+    parser.add_argument('--config', action='append', default=[], metavar='KEY=VALUE',
+                        help="overrides a deploy.cfg setting, may be repeated")
+    parser.add_argument('--output', help="file to write the results to as JSON")
+    parser.add_argument('--baseline', help="results of a previous run to compare with")
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help="tolerated relative p95 latency and throughput change")
+    args = parser.parse_args()
+    if args.keys < 3:
+        parser.error("--keys must be at least 3, one of each key type")
+
+    dataset_args = {'num_samples': args.samples, 'num_keys': args.keys,
+                    'num_custom_keys': args.custom_keys, 'versions': args.versions,
+                    'seed': args.seed, 'key_skew': args.key_skew}
+    # the stand-ins run in their own process so they neither compete for the GIL nor
+    # count towards the peak RSS measured here
+    context = multiprocessing.get_context('spawn')
+    ready = context.Queue()
+    server = context.Process(target=serve, args=(0, dataset_args, args.set_size, ready),
+                             daemon=True)
+    server.start()
+    try:
+        base_url = f"http://127.0.0.1:{ready.get(timeout=60)}"
+        config = deploy_config()
+        config.update({
+            'kbase-endpoint': base_url,
+            're-api-url': base_url + '/relation_engine_api',
+            'workspace-url': base_url + '/ws',
+            'scratch': tempfile.mkdtemp(prefix='sample_search_benchmark'),
+            # the default warm up keys do not exist in the synthetic data
+            'static-metadata-warm-keys': ''
+        })
+        for override in args.config:
+            key, _, value = override.partition('=')
+            config[key.strip()] = value.strip()
+        impl = sample_search_api(config)
+        # the method context of an authenticated call, without the server's logger
+        ctx = {'token': 'benchmark', 'user_id': 'benchmark', 'authenticated': 1}
+
+        dataset = SyntheticDataset(**dataset_args)
+        results = {
+            'parameters': dict(vars(args), config=args.config),
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count()
+            },
+            'config': {key: value for key, value in config.items() if key != 'scratch'},
+            'scenarios': {}
+        }
+        for name, (method, make_params) in scenarios(dataset).items():
+            if args.scenarios and name not in args.scenarios:
+                continue
+            summary = run_scenario(impl, ctx, method, make_params, dataset, args.set_size,
+                                   args.iterations, args.concurrency, args.warmup)
+            results['scenarios'][name] = summary
+            print(f"{name:24} {summary['throughput']:>9.1f}/s"
+                  f"  p50 {_format_ms(summary['p50_ms']):>11}"
+                  f"  p95 {_format_ms(summary['p95_ms']):>11}"
+                  f"  p99 {_format_ms(summary['p99_ms']):>11}"
+                  f"  errors {summary['errors']}", flush=True)
+            if summary['errors']:
+                print(f"    {summary['first_error']}", flush=True)
+        results['peak_rss_mb'] = _peak_rss_mb()
+        results['relation_engine_session'] = get_session_stats()
+        print(f"peak RSS {results['peak_rss_mb']} MB")
+    finally:
+        server.terminate()
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    failed = [name for name, summary in results['scenarios'].items() if summary['errors']]
+    for name in failed:
+        print(f"FAILED {name}: {results['scenarios'][name]['errors']} calls failed")
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+    if failed or regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
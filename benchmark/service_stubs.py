@@ -0,0 +1,100 @@
+# JSON-RPC stand-ins for the SampleService and Workspace methods the service calls
+"""
+Each stub maps a JSON-RPC method name to a function of the params list returning the
+result list, and raises StubError for the errors the real service would return.
+"""
+import re
+
+SAMPLE_SET_TYPE = 'KBaseSets.SampleSet-2.0'
+# SampleSet objects live in this workspace, object n holds the n-th slice of samples
+SAMPLE_SET_WORKSPACE = 1
+
+_REF_REGEX = re.compile(r"^(\d+)/(\d+)(?:/(\d+))?$")
+
+
+class StubError(Exception):
+    '''a JSON-RPC error of a stubbed service'''
+    def __init__(cls, name, message, code=-32500):
+        super().__init__(message)
+        cls.name = name
+        cls.code = code
+        cls.message = message
+
+    def to_json(self):
+        return {'name': self.name, 'code': self.code, 'message': self.message, 'error': ''}
+
+
+class SampleServiceStub:
+    '''get_metadata_key_static_metadata of the controlled keys of a SyntheticDataset'''
+    def __init__(cls, dataset):
+        cls.dataset = dataset
+        cls.methods = {
+            'SampleService.get_metadata_key_static_metadata': cls.get_metadata_key_static_metadata
+        }
+
+    def get_metadata_key_static_metadata(self, params):
+        params = params[0]
+        prefix = params.get('prefix', 0)
+        static_metadata = {}
+        unknown = []
+        for key in params['keys']:
+            key_metadata = self.dataset.static_metadata(key, prefix)
+            if key_metadata is None:
+                unknown.append(key)
+            else:
+                static_metadata[key] = key_metadata
+        if unknown:
+            # the SampleService names the unresolvable keys after the last colon
+            raise StubError('ServerError', "Cannot validate controlled vocabulary metadata "
+                            "keys with prefix mode {}: {}".format(prefix, ", ".join(unknown)))
+        return [{'static_metadata': static_metadata}]
+
+
+class WorkspaceStub:
+    '''
+    get_objects2 and get_object_info3 for SampleSet objects 1/n/1, the n-th slice of
+    'set_size' samples of a SyntheticDataset (n counts from 1).
+    '''
+    def __init__(cls, dataset, set_size=1000):
+        cls.dataset = dataset
+        cls.set_size = set_size
+        cls.methods = {
+            'Workspace.get_objects2': cls.get_objects2,
+            'Workspace.get_object_info3': cls.get_object_info3
+        }
+
+    def _set_index(self, ref):
+        match = _REF_REGEX.match(ref)
+        if not match or int(match.group(1)) != SAMPLE_SET_WORKSPACE or \
+                match.group(3) not in (None, '1'):
+            raise StubError('JSONRPCError', f"Object {ref} cannot be accessed: No object "
+                            f"with id {ref} exists")
+        idx = int(match.group(2)) - 1
+        if idx < 0 or idx * self.set_size >= self.dataset.num_samples:
+            raise StubError('JSONRPCError', f"No object with id {match.group(2)} exists in "
+                            f"workspace {SAMPLE_SET_WORKSPACE}")
+        return idx
+
+    def _info(self, idx):
+        return [idx + 1, f"sample_set_{idx + 1}", SAMPLE_SET_TYPE, '2020-01-01T00:00:00+0000',
+                1, 'benchmark', SAMPLE_SET_WORKSPACE, 'benchmark:samples', '', 0, {}]
+
+    def get_object_info3(self, params):
+        infos = [self._info(self._set_index(obj['ref'])) for obj in params[0]['objects']]
+        return [{'infos': infos, 'paths': [[obj['ref']] for obj in params[0]['objects']]}]
+
+    def get_objects2(self, params):
+        data = []
+        for obj in params[0]['objects']:
+            idx = self._set_index(obj['ref'])
+            samples = self.dataset.sample_addresses(self.set_size, idx * self.set_size)
+            data.append({
+                'data': {
+                    'description': f"synthetic sample set {idx + 1}",
+                    'samples': [{'id': sample['id'], 'version': sample['version'],
+                                 'name': f"sample{self.dataset.sample_index(sample['id'])}"}
+                                for sample in samples]
+                },
+                'info': self._info(idx)
+            })
+        return [{'data': data}]
@@ -0,0 +1,136 @@
+# HTTP server hosting the Relation Engine, SampleService and Workspace stand-ins
+"""
+Serves, on one port:
+    /relation_engine_api/api/v1/query_results      - RelationEngineStandIn
+    /relation_engine_api/api/v1/specs/collections  - RelationEngineStandIn
+    /sampleservice                                  - SampleServiceStub (JSON-RPC)
+    /ws                                             - WorkspaceStub (JSON-RPC)
+so the service can be configured with kbase-endpoint and workspace-url pointing at it.
+
+Run standalone with
+    python benchmark/standin_server.py --samples 100000 --port 5000
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARK_DIR), 'lib'))
+
+from re_standin import RelationEngineStandIn, UnsupportedQuery  # noqa: E402
+from service_stubs import SampleServiceStub, StubError, WorkspaceStub  # noqa: E402
+from synthetic import SyntheticDataset  # noqa: E402
+
+RE_PREFIX = '/relation_engine_api'
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(cls, address, dataset, set_size=1000):
+        super().__init__(address, _Handler)
+        cls.relation_engine = RelationEngineStandIn(dataset)
+        cls.rpc_methods = dict(SampleServiceStub(dataset).methods)
+        cls.rpc_methods.update(WorkspaceStub(dataset, set_size).methods)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == RE_PREFIX + '/api/v1/specs/collections':
+            name = parse_qs(url.query).get('name', [''])[0]
+            self._send(200, self.server.relation_engine.collection_spec(name))
+        else:
+            self._send(404, {'error': f"Not found: {url.path}"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path == RE_PREFIX + '/api/v1/query_results':
+            self._query_results(url)
+        elif url.path in ('/sampleservice', '/ws'):
+            self._rpc()
+        else:
+            self._send(404, {'error': f"Not found: {url.path}"})
+
+    def _query_results(self, url):
+        query = parse_qs(url.query)
+        batch_size = query.get('batch_size')
+        cursor_id = query.get('cursor_id')
+        try:
+            body = self._body()
+            response = self.server.relation_engine.query_results(
+                body,
+                batch_size=int(batch_size[0]) if batch_size else None,
+                cursor_id=cursor_id[0] if cursor_id else None
+            )
+        except (UnsupportedQuery, KeyError, ValueError) as error:
+            self._send(400, {'error': {'message': str(error)}})
+            return
+        self._send(200, response)
+
+    def _rpc(self):
+        request = self._body()
+        method = self.server.rpc_methods.get(request.get('method'))
+        if method is None:
+            error = StubError('JSONRPCError', f"Unknown method {request.get('method')}", -32601)
+            self._send(500, {'version': '1.1', 'id': request.get('id'), 'error': error.to_json()})
+            return
+        try:
+            result = method(request.get('params', []))
+        except StubError as error:
+            self._send(500, {'version': '1.1', 'id': request.get('id'), 'error': error.to_json()})
+            return
+        self._send(200, {'version': '1.1', 'id': request.get('id'), 'result': result})
+
+
+def serve(port, dataset_args, set_size, ready=None):
+    '''runs the stand-ins until killed, 'ready' is set to the port once listening'''
+    server = StandInServer(('127.0.0.1', port), SyntheticDataset(**dataset_args), set_size)
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--samples', type=int, default=10000)
+    parser.add_argument('--keys', type=int, default=50)
+    parser.add_argument('--custom-keys', type=int, default=5)
+    parser.add_argument('--versions', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--key-skew', type=float, default=0.7)
+    parser.add_argument('--set-size', type=int, default=1000)
+    args = parser.parse_args()
+    dataset_args = {'num_samples': args.samples, 'num_keys': args.keys,
+                    'num_custom_keys': args.custom_keys, 'versions': args.versions,
+                    'seed': args.seed, 'key_skew': args.key_skew}
+    serve(args.port, dataset_args, args.set_size)
+
+
+if __name__ == '__main__':
+    main()
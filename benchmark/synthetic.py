@@ -0,0 +1,316 @@
+# deterministic synthetic sample data for load and scale testing
+"""
+Generates samples_sample and samples_nodes documents shaped like those of the
+SampleService, with the static metadata of their controlled keys as returned by
+get_metadata_key_static_metadata. The data is served by the benchmark stand-ins, or
+written as JSONL files, one document per line, ready for arangoimport:
+
+    python benchmark/synthetic.py --samples 1000000 --keys 200 --output-dir /data/samples
+
+Every document is a function of the sample index, version and seed, so datasets of any
+size are generated in constant memory and the same arguments always give the same data.
+"""
+import argparse
+import bisect
+import gzip
+import hashlib
+import json
+import os
+import random
+import uuid
+from collections import OrderedDict
+from itertools import accumulate
+from threading import Lock
+
+KEY_TYPES = ('number', 'enum', 'string')
+# prefixes of the prefix validated keys, e.g. "enigma:depth"
+PREFIXES = ('enigma:', 'sesar:')
+# every PREFIX_KEY_INTERVAL-th controlled key is a prefix validated key
+PREFIX_KEY_INTERVAL = 7
+ENUM_CARDINALITIES = (2, 3, 5, 10, 25, 50, 200)
+UNITS = ('m', 'cm', 'degrees', 'mg/L', 'ppm', 'celsius', 'mM')
+# the number of the most frequent controlled keys present in nearly every sample
+CORE_KEY_FRACTION = 0.1
+CORE_KEY_PRESENCE = 0.95
+MIN_KEY_PRESENCE = 0.005
+STRING_MAX_LEN = 256
+CUSTOM_NUMBER_RANGE = (0, 100)
+
+
+def _presence(rank, num_core, skew):
+    '''fraction of the samples with the key of the given frequency rank'''
+    if rank < num_core:
+        return CORE_KEY_PRESENCE
+    return max(MIN_KEY_PRESENCE, CORE_KEY_PRESENCE * (rank - num_core + 1) ** -skew)
+
+
+def _zipf_weights(count, skew):
+    '''cumulative weights of 'count' values chosen with a Zipf distribution'''
+    return list(accumulate((idx + 1) ** -skew for idx in range(count)))
+
+
+class SyntheticDataset:
+    '''
+    A samples_sample / samples_nodes collection of 'num_samples' samples with
+    'num_keys' controlled and 'num_custom_keys' uncontrolled metadata keys, each sample
+    having 'versions' versions of one node.
+
+    The keys are ranked by frequency: the most frequent tenth is present in nearly
+    every sample, the presence of the others falls off as rank ** -key_skew. Controlled
+    keys cycle through the number, enum and string types; numbers have a range, and
+    possibly units, of their own, enums between 2 and 200 options chosen with a Zipf
+    distribution. Every PREFIX_KEY_INTERVAL-th key is validated by a prefix validator
+    of the SampleService rather than by its exact name. Uncontrolled keys alternate
+    between integer and string values.
+
+    Documents are generated on first use, the nodes of the most recently read
+    'cache_size' sample versions are kept.
+    '''
+    def __init__(cls, num_samples=10000, num_keys=50, num_custom_keys=5, versions=1,
+                 seed=0, key_skew=0.7, cache_size=100000):
+        cls.num_samples = num_samples
+        cls.num_keys = num_keys
+        cls.num_custom_keys = num_custom_keys
+        cls.versions = versions
+        cls.seed = seed
+        cls.key_skew = key_skew
+        cls.cache_size = cache_size
+        rng = random.Random(f"{seed}/keys")
+        num_core = max(1, int(num_keys * CORE_KEY_FRACTION))
+        cls.keys = [cls._key_spec(idx, _presence(idx, num_core, key_skew), rng)
+                    for idx in range(num_keys)]
+        num_core = max(1, int(num_custom_keys * CORE_KEY_FRACTION))
+        cls.custom_keys = [{
+            'key': f"custom{idx:02d}",
+            'type': 'number' if idx % 2 == 0 else 'string',
+            # uncontrolled keys are rarer than controlled ones
+            'presence': _presence(idx, num_core, key_skew) * 0.5
+        } for idx in range(num_custom_keys)]
+        # the static metadata of every exact key and prefix validator
+        cls._exact = {spec['key']: cls._static_metadata(spec)
+                      for spec in cls.keys if not spec['prefix']}
+        cls._prefixes = {}
+        for spec in cls.keys:
+            if spec['prefix']:
+                cls._prefixes.setdefault(spec['prefix'], {
+                    'display_name': spec['prefix'].rstrip(':'),
+                    'description': f"Keys validated by the '{spec['prefix']}' prefix",
+                    'type': 'string',
+                    'max-len': STRING_MAX_LEN
+                })
+        cls._nodes = OrderedDict()
+        cls._lock = Lock()
+
+    def _key_spec(self, idx, presence, rng):
+        key_type = KEY_TYPES[idx % len(KEY_TYPES)]
+        prefix = PREFIXES[(idx // PREFIX_KEY_INTERVAL) % len(PREFIXES)] \
+            if idx % PREFIX_KEY_INTERVAL == PREFIX_KEY_INTERVAL - 1 else None
+        spec = {
+            'key': f"{prefix or ''}key{idx:03d}",
+            'type': 'string' if prefix else key_type,
+            'presence': presence,
+            'prefix': prefix
+        }
+        if spec['type'] == 'number':
+            scale = 10 ** rng.randint(0, 4)
+            minimum = -scale if rng.random() < 0.25 else 0
+            spec.update({
+                'minimum': minimum,
+                'maximum': minimum + scale * rng.choice((1, 2, 5)),
+                'integer': rng.random() < 0.3,
+                'units': rng.choice(UNITS) if rng.random() < 0.6 else None
+            })
+        elif spec['type'] == 'enum':
+            cardinality = rng.choice(ENUM_CARDINALITIES)
+            spec['enum'] = [f"{spec['key']}-option{option}" for option in range(cardinality)]
+            spec['weights'] = _zipf_weights(cardinality, 1.0)
+        else:
+            # values repeat within a vocabulary of this many values
+            spec['vocabulary'] = rng.choice((10, 100, 1000, 2 ** 32))
+        return spec
+
+    def _static_metadata(self, spec):
+        static_metadata = {
+            'display_name': spec['key'],
+            'description': f"Synthetic {spec['type']} field {spec['key']}",
+            'type': spec['type']
+        }
+        if spec['type'] == 'number':
+            static_metadata.update({'minimum': spec['minimum'], 'maximum': spec['maximum']})
+            if spec['units']:
+                static_metadata['units'] = spec['units']
+        elif spec['type'] == 'enum':
+            static_metadata['enum'] = list(spec['enum'])
+        else:
+            static_metadata['max-len'] = STRING_MAX_LEN
+        return static_metadata
+
+    def sample_id(self, idx):
+        return str(uuid.UUID(int=idx + 1))
+
+    def sample_index(self, sample_id):
+        '''index of a sample id of this dataset, None for any other id'''
+        try:
+            idx = uuid.UUID(sample_id).int - 1
+        except (TypeError, ValueError, AttributeError):
+            return None
+        return idx if 0 <= idx < self.num_samples else None
+
+    def sample_addresses(self, count, start=0):
+        '''the addresses of the latest versions of 'count' samples from index 'start' '''
+        return [{'id': self.sample_id(idx), 'version': self.versions}
+                for idx in range(start, min(start + count, self.num_samples))]
+
+    def version_uuid(self, sample_id, version):
+        '''the version uuid of samples_sample 'vers', None for unknown samples'''
+        idx = self.sample_index(sample_id)
+        if idx is None or not isinstance(version, int) or not 1 <= version <= self.versions:
+            return None
+        return str(uuid.UUID(int=(1 << 64) + idx * 256 + version))
+
+    def nodes(self, sample_id, version):
+        '''the samples_nodes documents of a sample version, [] for unknown versions'''
+        version_id = self.version_uuid(sample_id, version)
+        if version_id is None:
+            return []
+        with self._lock:
+            nodes = self._nodes.get(version_id)
+            if nodes is not None:
+                self._nodes.move_to_end(version_id)
+                return nodes
+        nodes = self._generate_nodes(self.sample_index(sample_id), version)
+        with self._lock:
+            self._nodes[version_id] = nodes
+            if len(self._nodes) > self.cache_size:
+                self._nodes.popitem(last=False)
+        return nodes
+
+    def value(self, spec, rng):
+        '''a random value of a key'''
+        if spec['type'] == 'number':
+            if spec.get('integer'):
+                return rng.randint(spec['minimum'], spec['maximum'])
+            return round(rng.uniform(spec['minimum'], spec['maximum']), 2)
+        if spec['type'] == 'enum':
+            weights = spec['weights']
+            return spec['enum'][bisect.bisect(weights, rng.random() * weights[-1])]
+        return f"{spec['key']}-{rng.randrange(spec['vocabulary']):08x}"
+
+    def static_metadata(self, key, prefix):
+        '''
+        The get_metadata_key_static_metadata result for a key in the given prefix mode of
+        the SampleService: 0 for exact keys, 1 for prefix validators named exactly 'key'
+        and 2 for the prefix validator 'key' starts with. None if the key is unknown.
+        '''
+        if not prefix:
+            return self._exact.get(key)
+        if prefix == 1:
+            return self._prefixes.get(key)
+        return next((metadata for validator, metadata in self._prefixes.items()
+                     if key.startswith(validator)), None)
+
+    def static_metadata_entries(self):
+        '''the static metadata of every exact key and prefix validator'''
+        for key, static_metadata in self._exact.items():
+            yield {'key': key, 'prefix': 0, 'static_metadata': static_metadata}
+        for key, static_metadata in self._prefixes.items():
+            yield {'key': key, 'prefix': 1, 'static_metadata': static_metadata}
+
+    def sample_document(self, idx):
+        '''the samples_sample document of the sample with index 'idx' '''
+        sample_id = self.sample_id(idx)
+        owner = f"user{idx % 97}"
+        return {
+            '_key': sample_id,
+            'id': sample_id,
+            'vers': [self.version_uuid(sample_id, version)
+                     for version in range(1, self.versions + 1)],
+            'acls': {'owner': owner, 'admin': [], 'write': [], 'read': [],
+                     'pubread': idx % 10 == 0}
+        }
+
+    def iter_documents(self):
+        '''(collection, document) for every document of the dataset, sample by sample'''
+        for idx in range(self.num_samples):
+            yield 'samples_sample', self.sample_document(idx)
+            for version in range(1, self.versions + 1):
+                for node in self._generate_nodes(idx, version):
+                    yield 'samples_nodes', node
+
+    def write_jsonl(self, output_dir, compress=False):
+        '''
+        Writes the dataset as samples_sample.jsonl, samples_nodes.jsonl and
+        static_metadata.jsonl in 'output_dir', gzipped if 'compress'. Returns the paths.
+        '''
+        os.makedirs(output_dir, exist_ok=True)
+        suffix = '.jsonl.gz' if compress else '.jsonl'
+        paths = {name: os.path.join(output_dir, name + suffix)
+                 for name in ('samples_sample', 'samples_nodes', 'static_metadata')}
+        opener = gzip.open if compress else open
+        files = {name: opener(path, 'wt', encoding='utf-8') for name, path in paths.items()}
+        try:
+            for collection, document in self.iter_documents():
+                files[collection].write(json.dumps(document, separators=(',', ':')) + '\n')
+            for entry in self.static_metadata_entries():
+                files['static_metadata'].write(json.dumps(entry, separators=(',', ':')) + '\n')
+        finally:
+            for output in files.values():
+                output.close()
+        return paths
+
+    def _generate_nodes(self, idx, version):
+        rng = random.Random(f"{self.seed}/{idx}/{version}")
+        sample_id = self.sample_id(idx)
+        version_id = self.version_uuid(sample_id, version)
+        cmeta = []
+        for spec in self.keys:
+            if rng.random() < spec['presence']:
+                cmeta.append({'ok': spec['key'], 'k': 'value', 'v': self.value(spec, rng)})
+                if spec.get('units'):
+                    cmeta.append({'ok': spec['key'], 'k': 'units', 'v': spec['units']})
+        ucmeta = []
+        for spec in self.custom_keys:
+            if rng.random() < spec['presence']:
+                value = rng.randrange(*CUSTOM_NUMBER_RANGE) if spec['type'] == 'number' \
+                    else f"{spec['key']}-{rng.randrange(50)}"
+                ucmeta.append({'ok': spec['key'], 'k': 'value', 'v': value})
+        name = f"sample{idx}"
+        return [{
+            '_key': f"{sample_id}_{version_id}_"
+                    f"{hashlib.md5(name.encode('utf-8')).hexdigest()}",
+            'id': sample_id,
+            'ver': version,
+            'uuidver': version_id,
+            'saved': 1577836800000 + idx * 1000 + version,
+            'name': name,
+            'type': 'BioReplicate',
+            'parent': None,
+            'index': 0,
+            'cmeta': cmeta,
+            'ucmeta': ucmeta
+        }]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=10000)
+    parser.add_argument('--keys', type=int, default=50, help="controlled metadata keys")
+    parser.add_argument('--custom-keys', type=int, default=5,
+                        help="uncontrolled metadata keys")
+    parser.add_argument('--versions', type=int, default=1, help="versions per sample")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--key-skew', type=float, default=0.7,
+                        help="how fast the presence of less frequent keys falls off")
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--gzip', action='store_true', help="compress the JSONL files")
+    args = parser.parse_args()
+    dataset = SyntheticDataset(num_samples=args.samples, num_keys=args.keys,
+                               num_custom_keys=args.custom_keys, versions=args.versions,
+                               seed=args.seed, key_skew=args.key_skew, cache_size=0)
+    for path in dataset.write_jsonl(args.output_dir, compress=args.gzip).values():
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
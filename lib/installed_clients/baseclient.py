@@ -3,6 +3,10 @@
 # Autogenerated by the KBase type compiler -
 # any changes made here will be overwritten
 #
+# Hand edited in sample_search_api: _call posts through the pooled keep-alive
+# sessions of _get_session, configured with configure_pools. Reapply the edit
+# when the client is regenerated.
+#
 ############################################################
 
 from __future__ import print_function
@@ -11,9 +15,12 @@ import json as _json
 import requests as _requests
 import random as _random
 import os as _os
+import threading as _threading
 import traceback as _traceback
+from requests.adapters import HTTPAdapter as _HTTPAdapter
 from requests.exceptions import ConnectionError
 from urllib3.exceptions import ProtocolError
+from urllib3.util.retry import Retry as _Retry
 
 try:
     from configparser import ConfigParser as _ConfigParser  # py 3
@@ -31,6 +38,58 @@ _AJ = 'application/json'
 _URL_SCHEME = frozenset(['http', 'https'])
 _CHECK_JOB_RETRYS = 3
 
+# Keep-alive sessions shared by every client talking to the same base url
+# (scheme + host), so RPCs reuse open connections instead of paying connection
+# setup on each call. Adjust with configure_pools before the first call. A forked
+# process (e.g. a uWSGI worker) builds sessions of its own on first use.
+_POOL_CONFIG = {'max_connections': 10, 'max_retries': 0}
+_SESSIONS = dict()
+# the process the sessions were built in
+_SESSIONS_PID = None
+_SESSIONS_LOCK = _threading.Lock()
+
+
+def configure_pools(max_connections=None, max_retries=None):
+    '''
+    Sets the connection pool size per base url and the number of times a failed
+    connection attempt is retried. RPCs are not idempotent in general, so only
+    connection errors are retried, never requests that reached the server.
+    Existing sessions are discarded and rebuilt on their next use.
+    '''
+    with _SESSIONS_LOCK:
+        if max_connections is not None:
+            _POOL_CONFIG['max_connections'] = int(max_connections)
+        if max_retries is not None:
+            _POOL_CONFIG['max_retries'] = int(max_retries)
+        for session in _SESSIONS.values():
+            session.close()
+        _SESSIONS.clear()
+
+
+def _get_session(url):
+    global _SESSIONS_PID
+    scheme, netloc, _, _, _, _ = _urlparse(url)
+    base_url = scheme + '://' + netloc
+    pid = _os.getpid()
+    with _SESSIONS_LOCK:
+        if _SESSIONS_PID != pid:
+            # sessions built before a fork are dropped without closing them, their
+            # connections belong to the parent process
+            _SESSIONS.clear()
+            _SESSIONS_PID = pid
+        session = _SESSIONS.get(base_url)
+        if session is None:
+            retries = _Retry(total=_POOL_CONFIG['max_retries'],
+                             connect=_POOL_CONFIG['max_retries'],
+                             read=0, status=0, redirect=0)
+            adapter = _HTTPAdapter(pool_connections=1,
+                                   pool_maxsize=_POOL_CONFIG['max_connections'],
+                                   max_retries=retries)
+            session = _requests.Session()
+            session.mount(base_url, adapter)
+            _SESSIONS[base_url] = session
+        return session
+
 
 def _get_token(user_id, password, auth_svc):
     # This is bandaid helper function until we get a full
@@ -176,9 +235,9 @@ class BaseClient(object):
             arg_hash['context'] = context
 
         body = _json.dumps(arg_hash, cls=_JSONObjectEncoder)
-        ret = _requests.post(url, data=body, headers=self._headers,
-                             timeout=self.timeout,
-                             verify=not self.trust_all_ssl_certificates)
+        ret = _get_session(url).post(url, data=body, headers=self._headers,
+                                     timeout=self.timeout,
+                                     verify=not self.trust_all_ssl_certificates)
         ret.encoding = 'utf-8'
         if ret.status_code == 500:
             if ret.headers.get(_CT) == _AJ:
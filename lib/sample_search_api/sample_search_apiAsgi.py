@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ASGI entry point serving the same JSON RPC interface as the WSGI application in
+sample_search_apiServer. filter_samples, batch_filter_samples and get_sampleset_meta
+await their Relation Engine queries, so a single process keeps many calls in flight,
+the other methods run in the default executor of the event loop.
+
+Requires the aiohttp package and an ASGI server, for example:
+uvicorn --app-dir lib sample_search_api.sample_search_apiAsgi:application
+"""
+import json
+import traceback
+
+from jsonrpcbase import JSONRPCError, KeywordError
+from jsonrpcbase import ServerError as JSONServerError
+
+from biokbase import log
+from sample_search_api.sample_search_apiServer import (
+    JSONObjectEncoder,
+    JSONRPCServiceCustom,
+    MethodContext,
+    add_debug_timings,
+    application as wsgi_application,
+    config,
+    getIPAddress,
+    impl_sample_search_api
+)
+from utils.async_re_utils import close_async_session, configure_async_session
+from utils.executors import run_blocking
+from utils.filter_samples import AsyncSampleFilterer
+from utils.meta_manager import AsyncMetadataManager
+from utils.timing import RequestTimings, recording, span
+
+
+class AsyncImpl:
+    '''
+    Coroutine versions of the sample_search_api methods, sharing the configuration and
+    caches of the sample_search_api implementation they are created from.
+    '''
+    def __init__(cls, impl):
+        cls.impl = impl
+        cls.sample_filter = AsyncSampleFilterer.from_filterer(impl.sample_filter)
+        cls.meta_manager = AsyncMetadataManager.from_manager(impl.meta_manager)
+
+    async def filter_samples(self, ctx, params):
+        results = await self.sample_filter.filter_samples(params, ctx.get('token'))
+        if not isinstance(results, dict):
+            raise ValueError('Method filter_samples return value ' +
+                             'results is not type dict as required.')
+        return [results]
+
+    async def batch_filter_samples(self, ctx, params):
+        results = await self.sample_filter.batch_filter_samples(params, ctx.get('token'))
+        if not isinstance(results, dict):
+            raise ValueError('Method batch_filter_samples return value ' +
+                             'results is not type dict as required.')
+        return [results]
+
+    async def get_sampleset_meta(self, ctx, params):
+        sample_ids = await run_blocking(self.impl._resolve_sample_set_refs,
+                                        params.get('sample_set_refs'), ctx.get('token'))
+        fields = await self.meta_manager.get_sampleset_meta(sample_ids, ctx.get('token'))
+        results = [{'field': f} for f in fields]
+        if not isinstance(results, list):
+            raise ValueError('Method get_sampleset_meta return value ' +
+                             'results is not type list as required.')
+        return [results]
+
+
+class AsyncJSONRPCService(JSONRPCServiceCustom):
+    '''
+    JSONRPCServiceCustom that awaits the methods registered with add_async, every other
+    call, including batch calls, is handled by JSONRPCServiceCustom in the executor.
+    '''
+    def __init__(self, method_data):
+        super().__init__()
+        self.method_data = method_data
+        self.async_methods = {}
+
+    def add_async(self, method, name):
+        self.async_methods[name] = method
+
+    async def call_async(self, ctx, jsondata):
+        if not isinstance(jsondata, dict) or jsondata.get('method') not in self.async_methods:
+            return await run_blocking(self.call, ctx, jsondata)
+        timings = ctx['timings'] = RequestTimings()
+        with recording(timings):
+            with span('rpc.call'):
+                respond = await self._call_async_method(ctx, jsondata)
+            if respond is not None:
+                add_debug_timings(respond, jsondata, timings)
+                with span('rpc.encode'):
+                    return json.dumps(respond, cls=JSONObjectEncoder)
+        return None
+
+    async def _call_async_method(self, ctx, jsondata):
+        request = self._get_default_vals()
+        self._fill_request(request, jsondata)
+        if 'types' in self.method_data[request['method']]:
+            self._validate_params_types(request['method'], request['params'])
+        method = self.async_methods[request['method']]
+        params = request['params']
+        try:
+            if isinstance(params, list):
+                result = await method(ctx, *params)
+            elif isinstance(params, dict):
+                # Do not accept keyword arguments if the jsonrpc version is
+                # not >=1.1.
+                if request['jsonrpc'] < 11:
+                    raise KeywordError
+                result = await method(ctx, **params)
+            else:  # No params
+                result = await method(ctx)
+        except JSONRPCError:
+            raise
+        except Exception as e:
+            newerr = JSONServerError()
+            newerr.trace = traceback.format_exc()
+            if len(e.args) == 1:
+                newerr.data = repr(e.args[0])
+            else:
+                newerr.data = repr(e.args)
+            raise newerr
+        # Do not respond to notifications.
+        if request['id'] is None:
+            return None
+        respond = {}
+        self._fill_ver(request['jsonrpc'], respond)
+        respond['result'] = result
+        respond['id'] = request['id']
+        return respond
+
+
+class AsgiApplication:
+    '''
+    ASGI counterpart of sample_search_apiServer.Application, authenticating and logging
+    calls with the WSGI application's auth client and logs.
+    '''
+    def __init__(cls, wsgi_app, async_impl):
+        cls.wsgi_app = wsgi_app
+        cls.rpc_service = AsyncJSONRPCService(wsgi_app.rpc_service.method_data)
+        for name in ('filter_samples', 'batch_filter_samples', 'get_sampleset_meta'):
+            cls.rpc_service.add_async(getattr(async_impl, name), 'sample_search_api.' + name)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                   for name, value in scope.get('headers', [])}
+        environ = {
+            'HTTP_X_FORWARDED_FOR': headers.get('x-forwarded-for'),
+            'HTTP_X_REAL_IP': headers.get('x-real-ip'),
+            'REMOTE_ADDR': scope['client'][0] if scope.get('client') else None
+        }
+        # Context object, equivalent to the perl impl CallContext
+        ctx = MethodContext(self.wsgi_app.userlog)
+        ctx['client_ip'] = getIPAddress(environ)
+        status = 500
+
+        if scope['method'] == 'OPTIONS':
+            # we basically do nothing and just return headers
+            status = 200
+            rpc_result = ""
+        else:
+            request_body = await self._read_body(receive)
+            try:
+                req = json.loads(request_body)
+            except ValueError as ve:
+                err = {'error': {'code': -32700,
+                                 'name': "Parse error",
+                                 'message': str(ve),
+                                 }
+                       }
+                rpc_result = self.wsgi_app.process_error(err, ctx, {'version': '1.1'})
+            else:
+                rpc_result, status = await self._call(ctx, req, headers)
+
+        response_body = (rpc_result or '').encode('utf8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'access-control-allow-origin', b'*'),
+                (b'access-control-allow-headers', headers.get(
+                    'access-control-request-headers', 'authorization').encode('latin-1')),
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(response_body)).encode('latin-1'))
+            ]
+        })
+        await send({'type': 'http.response.body', 'body': response_body})
+
+    async def _call(self, ctx, req, headers):
+        '''runs a parsed JSON RPC request, returns the response body and HTTP status'''
+        ctx['module'], ctx['method'] = req['method'].split('.')
+        ctx['call_id'] = req['id']
+        ctx['rpc_context'] = {
+            'call_stack': [{'time': self.wsgi_app.now_in_utc(),
+                            'method': req['method']}
+                           ]
+        }
+        prov_action = {'service': ctx['module'],
+                       'method': ctx['method'],
+                       'method_params': req['params']
+                       }
+        ctx['provenance'] = [prov_action]
+        try:
+            token = headers.get('authorization')
+            # parse out the method being requested and check if it
+            # has an authentication requirement
+            method_name = req['method']
+            auth_req = self.wsgi_app.method_authentication.get(method_name, 'none')
+            if auth_req != 'none':
+                if token is None and auth_req == 'required':
+                    err = JSONServerError()
+                    err.data = (
+                        'Authentication required for ' +
+                        'sample_search_api ' +
+                        'but no authentication header was passed')
+                    raise err
+                elif token is None and auth_req == 'optional':
+                    pass
+                else:
+                    try:
+                        user = await run_blocking(self.wsgi_app.auth_client.get_user, token)
+                        ctx['user_id'] = user
+                        ctx['authenticated'] = 1
+                        ctx['token'] = token
+                    except Exception as e:
+                        if auth_req == 'required':
+                            err = JSONServerError()
+                            err.data = \
+                                "Token validation failed: %s" % e
+                            raise err
+            if headers.get('x-forwarded-for'):
+                self.wsgi_app.log(log.INFO, ctx, 'X-Forwarded-For: ' +
+                                  headers.get('x-forwarded-for'))
+            self.wsgi_app.log(log.INFO, ctx, 'start method')
+            rpc_result = await self.rpc_service.call_async(ctx, req)
+            self.wsgi_app.log(log.INFO, ctx, 'end method')
+            self.wsgi_app.log_timings(ctx)
+            return rpc_result, 200
+        except JSONRPCError as jre:
+            err = {'error': {'code': jre.code,
+                             'name': jre.message,
+                             'message': jre.data
+                             }
+                   }
+            trace = jre.trace if hasattr(jre, 'trace') else None
+            return self.wsgi_app.process_error(err, ctx, req, trace), 500
+        except Exception:
+            err = {'error': {'code': 0,
+                             'name': 'Unexpected Server Error',
+                             'message': 'An unexpected server error ' +
+                                        'occurred',
+                             }
+                   }
+            return self.wsgi_app.process_error(err, ctx, req, traceback.format_exc()), 500
+
+    async def _read_body(self, receive):
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        return body
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await close_async_session()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+configure_async_session(pool_size=int((config or {}).get('re-async-pool-size', 100)))
+application = AsgiApplication(wsgi_application, AsyncImpl(impl_sample_search_api))
@@ -5,10 +5,18 @@ import os
 
 from installed_clients.KBaseReportClient import KBaseReport
 from installed_clients.SampleServiceClient import SampleService
-from installed_clients.WorkspaceClient import Workspace
 from installed_clients.baseclient import ServerError as WorkspaceError
+from installed_clients.baseclient import configure_pools
+from utils.chunking import ChunkedRunner
+from utils.facets import FacetCounter
 from utils.filter_samples import SampleFilterer
+from utils.local_filter import LocalFilterEngine
 from utils.meta_manager import MetadataManager
+from utils.parsing_and_formatting import parse_facet_input
+from utils.re_indexes import check_required_indexes
+from utils.re_utils import configure_session, get_session_stats
+from utils.sample_sets import SampleSetResolver
+from utils.static_metadata import StaticMetadataCache
 #END_HEADER
 
 
@@ -20,7 +28,6 @@ class sample_search_api:
     Module Description:
     TODO:
 Ontology type queries
-more complex lexicographical queries (nested or parenthesis)
     '''
 
     ######## WARNING FOR GEVENT USERS ####### noqa
@@ -29,11 +36,22 @@ more complex lexicographical queries (nested or parenthesis)
     # state. A method could easily clobber the state set by another while
     # the latter method is running.
     ######################################### noqa
-    VERSION = "0.1.0"
+    VERSION = "0.2.0"
     GIT_URL = "https://github.com/charleshtrenholm/sample_search_api.git"
     GIT_COMMIT_HASH = "6e628e4c48facab106c772c6341c3404d13f272c"
 
     #BEGIN_CLASS_HEADER
+    def _resolve_sample_set_refs(self, sample_set_refs, token):
+        try:
+            return self.sample_set_resolver.get_sample_ids(sample_set_refs, token)
+        except WorkspaceError:
+            raise ValueError(
+                f'Bad sampleset ids: {",".join(sample_set_refs)}'
+            )
+        except KeyError as e:
+            raise ValueError(
+                f'Invalid sampleset ref - sample in dataset missing the {str(e)} field.'
+            )
     #END_CLASS_HEADER
 
     # config contains contents of config file in a hash or None if it couldn't
@@ -42,16 +60,88 @@ more complex lexicographical queries (nested or parenthesis)
         #BEGIN_CONSTRUCTOR
         re_api_url = config.get('re-api-url', config.get('kbase-endpoint') +
                                 '/relation_engine_api')
+        configure_session(
+            pool_size=int(config.get('re-pool-size', 10)),
+            max_retries=int(config.get('re-max-retries', 3)),
+            backoff_factor=float(config.get('re-retry-backoff', 0.5)),
+            timeout=float(config.get('re-timeout', 300))
+        )
+        # SDK clients share one keep-alive session per service url
+        configure_pools(
+            max_connections=int(config.get('sdk-client-pool-size', 10)),
+            max_retries=int(config.get('sdk-client-max-retries', 0))
+        )
         self.sample_url = config.get('kbase-endpoint') + '/sampleservice'
         self.shared_folder = config['scratch']
         self.ws_url = config.get('workspace-url')
         self.sample_service = SampleService(self.sample_url)
-        self.meta_manager = MetadataManager(re_api_url,
-                                            re_admin_token=config.get('re-admin-token'))
+        self.sample_set_resolver = SampleSetResolver(
+            self.ws_url, cache_size=int(config.get('sample-set-cache-size', 1000))
+        )
+        # queries over many samples are split into chunks run concurrently
+        chunk_config = {
+            'max_workers': int(config.get('query-workers', 4)),
+            'chunk_size': int(config.get('query-chunk-size', 5000)),
+            'target_seconds': float(config.get('query-chunk-target-seconds', 2.0))
+        }
+        # the field sets are only shared between callers that query with the same token
+        persist_meta_cache = config.get('re-admin-token') and \
+            config.get('meta-cache-persist', 'false').lower() == 'true'
+        self.meta_manager = MetadataManager(
+            re_api_url,
+            re_admin_token=config.get('re-admin-token'),
+            cache_size=int(config.get('meta-cache-size', 100000)),
+            cache_dir=self.shared_folder if persist_meta_cache else None,
+            chunk_runner=ChunkedRunner(**chunk_config)
+        )
+        self.facet_counter = FacetCounter(
+            re_api_url,
+            re_admin_token=config.get('re-admin-token'),
+            chunk_runner=ChunkedRunner(**chunk_config),
+            approximate_min_samples=int(config.get('facet-approximate-min-samples', 0)),
+            precision=int(config.get('facet-sketch-precision', 12)),
+            compression=float(config.get('facet-sketch-compression', 100)),
+            max_values=int(config.get('facet-sketch-max-values', 1000))
+        )
+        # the warm keys are fetched on the first lookup of each worker
+        warm_keys = [k.strip() for k in config.get('static-metadata-warm-keys', '').split(',')]
+        self.static_metadata = StaticMetadataCache(
+            self.sample_service,
+            maxsize=int(config.get('static-metadata-cache-size', 2000)),
+            ttl=float(config.get('static-metadata-cache-ttl', 3600)),
+            warm_keys=[k for k in warm_keys if k]
+        )
+        # sets of up to 'local-filter-max-samples' samples are filtered in process, 0 disables
+        local_max_samples = int(config.get('local-filter-max-samples', 0))
+        # the loaded metadata is only shared between callers that query with the same token
+        share_local_metadata = config.get('re-admin-token') and \
+            config.get('local-filter-snapshot', 'false').lower() == 'true'
+        self.local_engine = LocalFilterEngine(
+            re_api_url,
+            max_samples=local_max_samples,
+            cache_size=int(config.get('local-filter-cache-size', 20)),
+            cache_samples=int(config.get('local-filter-cache-samples', 200000)),
+            index_memory=int(config.get('local-filter-index-memory-mb', 256)) * 1024 * 1024,
+            snapshot_dir=self.shared_folder if share_local_metadata else None,
+            snapshot_samples=int(config.get('local-filter-snapshot-samples', 1000000))
+        ) if local_max_samples > 0 else None
         self.sample_filter = SampleFilterer(config.get('re-admin-token'), re_api_url,
-                                            self.sample_service)
+                                            self.sample_service,
+                                            static_metadata=self.static_metadata,
+                                            meta_manager=self.meta_manager,
+                                            query_cache_size=int(
+                                                config.get('query-cache-size', 256)),
+                                            local_engine=self.local_engine,
+                                            chunk_runner=ChunkedRunner(**chunk_config))
         logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
                             level=logging.INFO)
+        for index in check_required_indexes(re_api_url, config.get('re-admin-token')):
+            logging.warning(f"Relation Engine collection '{index['collection']}' does not "
+                            f"declare a {index['type']} index on {index['fields']}, "
+                            "sample queries will fall back to collection scans.")
+        # uWSGI forks the workers after the constructor ran, the connection the check
+        # opened must not be shared by them
+        configure_session()
         #END_CONSTRUCTOR
         pass
 
@@ -59,7 +149,17 @@ more complex lexicographical queries (nested or parenthesis)
     def filter_samples(self, ctx, params):
         """
         General sample filtering query
-        :param params: instance of type "FilterSamplesParams" -> structure:
+        :param params: instance of type "FilterSamplesParams" (Args:
+           sample_ids - samples to filter. filter_conditions - conditions the
+           returned samples must satisfy. limit - page size, if provided at
+           most this many samples are returned along with a cursor for the
+           next page. cursor - cursor returned by a previous paged call,
+           returns the next page. When a cursor is provided all other
+           arguments are ignored. return_mode - what to return, one of: "ids"
+           - the matching samples (the default) "count" - the number of
+           distinct matching samples "exists" - whether any sample matches
+           limit may only be used with "ids". @optional limit cursor
+           return_mode) -> structure:
            parameter "sample_ids" of list of type "SampleAddress" ->
            structure: parameter "id" of type "sample_id" (A Sample ID. Must
            be globally unique. Always assigned by the Sample service.),
@@ -70,17 +170,30 @@ more complex lexicographical queries (nested or parenthesis)
            "==", "!=", "<", ">", ">=", "<=", "in", "not in" metadata_values -
            list of values on which to constrain metadata_field with the input
            operator. logical_operator - accepted values for the operators
-           are: "and", "or" potential future args: paren_position - None/0 -
-           no operation n - add "n" open parenthesis to the beginning of the
-           statement -n - add "n" closed paranthesis to the end of statement)
+           are: "and", "or" paren_position - groups conditions with
+           parentheses, "and" binds tighter than "or" None/0 - no operation n
+           - add "n" open parenthesis to the beginning of the statement -n -
+           add "n" closed paranthesis to the end of statement @optional
+           paren_position)
            -> structure: parameter "metadata_field" of String, parameter
            "comparison_operator" of String, parameter "metadata_values" of
-           list of String, parameter "logical_operator" of String
-        :returns: instance of type "FilterSamplesResults" -> structure:
-           parameter "sample_ids" of list of type "SampleAddress" ->
-           structure: parameter "id" of type "sample_id" (A Sample ID. Must
-           be globally unique. Always assigned by the Sample service.),
-           parameter "version" of Long
+           list of String, parameter "logical_operator" of String, parameter
+           "paren_position" of Long, parameter "limit" of Long, parameter
+           "cursor" of String, parameter "return_mode" of String
+        :returns: instance of type "FilterSamplesResults" (Results:
+           sample_ids - samples that satisfy the filter conditions, in the
+           order of the input sample_ids and as many times as they are listed
+           there. Paged calls return every matching sample once. cursor - for
+           paged calls, the cursor for the next page, null on the last page.
+           count - the number of distinct matching samples, for the "count"
+           return mode. exists - whether any sample matches, for the "exists"
+           return mode. @optional sample_ids cursor count exists) ->
+           structure: parameter "sample_ids" of list of type "SampleAddress"
+           -> structure: parameter "id" of type "sample_id" (A Sample ID.
+           Must be globally unique. Always assigned by the Sample service.),
+           parameter "version" of Long, parameter "cursor" of String,
+           parameter "count" of Long, parameter "exists" of type "boolean" (A
+           boolean - 0 for false, 1 for true.)
         """
         # ctx is the context object
         # return variables are: results
@@ -95,6 +208,46 @@ more complex lexicographical queries (nested or parenthesis)
         # return the results
         return [results]
 
+    def batch_filter_samples(self, ctx, params):
+        """
+        Runs several groups of filter conditions against the same samples in one query.
+        :param params: instance of type "BatchFilterSamplesParams" (Args:
+           sample_ids - samples to filter. filter_condition_groups - groups
+           of filter conditions, each group is evaluated independently
+           against sample_ids, like the filter_conditions of
+           filter_samples.) -> structure: parameter "sample_ids" of list of
+           type "SampleAddress" -> structure: parameter "id" of type
+           "sample_id" (A Sample ID. Must be globally unique. Always assigned
+           by the Sample service.), parameter "version" of Long, parameter
+           "filter_condition_groups" of list of list of type
+           "filter_condition" -> structure: parameter "metadata_field" of
+           String, parameter "comparison_operator" of String, parameter
+           "metadata_values" of list of String, parameter "logical_operator"
+           of String, parameter "paren_position" of Long
+        :returns: instance of type "BatchFilterSamplesResults" (Results:
+           results - one result per filter condition group, in the order of
+           the groups.) -> structure: parameter "results" of list of type
+           "FilterGroupResult" (Results: sample_ids - samples that satisfy
+           the group's filter conditions. count - number of samples that
+           satisfy the group's filter conditions.) -> structure: parameter
+           "sample_ids" of list of type "SampleAddress" -> structure:
+           parameter "id" of type "sample_id" (A Sample ID. Must be globally
+           unique. Always assigned by the Sample service.), parameter
+           "version" of Long, parameter "count" of Long
+        """
+        # ctx is the context object
+        # return variables are: results
+        #BEGIN batch_filter_samples
+        results = self.sample_filter.batch_filter_samples(params, ctx.get('token'))
+        #END batch_filter_samples
+
+        # At some point might do deeper type checking...
+        if not isinstance(results, dict):
+            raise ValueError('Method batch_filter_samples return value ' +
+                             'results is not type dict as required.')
+        # return the results
+        return [results]
+
     def get_sampleset_meta(self, ctx, params):
         """
         Gets all metadata fields present in a given list of samples. If samples with different
@@ -108,24 +261,8 @@ more complex lexicographical queries (nested or parenthesis)
         # ctx is the context object
         # return variables are: results
         #BEGIN get_sampleset_meta
-        ws_input = {'objects': [{'ref': o} for o in params.get('sample_set_refs')]}
-        ws = Workspace(self.ws_url, token=ctx.get('token'))
-        try:
-            samples = []
-            for sample_set in ws.get_objects2(ws_input)['data']:
-                samples.extend(sample_set['data']['samples'])
-            sample_ids = [{
-                'id': sample['id'],
-                'version': sample['version']
-            } for sample in samples]
-        except WorkspaceError:
-            raise ValueError(
-                f'Bad sampleset ids: {",".join(params.get("sample_set_refs"))}'
-            )
-        except KeyError as e:
-            raise ValueError(
-                f'Invalid sampleset ref - sample in dataset missing the {str(e)} field.'
-            )
+        sample_ids = self._resolve_sample_set_refs(params.get('sample_set_refs'),
+                                                   ctx.get('token'))
         fields = self.meta_manager.get_sampleset_meta(sample_ids, ctx.get('token'))
         results = [{'field': f} for f in fields]
         #END get_sampleset_meta
@@ -135,12 +272,89 @@ more complex lexicographical queries (nested or parenthesis)
                              'results is not type list as required.')
         # return the results
         return [results]
+
+    def get_sampleset_facets(self, ctx, params):
+        """
+        Gets the distribution of the values of metadata fields over a set of samples in one
+        aggregation, for rendering the facet panels of the filter_samplesets dropdowns.
+        :param params: instance of type "GetSamplesetFacetsParams" (Args:
+           sample_ids - samples to describe. sample_set_refs - SampleSets
+           whose samples are described, together with sample_ids. At least
+           one of sample_ids and sample_set_refs is required. fields -
+           metadata fields to describe, "custom:" prefixed for uncontrolled
+           fields. Every field present in the samples when not given. top_k
+           - number of most frequent values returned for non numeric fields,
+           10 by default, at most 1000. num_buckets - number of histogram
+           buckets for numeric fields, 10 by default, at most 100.
+           approximate - 1 to describe the samples with fixed size sketches, 0
+           for exact results. By default large sets are described
+           approximately. @optional sample_ids sample_set_refs fields top_k
+           num_buckets approximate) -> structure:
+           parameter "sample_ids" of list of type "SampleAddress" ->
+           structure: parameter "id" of type "sample_id" (A Sample ID. Must
+           be globally unique. Always assigned by the Sample service.),
+           parameter "version" of Long, parameter "sample_set_refs" of list
+           of String, parameter "fields" of list of String, parameter "top_k"
+           of Long, parameter "num_buckets" of Long, parameter "approximate"
+           of type "boolean" (A boolean - 0 for false, 1 for true.)
+        :returns: instance of type "GetSamplesetFacetsResults" (Results:
+           facets - one facet per field present in the samples, sorted by
+           field. approximate - 1 if the facets are estimates: distinct
+           counts, quantiles and bucket counts are approximate and value
+           counts are lower bounds, values too rare to be told apart from the
+           error are left out.) -> structure: parameter "facets" of list of
+           type
+           "FieldFacet" (Results: field - metadata field name. type -
+           "number" if every value of the field is a number, "string"
+           otherwise. count - number of samples with a value for the field.
+           distinct_count - number of distinct values of the field. values -
+           for "string" fields, the top_k most frequent values and the number
+           of samples with each, most frequent first. min, max - for
+           "number" fields, the smallest and largest value. quantiles - for
+           "number" fields, the 5th, 25th, 50th, 75th and 95th percentiles of
+           the sample values. buckets - for "number" fields, num_buckets
+           equal width buckets between min and max, with the number of sample
+           values in each. @optional values min max quantiles buckets) ->
+           structure: parameter "field" of String,
+           parameter "type" of String, parameter "count" of Long, parameter
+           "distinct_count" of Long, parameter "values" of list of type
+           "FacetValue" -> structure: parameter "value" of unspecified
+           object, parameter "count" of Long, parameter "min" of Double,
+           parameter "max" of Double, parameter "quantiles" of list of type
+           "FacetQuantile" -> structure: parameter "quantile" of Double,
+           parameter "value" of Double, parameter "buckets" of list of type
+           "FacetBucket" -> structure: parameter "lower" of Double, parameter
+           "upper" of Double, parameter "count" of Long, parameter
+           "approximate" of type "boolean" (A boolean - 0 for false, 1 for
+           true.)
+        """
+        # ctx is the context object
+        # return variables are: results
+        #BEGIN get_sampleset_facets
+        fields, top_k, num_buckets, approximate = parse_facet_input(params)
+        sample_ids = list(params.get('sample_ids') or [])
+        if params.get('sample_set_refs'):
+            sample_ids.extend(self._resolve_sample_set_refs(params['sample_set_refs'],
+                                                            ctx.get('token')))
+        results = self.facet_counter.get_sampleset_facets(
+            sample_ids, fields, top_k, num_buckets, ctx.get('token'), approximate=approximate
+        )
+        #END get_sampleset_facets
+
+        # At some point might do deeper type checking...
+        if not isinstance(results, dict):
+            raise ValueError('Method get_sampleset_facets return value ' +
+                             'results is not type dict as required.')
+        # return the results
+        return [results]
     def status(self, ctx):
         #BEGIN_STATUS
         returnVal = {'state': "OK",
                      'message': "",
                      'version': self.VERSION,
                      'git_url': self.GIT_URL,
-                     'git_commit_hash': self.GIT_COMMIT_HASH}
+                     'git_commit_hash': self.GIT_COMMIT_HASH,
+                     # counters of the Relation Engine connection pool of this worker
+                     'relation_engine_session': get_session_stats()}
         #END_STATUS
         return [returnVal]
@@ -18,6 +18,7 @@ from jsonrpcbase import ServerError as JSONServerError
 
 from biokbase import log
 from sample_search_api.authclient import KBaseAuth as _KBaseAuth
+from utils.timing import RequestTimings, recording, span
 
 try:
     from ConfigParser import ConfigParser
@@ -67,6 +68,15 @@ class JSONObjectEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+def add_debug_timings(respond, jsondata, timings):
+    """Adds the timing spans to the response of a request asking for them."""
+    if not isinstance(respond, dict) or not isinstance(jsondata, dict):
+        return
+    context = jsondata.get('context')
+    if isinstance(context, dict) and context.get('debug'):
+        respond['debug'] = {'timings': timings.to_json()}
+
+
 class JSONRPCServiceCustom(JSONRPCService):
 
     def call(self, ctx, jsondata):
@@ -74,12 +84,21 @@ class JSONRPCServiceCustom(JSONRPCService):
         Calls jsonrpc service's method and returns its return value in a JSON
         string or None if there is none.
 
+        The time spent in the stages of the call is recorded in ctx['timings'],
+        and returned in the 'debug' field of the response if the 'context' of the
+        request has a true 'debug' value.
+
         Arguments:
         jsondata -- remote method call in jsonrpc format
         """
-        result = self.call_py(ctx, jsondata)
-        if result is not None:
-            return json.dumps(result, cls=JSONObjectEncoder)
+        timings = ctx['timings'] = RequestTimings()
+        with recording(timings):
+            with span('rpc.call'):
+                result = self.call_py(ctx, jsondata)
+            if result is not None:
+                add_debug_timings(result, jsondata, timings)
+                with span('rpc.encode'):
+                    return json.dumps(result, cls=JSONObjectEncoder)
 
         return None
 
@@ -209,6 +228,7 @@ class MethodContext(dict):
         self['call_id'] = None
         self['rpc_context'] = None
         self['provenance'] = None
+        self['timings'] = None
         self._debug_levels = set([7, 8, 9, 'DEBUG', 'DEBUG2', 'DEBUG3'])
         self._logger = logger
 
@@ -342,15 +362,25 @@ class Application(object):
                              name='sample_search_api.filter_samples',
                              types=[dict])
         self.method_authentication['sample_search_api.filter_samples'] = 'required'  # noqa
+        self.rpc_service.add(impl_sample_search_api.batch_filter_samples,
+                             name='sample_search_api.batch_filter_samples',
+                             types=[dict])
+        self.method_authentication['sample_search_api.batch_filter_samples'] = 'required'  # noqa
         self.rpc_service.add(impl_sample_search_api.get_sampleset_meta,
                              name='sample_search_api.get_sampleset_meta',
                              types=[dict])
         self.method_authentication['sample_search_api.get_sampleset_meta'] = 'required'  # noqa
+        self.rpc_service.add(impl_sample_search_api.get_sampleset_facets,
+                             name='sample_search_api.get_sampleset_facets',
+                             types=[dict])
+        self.method_authentication['sample_search_api.get_sampleset_facets'] = 'required'  # noqa
         self.rpc_service.add(impl_sample_search_api.status,
                              name='sample_search_api.status',
                              types=[dict])
         authurl = config.get(AUTH) if config else None
         self.auth_client = _KBaseAuth(authurl)
+        self.log_request_timings = \
+            (config or {}).get('log-request-timings', 'true').lower() == 'true'
 
     def __call__(self, environ, start_response):
         # Context object, equivalent to the perl impl CallContext
@@ -425,6 +455,7 @@ class Application(object):
                     self.log(log.INFO, ctx, 'start method')
                     rpc_result = self.rpc_service.call(ctx, req)
                     self.log(log.INFO, ctx, 'end method')
+                    self.log_timings(ctx)
                     status = '200 OK'
                 except JSONRPCError as jre:
                     err = {'error': {'code': jre.code,
@@ -464,7 +495,14 @@ class Application(object):
         start_response(status, response_headers)
         return [response_body.encode('utf8')]
 
+    def log_timings(self, context):
+        '''logs the time spent in the stages of the call as one JSON line'''
+        if self.log_request_timings and context.get('timings') is not None:
+            self.log(log.INFO, context, 'request timings ' +
+                     json.dumps(context['timings'].summary(), sort_keys=True))
+
     def process_error(self, error, context, request, trace=None):
+        self.log_timings(context)
         if trace:
             self.log(log.ERR, context, trace.split('\n')[0:-1])
         if 'id' in request:
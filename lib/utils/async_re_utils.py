@@ -0,0 +1,121 @@
+# asyncio relation engine utilities
+
+"""
+Relation engine API client coroutines, the asyncio counterparts of utils.re_utils.
+Requires the optional aiohttp package, only the ASGI entry point uses them.
+"""
+import asyncio
+import json
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from utils.re_utils import _SESSION_CONFIG, _RETRY_STATUSES
+from utils.timing import span
+
+# Keep-alive connections shared by every asyncio Relation Engine request of an event
+# loop. The retry policy and timeout are the ones configured in utils.re_utils.
+_ASYNC_SESSION_CONFIG = {
+    'pool_size': 100
+}
+_sessions = {}
+
+
+def configure_async_session(pool_size=None):
+    """Sets the maximum number of connections an event loop keeps open to the RE."""
+    if pool_size is not None:
+        _ASYNC_SESSION_CONFIG['pool_size'] = pool_size
+
+
+def get_async_session():
+    """Returns the keep-alive aiohttp session of the running event loop."""
+    if aiohttp is None:
+        raise RuntimeError("The aiohttp package is required for asyncio Relation Engine "
+                           "requests")
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=_ASYNC_SESSION_CONFIG['pool_size']),
+            timeout=aiohttp.ClientTimeout(total=_SESSION_CONFIG['timeout'])
+        )
+        _sessions[loop] = session
+    return session
+
+
+async def close_async_session():
+    """Closes the session of the running event loop, for application shutdown."""
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+async def _post(re_api_url, token, data=None, params=None, retry=True):
+    """
+    POSTs to the query results endpoint, retrying gateway and connection errors like
+    the pooled session of utils.re_utils. Without retry only failures to connect are
+    retried, for requests the RE must not serve twice.
+    """
+    session = get_async_session()
+    attempt = 0
+    while True:
+        try:
+            async with session.post(
+                re_api_url + '/api/v1/query_results',
+                data=data,
+                params=params,
+                headers={'Authorization': token}
+            ) as resp:
+                text = await resp.text()
+                if not retry or resp.status not in _RETRY_STATUSES or \
+                        attempt >= _SESSION_CONFIG['max_retries']:
+                    if resp.status >= 400:
+                        raise RuntimeError(text)
+                    return json.loads(text)
+        except aiohttp.ClientConnectionError as error:
+            if attempt >= _SESSION_CONFIG['max_retries'] or \
+                    not (retry or isinstance(error, aiohttp.ClientConnectorError)):
+                raise
+        await asyncio.sleep(_SESSION_CONFIG['backoff_factor'] * (2 ** attempt))
+        attempt += 1
+
+
+async def execute_query(query, re_api_url, token, params=None, batch_size=None):
+    """
+    Execute an arbitrary query in the database.
+    NOTE: be sure to guard against AQL injection when using this function.
+    NOTE: token must be Relation Engine Admin token.
+    batch_size - if given, at most this many results are returned and the response
+        carries a 'cursor_id' to fetch the rest with fetch_cursor while 'has_more' is true.
+    """
+    if not params:
+        params = {}
+    params['query'] = query
+    with span('re.execute_query'):
+        return await _post(re_api_url, token, data=json.dumps(params),
+                           params={'batch_size': batch_size} if batch_size else None)
+
+
+async def fetch_cursor(cursor_id, re_api_url, token):
+    """
+    Fetch the next batch of results of a query run with a batch_size. A failed fetch is
+    not retried, the RE may have advanced the cursor past the batch it lost.
+    """
+    with span('re.fetch_cursor'):
+        return await _post(re_api_url, token, params={'cursor_id': cursor_id}, retry=False)
+
+
+async def iter_query_results(query, re_api_url, token, params=None, batch_size=1000):
+    """
+    Asynchronous generator over the results of a query, fetched and decoded one batch of
+    at most batch_size results at a time.
+    """
+    resp = await execute_query(query, re_api_url, token, params, batch_size=batch_size)
+    while True:
+        for result in resp['results']:
+            yield result
+        if not resp.get('has_more'):
+            return
+        resp = await fetch_cursor(resp['cursor_id'], re_api_url, token)
@@ -0,0 +1,78 @@
+# in-process caching utilities
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    '''
+    Thread safe, size bounded least recently used cache with optional expiry.
+    maxsize - maximum number of entries kept, the least recently used is dropped first.
+    ttl - seconds an entry stays valid, None for entries that never expire.
+    max_weight - optional bound on the total weight of the entries, given by
+        weigh(value). The most recently set entry is kept even if it is heavier.
+    '''
+    def __init__(cls, maxsize=1000, ttl=None, max_weight=None, weigh=None):
+        cls.maxsize = maxsize
+        cls.ttl = ttl
+        cls.max_weight = max_weight
+        cls.weigh = weigh
+        cls.weight = 0
+        cls._entries = OrderedDict()
+        cls._lock = threading.Lock()
+        cls.hits = 0
+        cls.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires, _ = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._pop(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        weight = self.weigh(value) if self.weigh is not None else 0
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (value, expires, weight)
+            self.weight += weight
+            while len(self._entries) > self.maxsize or (
+                    self.max_weight is not None and self.weight > self.max_weight and
+                    len(self._entries) > 1):
+                self._pop(next(iter(self._entries)))
+
+    def items(self):
+        '''unexpired (key, value) pairs, least recently used first'''
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value) for key, (value, expires, _) in self._entries.items()
+                    if expires is None or expires > now]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.weight = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            stats = {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+            if self.max_weight is not None:
+                stats['weight'] = self.weight
+            return stats
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.weight -= entry[2]
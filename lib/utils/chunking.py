@@ -0,0 +1,78 @@
+# concurrent execution of queries over chunks of a large list of samples
+import asyncio
+import threading
+import time
+
+from utils.executors import ProcessLocalExecutor
+from utils.timing import bind
+
+
+class ChunkedRunner:
+    '''
+    Splits long lists of sample addresses into chunks queried concurrently by up to
+    'max_workers' threads (or coroutines), keeping the results in input order.
+    The chunk size starts at 'chunk_size' and is tuned from the observed query latency
+    so a chunk takes about 'target_seconds', within [min_chunk_size, max_chunk_size].
+    '''
+    def __init__(cls, max_workers=4, chunk_size=5000, min_chunk_size=500,
+                 max_chunk_size=20000, target_seconds=2.0):
+        cls.max_workers = max_workers
+        cls.chunk_size = chunk_size
+        cls.min_chunk_size = min_chunk_size
+        cls.max_chunk_size = max_chunk_size
+        cls.target_seconds = target_seconds
+        # exponentially weighted moving average of the seconds spent per item
+        cls.seconds_per_item = None
+        cls._executor = ProcessLocalExecutor(max_workers=max_workers)
+        cls._lock = threading.Lock()
+
+    def split(self, items):
+        '''splits 'items' into chunks of the current chunk size'''
+        size = self.chunk_size
+        return [items[start:start + size] for start in range(0, len(items), size)] or [items]
+
+    def map(self, func, chunks):
+        '''returns [func(chunk) for chunk in chunks], running the calls concurrently'''
+        if len(chunks) == 1:
+            return [self._timed(func, chunks[0])]
+        timed = bind(self._timed)
+        futures = [self._executor.submit(timed, func, chunk) for chunk in chunks]
+        return [future.result() for future in futures]
+
+    async def map_async(self, func, chunks):
+        '''returns [await func(chunk) for chunk in chunks], awaiting the calls concurrently'''
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def run(chunk):
+            async with semaphore:
+                start = time.monotonic()
+                result = await func(chunk)
+                self.observe(len(chunk), time.monotonic() - start)
+                return result
+
+        return list(await asyncio.gather(*[run(chunk) for chunk in chunks]))
+
+    def observe(self, num_items, seconds):
+        '''updates the chunk size from the time a query over 'num_items' items took'''
+        if num_items < self.min_chunk_size:
+            # fixed per query overhead dominates small queries
+            return
+        with self._lock:
+            per_item = seconds / num_items
+            if self.seconds_per_item is None:
+                self.seconds_per_item = per_item
+            else:
+                self.seconds_per_item = 0.8 * self.seconds_per_item + 0.2 * per_item
+            if self.seconds_per_item > 0:
+                size = int(self.target_seconds / self.seconds_per_item)
+                self.chunk_size = max(self.min_chunk_size, min(self.max_chunk_size, size))
+
+    def stats(self):
+        with self._lock:
+            return {'chunk_size': self.chunk_size, 'seconds_per_item': self.seconds_per_item}
+
+    def _timed(self, func, chunk):
+        start = time.monotonic()
+        result = func(chunk)
+        self.observe(len(chunk), time.monotonic() - start)
+        return result
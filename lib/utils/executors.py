@@ -0,0 +1,41 @@
+# thread pools of the request handlers and running blocking calls off the event loop
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.timing import bind
+
+
+class ProcessLocalExecutor:
+    '''
+    Thread pool of up to 'max_workers' threads, created on first use in each process.
+    The threads of a pool do not survive a fork, calls submitted in a uWSGI worker to a
+    pool created in the master before the workers were forked would never run.
+    '''
+    def __init__(cls, max_workers=4):
+        cls.max_workers = max_workers
+        cls._executor = None
+        cls._pid = None
+        cls._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        '''schedules func(*args, **kwargs) on the pool of this process'''
+        return self._get_executor().submit(func, *args, **kwargs)
+
+    def _get_executor(self):
+        pid = os.getpid()
+        with self._lock:
+            if self._pid != pid:
+                # the pool of the parent process is left alone, it has no threads here
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+                self._pid = pid
+            return self._executor
+
+
+def run_blocking(func, *args, **kwargs):
+    '''runs a blocking call in the default executor of the running event loop'''
+    # the call records its spans with the recorder of the calling task
+    call = functools.partial(bind(func), *args, **kwargs)
+    return asyncio.get_running_loop().run_in_executor(None, call)
@@ -0,0 +1,331 @@
+# value distributions of the metadata fields of a set of samples
+from utils.chunking import ChunkedRunner
+from utils.parsing_and_formatting import unique_sample_ids
+from utils.re_utils import iter_query_results
+from utils.sketches import FrequentValues, HyperLogLog, TDigest, fraction_between, interpolate
+
+SAMPLE_NODE_COLLECTION = "samples_nodes"
+SAMPLE_SAMPLE_COLLECTION = "samples_sample"
+
+# Aggregates the metadata values of the requested samples in a single pass over their
+# nodes. 'sample_values' holds every distinct (field, sample, value) triple, from which
+# the query returns the number of samples with each field ({"field", "count"} rows) and
+# the number of samples with each value of each field ({"field", "value", "count"} rows).
+# Like the filters, only the 'value' entries of the metadata are considered, null values
+# are left out.
+AQL_facet_query = f"""
+let sample_values = (for sample_id in @sample_ids
+    let version_id = DOCUMENT(
+        {SAMPLE_SAMPLE_COLLECTION}, sample_id.id
+    ).vers[sample_id.version - 1]
+    for node in {SAMPLE_NODE_COLLECTION}
+        FILTER node.uuidver == version_id AND node.id == sample_id.id
+        for meta in APPEND(
+            node.cmeta[* FILTER CURRENT.k == 'value' RETURN [CURRENT.ok, CURRENT.v]],
+            node.ucmeta[* FILTER CURRENT.k == 'value'
+                RETURN [CONCAT("custom:", CURRENT.ok), CURRENT.v]]
+        )
+            FILTER meta[1] != null AND (@all_fields OR meta[0] IN @fields)
+            RETURN DISTINCT [meta[0], sample_id.id, sample_id.version, meta[1]]
+)
+let field_counts = (for row in sample_values
+    COLLECT field = row[0], id = row[1], version = row[2]
+    COLLECT sample_field = field WITH COUNT INTO count
+    RETURN {{"field": sample_field, "count": count}}
+)
+let value_counts = (for row in sample_values
+    COLLECT field = row[0], value = row[3] WITH COUNT INTO count
+    RETURN {{"field": field, "value": value, "count": count}}
+)
+for row in APPEND(field_counts, value_counts)
+    RETURN row
+"""
+
+# number of low bits of the AQL HASH() of a value the HyperLogLog registers are built from
+HASH_BITS = 48
+
+# Reduces the metadata values of the requested samples to one fixed size summary per
+# field, so the transfer does not grow with the number of distinct values:
+#   count, value_count - the number of samples with the field and with each of its values
+#   values - the @max_values most frequent [value, count] pairs
+#   registers - [register, rank] HyperLogLog pairs of the distinct values, from the low
+#               @rank_bits + log2(@num_registers) bits of their hash
+#   numbers, min, max - the number, smallest and largest of the numeric values
+#   centroids - [mean, weight] t-digest centroids of the sorted numeric values, cut at
+#               every unit of the t-digest scale function with compression @compression
+# sample_values is built like in AQL_facet_query.
+AQL_facet_sketch_query = f"""
+let sample_values = (for sample_id in @sample_ids
+    let version_id = DOCUMENT(
+        {SAMPLE_SAMPLE_COLLECTION}, sample_id.id
+    ).vers[sample_id.version - 1]
+    for node in {SAMPLE_NODE_COLLECTION}
+        FILTER node.uuidver == version_id AND node.id == sample_id.id
+        for meta in APPEND(
+            node.cmeta[* FILTER CURRENT.k == 'value' RETURN [CURRENT.ok, CURRENT.v]],
+            node.ucmeta[* FILTER CURRENT.k == 'value'
+                RETURN [CONCAT("custom:", CURRENT.ok), CURRENT.v]]
+        )
+            FILTER meta[1] != null AND (@all_fields OR meta[0] IN @fields)
+            RETURN DISTINCT [meta[0], sample_id.id, sample_id.version, meta[1]]
+)
+for row in sample_values
+    COLLECT field = row[0] INTO field_rows = row
+    let values = (for value_row in field_rows
+        COLLECT value = value_row[3] WITH COUNT INTO count
+        SORT count DESC
+        LIMIT @max_values
+        RETURN [value, count]
+    )
+    let registers = (for value_row in field_rows
+        let hash = HASH(value_row[3]) % @hash_range
+        let rest = FLOOR(hash / @num_registers)
+        COLLECT register = hash % @num_registers
+        AGGREGATE rank = MAX(@rank_bits + 1 - (rest == 0 ? 0 : FLOOR(LOG2(rest)) + 1))
+        RETURN [register, rank]
+    )
+    let numbers = (for value_row in field_rows
+        FILTER IS_NUMBER(value_row[3])
+        SORT value_row[3]
+        RETURN value_row[3]
+    )
+    let num_numbers = LENGTH(numbers)
+    let centroids = (for idx in 0..num_numbers
+        FILTER idx < num_numbers
+        COLLECT bin = FLOOR(
+            @compression / (2 * PI()) * ASIN(2 * (idx + 0.5) / num_numbers - 1)
+        )
+        AGGREGATE mean = AVERAGE(numbers[idx]), weight = LENGTH(1)
+        RETURN [mean, weight]
+    )
+    RETURN {{
+        "field": field,
+        "count": LENGTH(UNIQUE(field_rows[* RETURN [CURRENT[1], CURRENT[2]]])),
+        "value_count": LENGTH(field_rows),
+        "values": values,
+        "registers": registers,
+        "numbers": num_numbers,
+        "min": FIRST(numbers),
+        "max": LAST(numbers),
+        "centroids": centroids
+    }}
+"""
+
+# quantiles reported for numeric fields
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _value_key(value):
+    '''dict key of a metadata value, keeping true and false apart from 1 and 0'''
+    return (isinstance(value, bool), value)
+
+
+def _buckets(low, high, counts):
+    '''the histogram buckets of 'counts', equal width buckets from low to high'''
+    num_buckets = len(counts)
+    edges = [interpolate(low, high, idx / num_buckets) for idx in range(num_buckets)] + [high]
+    return [{
+        'lower': edges[idx],
+        'upper': edges[idx + 1],
+        'count': count
+    } for idx, count in enumerate(counts)]
+
+
+def _number_facet(facet, value_counts, num_buckets):
+    '''adds the range, quantiles and histogram of the numeric values to the facet'''
+    value_counts.sort()
+    low, high = value_counts[0][0], value_counts[-1][0]
+    total = sum(count for _, count in value_counts)
+    counts = [0] * (num_buckets if low != high else 1)
+    for value, count in value_counts:
+        bucket = int(fraction_between(value, low, high) * num_buckets) if low != high else 0
+        counts[min(bucket, len(counts) - 1)] += count
+    quantiles = []
+    cumulative = 0
+    values = iter(value_counts)
+    for q in QUANTILES:
+        # the smallest value with at least a q fraction of the values at or below it
+        while cumulative < q * total or not cumulative:
+            value, count = next(values)
+            cumulative += count
+        quantiles.append({'quantile': q, 'value': value})
+    facet.update({'type': 'number', 'min': low, 'max': high, 'quantiles': quantiles,
+                  'buckets': _buckets(low, high, counts)})
+
+
+def build_facets(rows, top_k, num_buckets):
+    '''
+    Builds the facet of every field from the AQL_facet_query result rows. Fields with
+    only numeric values get the range and a histogram of their values, other fields
+    their top_k most frequent values. Facets are sorted by field name.
+    '''
+    field_counts = {}
+    value_counts = {}
+    for row in rows:
+        field = row['field']
+        if 'value' in row:
+            values = value_counts.setdefault(field, {})
+            key = _value_key(row['value'])
+            count, _ = values.get(key, (0, None))
+            values[key] = (count + row['count'], row['value'])
+        else:
+            field_counts[field] = field_counts.get(field, 0) + row['count']
+    facets = []
+    for field in sorted(field_counts):
+        counts = [(value, count) for count, value in value_counts.get(field, {}).values()]
+        facet = {
+            'field': field,
+            'count': field_counts[field],
+            'distinct_count': len(counts)
+        }
+        if counts and all(_is_number(value) for value, _ in counts):
+            _number_facet(facet, counts, num_buckets)
+        else:
+            facet['type'] = 'string'
+            # most frequent first, ties in the order of the values' text
+            counts.sort(key=lambda value_count: (-value_count[1], str(value_count[0])))
+            facet['values'] = [{'value': value, 'count': count}
+                               for value, count in counts[:top_k]]
+        facets.append(facet)
+    return facets
+
+
+class FieldSketch:
+    '''
+    Mergeable approximate summary of the values of one field, of a size independent of
+    the number of samples: the number of samples with the field, a HyperLogLog of the
+    distinct values, a t-digest of the numeric values and the most frequent values.
+    '''
+    def __init__(cls, precision=12, compression=100, max_values=1000):
+        cls.count = 0
+        cls.distinct = HyperLogLog(precision)
+        cls.numbers = TDigest(compression)
+        cls.only_numbers = True
+        cls.values = FrequentValues(max_values)
+
+    def add_summary(self, row):
+        '''adds an AQL_facet_sketch_query result row of the field'''
+        self.count += row['count']
+        self.distinct.merge_registers(row['registers'])
+        self.values.add_top(((_value_key(value), value, count) for value, count in row['values']),
+                            row['value_count'])
+        if row['numbers']:
+            self.numbers.add_centroids(row['centroids'], row['min'], row['max'])
+        if row['numbers'] < row['value_count']:
+            self.only_numbers = False
+
+    def merge(self, other):
+        self.count += other.count
+        self.distinct.merge(other.distinct)
+        self.numbers.merge(other.numbers)
+        self.only_numbers = self.only_numbers and other.only_numbers
+        self.values.merge(other.values)
+
+    def facet(self, field, top_k, num_buckets):
+        facet = {'field': field, 'count': self.count,
+                 'distinct_count': self.distinct.estimate()}
+        numbers = self.numbers
+        if not self.only_numbers or not numbers.total:
+            facet['type'] = 'string'
+            facet['values'] = [{'value': value, 'count': count}
+                               for value, count in self.values.most_frequent(top_k)]
+            return facet
+        if numbers.min == numbers.max:
+            counts = [numbers.total]
+        else:
+            edges = [numbers.cdf(interpolate(numbers.min, numbers.max, idx / num_buckets))
+                     for idx in range(1, num_buckets)]
+            edges = [0.0] + edges + [1.0]
+            counts = [int(round(numbers.total * (edges[idx + 1] - edges[idx])))
+                      for idx in range(num_buckets)]
+        facet.update({
+            'type': 'number',
+            'min': numbers.min,
+            'max': numbers.max,
+            'quantiles': [{'quantile': q, 'value': numbers.quantile(q)} for q in QUANTILES],
+            'buckets': _buckets(numbers.min, numbers.max, counts)
+        })
+        return facet
+
+
+class FacetCounter:
+    '''
+    Computes the value distributions of the metadata fields of sets of samples. The
+    samples are aggregated by the Relation Engine in concurrent chunks, whose counts
+    are merged here.
+    Sets of at least 'approximate_min_samples' samples (0 for never) are described
+    approximately: the Relation Engine reduces every chunk to a fixed size summary per
+    field, merged into a FieldSketch per field, so neither the transfer nor memory grow
+    with the number of distinct values.
+    precision, compression, max_values - the FieldSketch error bounds.
+    '''
+    def __init__(cls, re_api_url, re_admin_token=None, chunk_runner=None,
+                 approximate_min_samples=0, precision=12, compression=100, max_values=1000):
+        cls.re_api_url = re_api_url
+        cls.re_admin_token = re_admin_token
+        cls.chunk_runner = chunk_runner or ChunkedRunner()
+        cls.approximate_min_samples = approximate_min_samples
+        cls.sketch_config = {
+            'precision': precision,
+            'compression': compression,
+            'max_values': max_values
+        }
+
+    def get_sampleset_facets(self, sample_ids, fields, top_k, num_buckets, user_token,
+                             approximate=None):
+        '''
+        Returns the facets of the given fields of the samples, of every field present in
+        the samples if 'fields' is empty, and whether they are approximate.
+        approximate - True or False to override the choice by set size.
+        '''
+        # use the user token if an admin token is not provided
+        run_token = self.re_admin_token if self.re_admin_token else user_token
+        sample_ids = unique_sample_ids(sample_ids)
+        if approximate is None:
+            approximate = 0 < self.approximate_min_samples <= len(sample_ids)
+        query_params = {'all_fields': not fields, 'fields': fields or []}
+        if approximate:
+            precision = self.sketch_config['precision']
+            query_params.update({
+                'max_values': self.sketch_config['max_values'],
+                'hash_range': 2 ** HASH_BITS,
+                'num_registers': 2 ** precision,
+                'rank_bits': HASH_BITS - precision,
+                'compression': self.sketch_config['compression']
+            })
+        query = AQL_facet_sketch_query if approximate else AQL_facet_query
+
+        def query_chunk(chunk):
+            rows = iter_query_results(query, self.re_api_url, run_token,
+                                      dict(query_params, sample_ids=chunk))
+            return self._sketch_rows(rows) if approximate else list(rows)
+
+        # the counts of the chunks are added up, so no sample may be in two chunks
+        chunk_results = self.chunk_runner.map(query_chunk, self.chunk_runner.split(sample_ids))
+        if not approximate:
+            facets = build_facets((row for rows in chunk_results for row in rows),
+                                  top_k, num_buckets)
+            return {'facets': facets, 'approximate': 0}
+        sketches = {}
+        for chunk_sketches in chunk_results:
+            for field, sketch in chunk_sketches.items():
+                if field in sketches:
+                    sketches[field].merge(sketch)
+                else:
+                    sketches[field] = sketch
+        facets = [sketches[field].facet(field, top_k, num_buckets) for field in sorted(sketches)]
+        return {'facets': facets, 'approximate': 1}
+
+    def _sketch_rows(self, rows):
+        '''folds AQL_facet_sketch_query result rows into a FieldSketch per field'''
+        sketches = {}
+        for row in rows:
+            sketch = sketches.get(row['field'])
+            if sketch is None:
+                sketch = sketches[row['field']] = FieldSketch(**self.sketch_config)
+            sketch.add_summary(row)
+        return sketches
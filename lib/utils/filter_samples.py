@@ -1,94 +1,462 @@
 # Primary file for filtering samples workflows
-from utils.re_utils import execute_query
+import itertools
+
+import utils.async_re_utils as async_re_utils
+from utils.re_utils import execute_query, fetch_cursor
 from utils.parsing_and_formatting import (
     parse_input,
+    parse_batch_input,
     parse_field,
     parse_values,
     parse_comparison_operator,
     parse_logical_operator,
+    parse_paren_position,
+    parse_limit,
+    parse_return_mode,
+    unique_sample_ids,
+    build_filter_tree,
+    simplify_filter_tree,
+    filter_tree_leaves,
+    filter_tree_shape,
     field_value_formatting,
     partition_controlled_parsed_filters
 )
+from utils.cache import LRUCache
+from utils.chunking import ChunkedRunner
+from utils.executors import ProcessLocalExecutor, run_blocking
+from utils.local_filter import UnsupportedFilter
 from utils.meta_manager import MetadataManager
+from utils.static_metadata import StaticMetadataCache
+from utils.timing import bind, span
 
 SAMPLE_NODE_COLLECTION = "samples_nodes"
 SAMPLE_SAMPLE_COLLECTION = "samples_sample"
 
 # AQL = Arango Query Languages
 # double curly braces "{{}}" are used to create string literal curly braces "{}"
+# Each requested sample resolves its version uuid through a primary key lookup on
+# the samples collection, and its nodes through the persistent 'uuidver' index on
+# the nodes collection (see utils/re_indexes.py), so the cost of the query scales
+# with the number of requested samples rather than with the size of the collection.
 AQL_query_template = f"""
-let version_ids = (for sample_id in @sample_ids
-    let doc = DOCUMENT({SAMPLE_SAMPLE_COLLECTION}, sample_id.id)
+for sample_id in @sample_ids
+    let version_id = DOCUMENT(
+        {SAMPLE_SAMPLE_COLLECTION}, sample_id.id
+    ).vers[sample_id.version - 1]
+    for node in {SAMPLE_NODE_COLLECTION}
+        FILTER node.uuidver == version_id and node.id == sample_id.id
+        FILTER """
+
+# Filters read the 'value' entry of a single metadata key straight out of the
+# node's metadata arrays, so no merged metadata document is ever built per node.
+# controlled fields live in 'cmeta', user-defined ("custom:") fields in 'ucmeta'.
+AQL_meta_value_template = ("FIRST(node.{meta}[* FILTER CURRENT.ok == @field{idx} "
+                           "AND CURRENT.k == 'value' LIMIT 1 RETURN CURRENT.v])")
+
+# Evaluates one or more groups of filters in a single pass over the sample nodes,
+# used for filter groups (batch_filter_samples) and when the filters reference
+# "custom:" fields. The same pass collects which of the requested custom fields are
+# present in the sample set, so custom field validation needs no separate query.
+# '{groups}' is replaced by one boolean match expression per filter group.
+# When the samples are split into several queries, a custom field missing from one
+# chunk may be present in another, so '@require_custom_fields' is false and the groups
+# are always returned.
+AQL_grouped_query_template = f"""
+let sample_rows = (for sample_id in @sample_ids
+    let version_id = DOCUMENT(
+        {SAMPLE_SAMPLE_COLLECTION}, sample_id.id
+    ).vers[sample_id.version - 1]
+    let nodes = (for node in {SAMPLE_NODE_COLLECTION}
+        FILTER node.uuidver == version_id and node.id == sample_id.id
+        RETURN {{"cmeta": node.cmeta, "ucmeta": node.ucmeta}}
+    )
     RETURN {{
-        'id': doc.id,
-        'version_id': doc.vers[sample_id.version - 1],
-        'version': sample_id.version
+        "id": sample_id.id,
+        "version": sample_id.version,
+        "custom_fields": (for node in nodes
+            for meta in node.ucmeta
+                FILTER meta.ok IN @custom_fields
+                RETURN DISTINCT meta.ok
+        ),
+        "matches": [{{groups}}]
     }}
 )
+let missing_custom_fields = MINUS(@custom_fields, FLATTEN(sample_rows[*].custom_fields))
+RETURN {{
+    "missing_custom_fields": missing_custom_fields,
+    "groups": @require_custom_fields AND LENGTH(missing_custom_fields) > 0 ? [] : (
+        for group_idx in RANGE(0, @num_groups - 1)
+            RETURN (for row in sample_rows
+                FILTER row.matches[group_idx]
+                RETURN {{"id": row.id, "version": row.version}}
+            )
+    )
+}}
+"""
 
-let node_metas = (for version_id in version_ids
-    for node in {SAMPLE_NODE_COLLECTION}
-        FILTER node.id == version_id.id and node.uuidver == version_id.version_id
-        LIMIT @num_sample_ids
-        let meta_objs_values = (for meta in APPEND(node.cmeta, node.ucmeta)
-            RETURN {{ [ meta.ok ]: {{ [ meta.k ]: meta.v }} }}
-        )
-        RETURN {{
-            "id": node.id,
-            "version": node.ver,
-            "meta": APPLY("MERGE_RECURSIVE", meta_objs_values)
-        }}
-)
-for node in node_metas
-    FILTER """
+AQL_stream_return = """
+        RETURN DISTINCT {"id": node.id, "version": node.ver}
+        """
+
+# the return clauses of the "count" and "exists" return modes, so only the number of
+# matching samples, or whether there is one, is sent back instead of the samples
+AQL_count_return = """
+        COLLECT id = node.id, version = node.ver
+        COLLECT WITH COUNT INTO count
+        RETURN count
+        """
+
+AQL_exists_return = """
+        LIMIT 1
+        RETURN true
+        """
+
+AQL_stream_returns = {
+    'ids': AQL_stream_return,
+    'count': AQL_count_return,
+    'exists': AQL_exists_return
+}
+
+# bind parameter prefix of the filter of a filter_samples call, the prefix of group 0
+FILTER_PREFIX = "0_"
+
+AQL_group_match_template = """LENGTH((for node in nodes
+            FILTER {filters}
+            LIMIT 1
+            RETURN 1
+        )) > 0"""
+
+
+def _expand_matches(samples, matches):
+    '''the samples whose (id, version) is in 'matches', in input order with duplicates'''
+    addresses = ((sample.get('id'), sample.get('version')) for sample in samples)
+    with span('filter.expand'):
+        return [{'id': id_, 'version': version} for id_, version in addresses
+                if (id_, version) in matches]
+
+
+def _filter_results(samples, matches, return_mode):
+    '''the filter_samples results for the set of matching (id, version) addresses'''
+    if return_mode == 'count':
+        return {'count': len(matches)}
+    if return_mode == 'exists':
+        return {'exists': int(bool(matches))}
+    return {'sample_ids': _expand_matches(samples, matches)}
+
+
+def _custom_fields(parsed_filters):
+    '''names of the uncontrolled fields in parsed_filters, without the "custom:" prefix'''
+    return sorted({pf['field'][len('custom:'):] for pf in parsed_filters
+                   if pf['field'].startswith('custom:')})
 
 
 class SampleFilterer():
     '''
     '''
-    def __init__(cls, re_admin_token, re_api_url, sample_service):
+    def __init__(cls, re_admin_token, re_api_url, sample_service, static_metadata=None,
+                 meta_manager=None, query_cache_size=256, local_engine=None,
+                 chunk_runner=None):
         cls.re_api_url = re_api_url
         cls.sample_service = sample_service
         cls.re_admin_token = re_admin_token
+        cls.static_metadata = static_metadata or StaticMetadataCache(sample_service)
+        cls.meta_manager = meta_manager or MetadataManager(re_api_url)
+        # compiled AQL text keyed by the shape of the filters it was compiled for, the
+        # field names and values of the filters are always passed as bind parameters.
+        cls.query_cache = LRUCache(maxsize=query_cache_size)
+        # optional utils.local_filter.LocalFilterEngine for unpaged filters of small sets
+        cls.local_engine = local_engine
+        # runs the custom field validation alongside the static metadata lookups
+        cls._executor = ProcessLocalExecutor(max_workers=4)
+        # queries over many samples are split into chunks run concurrently
+        cls.chunk_runner = chunk_runner or ChunkedRunner()
 
     def filter_samples(self, params, user_token):
-        samples, filter_conditions = parse_input(params)
-        # AQL = Arango Query Languages
-        AQL_query = AQL_query_template
-        query_params = {"sample_ids": samples, 'num_sample_ids': len(samples)}
-        num_filters = len(filter_conditions)
-        parsed_filters = [{
-            'field': parse_field(fc.get('metadata_field'), idx),
-            'values': parse_values(fc.get('metadata_values'), idx),
-            'comp_op': parse_comparison_operator(fc.get('comparison_operator'), idx),
-            'logic_op': parse_logical_operator(fc.get('logical_operator'), idx, num_filters)
-        } for idx, fc in enumerate(filter_conditions)]
+        '''
+        Returns the samples matching the filter conditions. If 'limit' is given the
+        results are paged, the response carries a 'cursor' that returns the next page
+        when passed back as the only parameter, and is null on the last page.
+        The "count" and "exists" return modes return the number of distinct matching
+        samples or whether any sample matches instead of the samples.
+        '''
+        # use the user token if an admin token is not provided
+        run_token = self.re_admin_token if self.re_admin_token else user_token
+        if params.get('cursor'):
+            return self._next_page(params['cursor'], run_token)
+        samples, limit, return_mode, tree, query_params, custom_fields = \
+            self._prepare_filter(params, run_token)
+        if limit is None:
+            local_matches = self._filter_local(samples, [tree], custom_fields, run_token)
+            if local_matches is not None:
+                return _filter_results(samples, local_matches[0], return_mode)
+        if limit is not None:
+            results = execute_query(
+                self._stream_query(tree),
+                self.re_api_url,
+                run_token,
+                query_params,
+                batch_size=limit
+            )
+            return self._page(results)
+        if return_mode != 'ids':
+            return {return_mode: self._run_stream_query(tree, query_params, run_token,
+                                                        return_mode)}
+        if not custom_fields:
+            matches = self._run_stream_query(tree, query_params, run_token)
+            return _filter_results(samples, matches, return_mode)
 
+        groups = self._run_grouped_query([tree], query_params, custom_fields, run_token)
+        return _filter_results(samples, groups[0], return_mode)
+
+    def batch_filter_samples(self, params, user_token):
+        '''
+        Evaluates several groups of filter conditions against the same samples in one
+        query, returns the matching samples and their count for every group.
+        '''
         # use the user token if an admin token is not provided
         run_token = self.re_admin_token if self.re_admin_token else user_token
-        formatted_filters = self._format_and_validate_filters(parsed_filters, samples, run_token)
-        for idx, formatted_filter in enumerate(formatted_filters):
-            query_constraint, filter_params = self._construct_filter(
-                formatted_filter, idx
+        samples, group_trees, query_params, custom_fields = self._prepare_batch(params,
+                                                                                run_token)
+        groups = self._filter_local(samples, group_trees, custom_fields, run_token)
+        if groups is None:
+            groups = self._run_grouped_query(group_trees, query_params, custom_fields,
+                                             run_token)
+        return self._batch_results([_expand_matches(samples, matches) for matches in groups])
+
+    def _prepare_filter(self, params, token):
+        '''
+        Parses and validates the filter_samples parameters, returns the samples, the page
+        size, the return mode, the filter expression tree, the query bind parameters and
+        the custom fields.
+        '''
+        samples, filter_conditions = parse_input(params)
+        limit = parse_limit(params.get('limit'))
+        return_mode = parse_return_mode(params.get('return_mode'), limit)
+        # the queries only see every sample once, the results are expanded to the input
+        query_params = {"sample_ids": unique_sample_ids(samples)}
+        parsed_filters = self._parse_filters(filter_conditions)
+
+        custom_fields = _custom_fields(parsed_filters)
+        # custom fields are validated by the filter query itself, unless the results
+        # are paged or counted and the query has to return one result per sample.
+        formatted_filters = self._format_and_validate_filters(
+            parsed_filters, query_params['sample_ids'], token,
+            validate_custom=limit is not None or return_mode != 'ids'
+        )
+        # the bind parameters are named like those of the first group of a grouped query,
+        # so the same parameters serve the stream query and the grouped query
+        tree, filter_params = self._construct_filters(formatted_filters, prefix=FILTER_PREFIX)
+        query_params.update(filter_params)
+        return samples, limit, return_mode, tree, query_params, custom_fields
+
+    def _prepare_batch(self, params, token):
+        '''
+        Parses and validates the batch_filter_samples parameters, returns the samples, the
+        filter expression tree of every group, the query bind parameters and the custom
+        fields of all groups.
+        '''
+        samples, filter_groups = parse_batch_input(params)
+        parsed_groups = [self._parse_filters(filter_conditions)
+                         for filter_conditions in filter_groups]
+        # fetch the static metadata of every group at once, the groups then hit the cache
+        with span('filter.static_metadata'):
+            self.static_metadata.get_static_metadata({
+                pf['field'] for parsed_filters in parsed_groups for pf in parsed_filters
+                if not pf['field'].startswith('custom:')
+            })
+        # the queries only see every sample once, the results are expanded to the input
+        query_params = {"sample_ids": unique_sample_ids(samples)}
+        group_trees = []
+        custom_fields = set()
+        for group_idx, parsed_filters in enumerate(parsed_groups):
+            custom_fields.update(_custom_fields(parsed_filters))
+            formatted_filters = self._format_and_validate_filters(
+                parsed_filters, samples, token, validate_custom=False
             )
-            logic_op = formatted_filter.get('logic_op')
+            tree, filter_params = self._construct_filters(formatted_filters,
+                                                          prefix=f"{group_idx}_")
             query_params.update(filter_params)
-            if idx + 1 < num_filters:
-                AQL_query += query_constraint + f" {logic_op} "
-            else:
-                # the final logical operator statement is ignored
-                AQL_query += query_constraint
+            group_trees.append(tree)
+        return samples, group_trees, query_params, sorted(custom_fields)
 
-        AQL_query += """
-        RETURN {"id": node.id, "version": node.version}
-        """
-        results = execute_query(
-            AQL_query,
-            self.re_api_url,
-            run_token,
-            query_params
+    def _batch_results(self, groups):
+        return {'results': [{'sample_ids': sample_ids, 'count': len(sample_ids)}
+                            for sample_ids in groups]}
+
+    def _parse_filters(self, filter_conditions):
+        num_filters = len(filter_conditions)
+        with span('filter.parse'):
+            return [{
+                'field': parse_field(fc.get('metadata_field'), idx),
+                'values': parse_values(fc.get('metadata_values'), idx),
+                'comp_op': parse_comparison_operator(fc.get('comparison_operator'), idx),
+                'logic_op': parse_logical_operator(fc.get('logical_operator'), idx, num_filters),
+                'paren_position': parse_paren_position(fc.get('paren_position'), idx)
+            } for idx, fc in enumerate(filter_conditions)]
+
+    def _filter_local(self, samples, group_trees, custom_fields, token):
+        '''
+        Evaluates the filter expression trees with the local engine, returns the set of
+        matching (id, version) addresses for each of them, or None if the Relation Engine
+        has to evaluate them.
+        '''
+        if self.local_engine is None:
+            return None
+        with span('filter.local_load'):
+            table = self.local_engine.get_table(samples, token)
+        if table is None:
+            return None
+        missing_fields = [f for f in custom_fields if f not in table.custom_fields]
+        if missing_fields:
+            message = "Unable to resolve uncontrolled custom metadata fields: " + \
+                ", ".join(['custom:' + f for f in missing_fields])
+            raise ValueError(message)
+        try:
+            with span('filter.local_eval'):
+                return [table.matching_samples(tree) for tree in group_trees]
+        except UnsupportedFilter:
+            return None
+
+    def _run_grouped_query(self, group_trees, query_params, custom_fields, token):
+        '''
+        Runs AQL_grouped_query_template for the given filter expression trees, returns the
+        set of matching (id, version) addresses for each of them.
+        '''
+        query = self._grouped_query(group_trees, query_params, custom_fields)
+        chunks = self.chunk_runner.split(query_params['sample_ids'])
+        return self._grouped_results(self.chunk_runner.map(
+            lambda chunk: execute_query(query, self.re_api_url, token,
+                                        self._chunk_params(query_params, chunk, chunks)),
+            chunks
+        ))
+
+    def _run_stream_query(self, tree, query_params, token, return_mode='ids'):
+        '''
+        Runs the stream query for the given filter expression tree unpaged, returns the
+        set of matching (id, version) addresses, their number for the "count" return mode
+        or whether there are any for the "exists" return mode.
+        '''
+        query = self._stream_query(tree, return_mode)
+        chunks = self.chunk_runner.split(query_params['sample_ids'])
+        return self._stream_results(self.chunk_runner.map(
+            lambda chunk: execute_query(query, self.re_api_url, token,
+                                        self._chunk_params(query_params, chunk, chunks)),
+            chunks
+        ), return_mode)
+
+    def _chunk_params(self, query_params, chunk, chunks):
+        '''the bind parameters of the query over one of the chunks of the samples'''
+        chunk_params = dict(query_params, sample_ids=chunk)
+        if 'custom_fields' in query_params:
+            chunk_params['require_custom_fields'] = len(chunks) == 1
+        return chunk_params
+
+    def _stream_results(self, chunk_results, return_mode='ids'):
+        '''merges the stream query results of the chunks, which never share a sample'''
+        with span('filter.merge'):
+            if return_mode == 'count':
+                return sum(sum(results['results']) for results in chunk_results)
+            if return_mode == 'exists':
+                return int(any(results['results'] for results in chunk_results))
+            return {(sample_id['id'], sample_id['version'])
+                    for results in chunk_results for sample_id in results['results']}
+
+    def _stream_query(self, tree, return_mode='ids'):
+        '''
+        the AQL returning every sample with a node matching 'tree' once, or their number
+        or whether there is one for the "count" and "exists" return modes
+        '''
+        return self._cached_query(
+            ('stream', return_mode, filter_tree_shape(tree)),
+            lambda: (AQL_query_template + self._compile_filter_tree(tree, FILTER_PREFIX) +
+                     AQL_stream_returns[return_mode])
         )
-        return {'sample_ids': results['results']}
+
+    def _grouped_query(self, group_trees, query_params, custom_fields):
+        '''
+        Returns the AQL_grouped_query_template query for the given filter expression trees
+        and adds its remaining bind parameters to query_params.
+        '''
+        def build_query():
+            groups = ", ".join([
+                AQL_group_match_template.format(
+                    filters=self._compile_filter_tree(tree, prefix=f"{group_idx}_")
+                ) for group_idx, tree in enumerate(group_trees)
+            ])
+            return AQL_grouped_query_template.replace('{groups}', groups)
+
+        query_params.update({
+            'custom_fields': custom_fields,
+            'num_groups': len(group_trees)
+        })
+        shape = ('grouped',) + tuple(filter_tree_shape(tree) for tree in group_trees)
+        return self._cached_query(shape, build_query)
+
+    def _grouped_results(self, chunk_results):
+        '''the matching (id, version) addresses of every group in the grouped query results'''
+        with span('filter.merge'):
+            chunk_results = [results['results'][0] for results in chunk_results]
+            # a custom field is missing if it is missing from every chunk
+            missing_fields = [f for f in chunk_results[0]['missing_custom_fields']
+                              if all(f in results['missing_custom_fields']
+                                     for results in chunk_results[1:])]
+            if missing_fields:
+                message = "Unable to resolve uncontrolled custom metadata fields: " + \
+                    ", ".join(['custom:' + f for f in missing_fields])
+                raise ValueError(message)
+            return [{(sample_id['id'], sample_id['version'])
+                     for results in chunk_results for sample_id in results['groups'][group_idx]}
+                    for group_idx in range(len(chunk_results[0]['groups']))]
+
+    def _next_page(self, cursor, token):
+        return self._page(fetch_cursor(cursor, self.re_api_url, token))
+
+    def _page(self, results):
+        return {
+            'sample_ids': results['results'],
+            'cursor': results.get('cursor_id') if results.get('has_more') else None
+        }
+
+    def _cached_query(self, shape, build_query):
+        '''returns the AQL text cached for 'shape', building and caching it on a miss'''
+        with span('filter.compile'):
+            AQL_query = self.query_cache.get(shape)
+            if AQL_query is None:
+                AQL_query = build_query()
+                self.query_cache.set(shape, AQL_query)
+            return AQL_query
+
+    def _construct_filters(self, formatted_filters, prefix=''):
+        '''
+        Parses the formatted filters into a simplified filter expression tree, returns
+        the tree and the bind parameters of its conditions.
+        prefix - prepended to the bind parameter indexes to keep them unique when
+            several filter expressions are part of the same query.
+        '''
+        tree = simplify_filter_tree(build_filter_tree(formatted_filters))
+        query_params = {}
+        for idx, formatted_filter in enumerate(filter_tree_leaves(tree)):
+            _, filter_params = self._construct_filter(formatted_filter, f"{prefix}{idx}")
+            query_params.update(filter_params)
+        return tree, query_params
+
+    def _compile_filter_tree(self, tree, prefix='', leaf_idx=None):
+        '''
+        Compiles a filter expression tree into an AQL filter expression, the conditions
+        refer to the bind parameters returned by _construct_filters for the same prefix.
+        '''
+        if leaf_idx is None:
+            leaf_idx = itertools.count()
+        op = tree.get('op')
+        if op == 'TRUE':
+            return "true"
+        if op == 'FALSE':
+            return "false"
+        if op is None:
+            query_constraint, _ = self._construct_filter(tree, f"{prefix}{next(leaf_idx)}")
+            return query_constraint
+        terms = [self._compile_filter_tree(term, prefix, leaf_idx) for term in tree['terms']]
+        return "(" + f" {op} ".join(terms) + ")"
 
     def _construct_filter(self, formatted_filter, idx):
         '''
@@ -96,52 +464,47 @@ class SampleFilterer():
             'field', 'comparison_operator', 'value', 'logical_operator'
         '''
         field = formatted_filter.get('field')
+        meta = 'cmeta'
         if field.startswith('custom:'):
             # parse out custom: prefix from uncontrolled fields
             field = field[len("custom:"):]
+            meta = 'ucmeta'
         comp_op = formatted_filter.get('comp_op')
         values = formatted_filter.get('values')
-        AQL_query = f"node.meta['{field}'].value {comp_op} @value{idx}"
+        meta_value = AQL_meta_value_template.format(meta=meta, idx=idx)
+        AQL_query = f"{meta_value} {comp_op} @value{idx}"
         # if there is one value in the list of values, flatten to just the value.
         if len(values) == 1 and comp_op not in ["IN", "NOT IN"]:
             values = values[0]
         filter_params = {
+            f"field{idx}": field,
             f"value{idx}": values
         }
         return AQL_query, filter_params
 
-    def _format_and_validate_filters(self, parsed_filters, samples, token):
+    def _format_and_validate_filters(self, parsed_filters, samples, token,
+                                     validate_custom=True):
         '''
         The SampleService will error here if the metadata field
         is not found as an accepted controlled metadata field
-        or does not exist in any sample as an uncontrolled field
+        or does not exist in any sample as an uncontrolled field.
+        validate_custom - set to False when the caller checks the uncontrolled fields itself
         '''
         controlled_filters, custom_filters = partition_controlled_parsed_filters(parsed_filters)
-        try:
-            static_metadata = self.sample_service.get_metadata_key_static_metadata({
-                'prefix': 0,  # expects these not to be prefix validated.
-                'keys': set([pf['field'] for pf in controlled_filters])
-            })['static_metadata']
-        except Exception as error:
-            err_message = error.message
-            err_keys = err_message.split(':')[-1]
-            try:
-                static_metadata = self.sample_service.get_metadata_key_static_metadata({
-                    'prefix': 1,  # assume the ones that failed are prefix validated
-                    'keys': set([pf['field'] for pf in controlled_filters])
-                })['static_metadata']
-            except Exception as error:
-                err_message = error.message
-                prefix_err_keys = err_message.split(':')[-1]
-                key_set = set([k.strip() for k in err_keys.strip().split(',')]).union(
-                    set([k.strip() for k in prefix_err_keys.strip().split(',')]))
-                message = "Unable to resolve metadata fields or prefix metadata fields: " + \
-                          ", ".join(list(key_set))
-                raise ValueError(message)
+        # the uncontrolled fields are checked while the static metadata is fetched
+        custom_check = self._executor.submit(
+            bind(self._validate_custom_fields), custom_filters, samples, token
+        ) if validate_custom and len(custom_filters) else None
+        # exact keys are tried first, the ones that fail are assumed to be prefix validated
+        with span('filter.static_metadata'):
+            static_metadata = self.static_metadata.get_static_metadata(
+                {pf['field'] for pf in controlled_filters}
+            )
 
         # check if there are any bad uncontrolled fields
-        if len(custom_filters):
-            self._validate_custom_fields(custom_filters, samples, token)
+        if custom_check is not None:
+            with span('filter.custom_fields_wait'):
+                custom_check.result()
 
         formatted_filters = []
         for idx, parsed_filter in enumerate(parsed_filters):
@@ -158,10 +521,94 @@ class SampleFilterer():
     def _validate_custom_fields(self, custom_filters, samples, token):
         # get all samples and search for each field in sampleset
         # if any uncontrolled fields are completely missing from set, throw an error
-        fields = MetadataManager(self.re_api_url).get_sampleset_meta(samples, token)
+        with span('filter.custom_fields'):
+            fields = self.meta_manager.get_sampleset_meta(samples, token)
         uc_fields = {f['field'] for f in custom_filters}
         missing_fields = uc_fields.difference(set(fields))
         if len(missing_fields):
             message = "Unable to resolve uncontrolled custom metadata fields: " + \
                 ", ".join(list(missing_fields))
             raise ValueError(message)
+
+
+class AsyncSampleFilterer(SampleFilterer):
+    '''
+    asyncio counterpart of SampleFilterer, used by the ASGI entry point. Relation Engine
+    queries are awaited, while the blocking SampleService lookups and local engine loads
+    run in the default executor of the event loop.
+    '''
+    @classmethod
+    def from_filterer(cls, sample_filter):
+        '''an AsyncSampleFilterer sharing the configuration and caches of sample_filter'''
+        async_filter = cls.__new__(cls)
+        async_filter.__dict__.update(sample_filter.__dict__)
+        return async_filter
+
+    async def filter_samples(self, params, user_token):
+        # use the user token if an admin token is not provided
+        run_token = self.re_admin_token if self.re_admin_token else user_token
+        if params.get('cursor'):
+            return await self._next_page(params['cursor'], run_token)
+        samples, limit, return_mode, tree, query_params, custom_fields = await run_blocking(
+            self._prepare_filter, params, run_token
+        )
+        if limit is None:
+            local_matches = await run_blocking(self._filter_local, samples, [tree],
+                                               custom_fields, run_token)
+            if local_matches is not None:
+                return _filter_results(samples, local_matches[0], return_mode)
+        if limit is not None:
+            results = await async_re_utils.execute_query(
+                self._stream_query(tree),
+                self.re_api_url,
+                run_token,
+                query_params,
+                batch_size=limit
+            )
+            return self._page(results)
+        if return_mode != 'ids':
+            return {return_mode: await self._run_stream_query(tree, query_params, run_token,
+                                                              return_mode)}
+        if not custom_fields:
+            matches = await self._run_stream_query(tree, query_params, run_token)
+            return _filter_results(samples, matches, return_mode)
+
+        groups = await self._run_grouped_query([tree], query_params, custom_fields,
+                                               run_token)
+        return _filter_results(samples, groups[0], return_mode)
+
+    async def batch_filter_samples(self, params, user_token):
+        # use the user token if an admin token is not provided
+        run_token = self.re_admin_token if self.re_admin_token else user_token
+        samples, group_trees, query_params, custom_fields = await run_blocking(
+            self._prepare_batch, params, run_token
+        )
+        groups = await run_blocking(self._filter_local, samples, group_trees,
+                                    custom_fields, run_token)
+        if groups is None:
+            groups = await self._run_grouped_query(group_trees, query_params, custom_fields,
+                                                   run_token)
+        return self._batch_results([_expand_matches(samples, matches) for matches in groups])
+
+    async def _run_grouped_query(self, group_trees, query_params, custom_fields, token):
+        query = self._grouped_query(group_trees, query_params, custom_fields)
+        chunks = self.chunk_runner.split(query_params['sample_ids'])
+        return self._grouped_results(await self.chunk_runner.map_async(
+            lambda chunk: async_re_utils.execute_query(
+                query, self.re_api_url, token, self._chunk_params(query_params, chunk, chunks)
+            ),
+            chunks
+        ))
+
+    async def _run_stream_query(self, tree, query_params, token, return_mode='ids'):
+        query = self._stream_query(tree, return_mode)
+        chunks = self.chunk_runner.split(query_params['sample_ids'])
+        return self._stream_results(await self.chunk_runner.map_async(
+            lambda chunk: async_re_utils.execute_query(
+                query, self.re_api_url, token, self._chunk_params(query_params, chunk, chunks)
+            ),
+            chunks
+        ), return_mode)
+
+    async def _next_page(self, cursor, token):
+        return self._page(await async_re_utils.fetch_cursor(cursor, self.re_api_url, token))
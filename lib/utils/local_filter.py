@@ -0,0 +1,411 @@
+# in-process evaluation of filter expressions over cached sample metadata
+import itertools
+import json
+import os
+import sys
+import threading
+import weakref
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+from utils.cache import LRUCache
+from utils.re_utils import iter_query_results
+from utils.snapshot import SnapshotFile
+
+SAMPLE_NODE_COLLECTION = "samples_nodes"
+SAMPLE_SAMPLE_COLLECTION = "samples_sample"
+
+# name of the snapshot file the loaded sample metadata is shared through
+SAMPLE_SNAPSHOT_FILE = "sample_metadata.snapshot"
+
+# Loads the 'value' entries of the metadata of every node of the requested sample
+# versions, the filter queries only ever read the 'value' entry of a metadata key.
+# 'custom_fields' lists every uncontrolled key of a node, regardless of its entries.
+AQL_load_template = f"""
+for sample_id in @sample_ids
+    let version_id = DOCUMENT(
+        {SAMPLE_SAMPLE_COLLECTION}, sample_id.id
+    ).vers[sample_id.version - 1]
+    RETURN {{
+        "id": sample_id.id,
+        "version": sample_id.version,
+        "found": version_id != null,
+        "nodes": (for node in {SAMPLE_NODE_COLLECTION}
+            FILTER node.uuidver == version_id and node.id == sample_id.id
+            RETURN {{
+                "cmeta": node.cmeta[* FILTER CURRENT.k == 'value'
+                    RETURN [CURRENT.ok, CURRENT.v]],
+                "ucmeta": node.ucmeta[* FILTER CURRENT.k == 'value'
+                    RETURN [CURRENT.ok, CURRENT.v]],
+                "custom_fields": UNIQUE(node.ucmeta[*].ok)
+            }}
+        )
+    }}
+"""
+
+# ArangoDB orders values of different types null < bool < number < string < array < object
+_NULL, _BOOL, _NUMBER, _STRING, _ARRAY, _OBJECT = range(6)
+_RANGE_OPERATORS = {"<", ">", "<=", ">="}
+
+
+class UnsupportedFilter(Exception):
+    '''raised for filter expressions the local engine can not evaluate exactly like AQL'''
+
+
+def _type_rank(value):
+    if value is None:
+        return _NULL
+    if isinstance(value, bool):
+        return _BOOL
+    if isinstance(value, (int, float)):
+        return _NUMBER
+    if isinstance(value, str):
+        return _STRING
+    if isinstance(value, list):
+        return _ARRAY
+    return _OBJECT
+
+
+def _equality_key(value):
+    '''hashable key under which two values are equal exactly when they are == in AQL'''
+    rank = _type_rank(value)
+    if rank == _NUMBER:
+        return (rank, float(value))
+    if rank >= _ARRAY:
+        return (rank, json.dumps(value, sort_keys=True))
+    return (rank, value)
+
+
+def bitset(positions, size):
+    '''packs row positions into an int with bit i set for every row i'''
+    packed = bytearray((size + 7) // 8)
+    for pos in positions:
+        packed[pos >> 3] |= 1 << (pos & 7)
+    return int.from_bytes(packed, 'little')
+
+
+def bitset_positions(bits):
+    '''the row positions set in a bitset, in ascending order'''
+    positions = []
+    packed = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+    for byte_idx, byte in enumerate(packed):
+        if byte:
+            base = byte_idx << 3
+            positions.extend(base + bit for bit in range(8) if byte >> bit & 1)
+    return positions
+
+
+class IndexBudget:
+    '''
+    Accounts for the memory of the column indexes of all SampleTables, and drops the
+    least recently used indexes once they take more than 'max_bytes'. Dropped indexes
+    are rebuilt on their next use.
+    '''
+    def __init__(cls, max_bytes=256 * 1024 * 1024):
+        cls.max_bytes = max_bytes
+        cls.total_bytes = 0
+        cls.evictions = 0
+        cls._entries = OrderedDict()
+        # reentrant, columns may be garbage collected and released while it is held
+        cls._lock = threading.RLock()
+        cls._column_ids = itertools.count()
+
+    def register(self, column, kind, nbytes):
+        '''accounts for a newly built index, evicting older indexes if needed'''
+        evicted = []
+        with self._lock:
+            if column.budget_id is None:
+                column.budget_id = next(self._column_ids)
+                # release the indexes of columns whose table was dropped from the cache
+                weakref.finalize(column, self._release, column.budget_id)
+            key = (column.budget_id, kind)
+            self._pop(key)
+            self._entries[key] = (weakref.ref(column), nbytes)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, (old_column, _) = next(iter(self._entries.items()))
+                self._pop(old_key)
+                self.evictions += 1
+                evicted.append((old_column(), old_key[1]))
+        for old_column, old_kind in evicted:
+            if old_column is not None:
+                old_column.drop_index(old_kind)
+
+    def touch(self, column, kind):
+        with self._lock:
+            key = (column.budget_id, kind)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'index_bytes': self.total_bytes,
+                'max_index_bytes': self.max_bytes,
+                'indexes': len(self._entries),
+                'index_evictions': self.evictions
+            }
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def _release(self, budget_id):
+        with self._lock:
+            for kind in ('hash', 'sorted'):
+                self._pop((budget_id, kind))
+
+
+class MetadataColumn:
+    '''
+    The values of one metadata key across the node rows of a SampleTable, None where
+    the key is missing. Numeric values are also kept in a typed array alongside the
+    rows they belong to, and every row is classified by its AQL type order.
+    Equality filters use a hash index from value to rows, range filters binary search
+    the numeric values in sorted order. Both are built on first use and accounted for
+    in 'budget', which may drop them again.
+    '''
+    def __init__(cls, values, budget=None):
+        cls.values = values
+        cls.budget = budget
+        cls.budget_id = None
+        type_rows = [[] for _ in range(6)]
+        cls.number_rows = array('l')
+        cls.numbers = array('d')
+        for row, value in enumerate(values):
+            rank = _type_rank(value)
+            type_rows[rank].append(row)
+            if rank == _NUMBER:
+                cls.number_rows.append(row)
+                cls.numbers.append(float(value))
+        type_masks = [bitset(rows, len(values)) for rows in type_rows]
+        # values of lower ranked types are less than any number, higher ranked greater
+        cls.below_numbers = type_masks[_NULL] | type_masks[_BOOL]
+        cls.above_numbers = type_masks[_STRING] | type_masks[_ARRAY] | type_masks[_OBJECT]
+        cls._hash_index = None
+        cls._sorted_index = None
+
+    def equal_rows(self, values):
+        '''bitset of the rows equal to any of 'values' '''
+        index = self._get_hash_index()
+        keys = {_equality_key(value) for value in values}
+        return bitset(itertools.chain.from_iterable(index.get(key, ()) for key in keys),
+                      len(self.values))
+
+    def range_rows(self, comp_op, value):
+        '''bitset of the rows for which "row comp_op value" holds in AQL'''
+        if _type_rank(value) != _NUMBER:
+            # strings are ordered by ArangoDB's collation, which is not reproduced here
+            raise UnsupportedFilter(f"range comparison against non-numeric value {value!r}")
+        value = float(value)
+        numbers, rows = self._get_sorted_index()
+        if comp_op == "<":
+            matches = rows[:bisect_left(numbers, value)]
+        elif comp_op == "<=":
+            matches = rows[:bisect_right(numbers, value)]
+        elif comp_op == ">":
+            matches = rows[bisect_right(numbers, value):]
+        else:
+            matches = rows[bisect_left(numbers, value):]
+        bits = bitset(matches, len(self.values))
+        return bits | (self.below_numbers if comp_op in ("<", "<=") else self.above_numbers)
+
+    def drop_index(self, kind):
+        if kind == 'hash':
+            self._hash_index = None
+        else:
+            self._sorted_index = None
+
+    def _get_hash_index(self):
+        index = self._hash_index
+        if index is not None:
+            self._touch('hash')
+            return index
+        rows = {}
+        for row, value in enumerate(self.values):
+            rows.setdefault(_equality_key(value), []).append(row)
+        index = {key: array('l', key_rows) for key, key_rows in rows.items()}
+        self._hash_index = index
+        self._account('hash', sys.getsizeof(index) + sum(
+            sys.getsizeof(key) + sys.getsizeof(key_rows) for key, key_rows in index.items()
+        ))
+        return index
+
+    def _get_sorted_index(self):
+        index = self._sorted_index
+        if index is not None:
+            self._touch('sorted')
+            return index
+        order = sorted(range(len(self.numbers)), key=self.numbers.__getitem__)
+        index = (array('d', [self.numbers[i] for i in order]),
+                 array('l', [self.number_rows[i] for i in order]))
+        self._sorted_index = index
+        self._account('sorted', sys.getsizeof(index[0]) + sys.getsizeof(index[1]))
+        return index
+
+    def _account(self, kind, nbytes):
+        if self.budget is not None:
+            self.budget.register(self, kind, nbytes)
+
+    def _touch(self, kind):
+        if self.budget is not None:
+            self.budget.touch(self, kind)
+
+
+class SampleTable:
+    '''
+    Columnar copy of the filterable metadata of a set of sample versions. Every node of
+    every sample is a row, a sample matches a filter expression if any of its rows does,
+    just like the AQL filter queries, which evaluate the filters per node.
+    '''
+    def __init__(cls, samples, budget=None):
+        '''
+        samples - results of AQL_load_template
+        budget - IndexBudget accounting for the memory of the column indexes
+        '''
+        cls.addresses = {}
+        cls.row_samples = []
+        cls.custom_fields = set()
+        cls.complete = True
+        row_values = {'cmeta': [], 'ucmeta': []}
+        for sample in samples:
+            sample_idx = cls.addresses.setdefault((sample['id'], sample['version']),
+                                                  len(cls.addresses))
+            cls.complete = cls.complete and sample['found']
+            for node in sample['nodes']:
+                cls.row_samples.append(sample_idx)
+                cls.custom_fields.update(node['custom_fields'])
+                for meta in ('cmeta', 'ucmeta'):
+                    values = {}
+                    for key, value in node[meta] or []:
+                        # the filter queries read the first 'value' entry of a key
+                        values.setdefault(key, value)
+                    row_values[meta].append(values)
+        cls.sample_addresses = list(cls.addresses)
+        cls.num_rows = len(cls.row_samples)
+        cls.all_rows = (1 << cls.num_rows) - 1
+        cls.columns = {}
+        for meta, rows in row_values.items():
+            for key in {key for values in rows for key in values}:
+                cls.columns[(meta, key)] = MetadataColumn([values.get(key) for values in rows],
+                                                          budget)
+        # a missing key reads as null on every row
+        cls.null_column = MetadataColumn([None] * cls.num_rows)
+
+    def column(self, field):
+        '''the column of a filter field, None if no node has the field'''
+        if field.startswith('custom:'):
+            return self.columns.get(('ucmeta', field[len('custom:'):]))
+        return self.columns.get(('cmeta', field))
+
+    def evaluate(self, tree):
+        '''bitset of the rows matching a simplified filter expression tree'''
+        op = tree.get('op')
+        if op == 'TRUE':
+            return self.all_rows
+        if op == 'FALSE':
+            return 0
+        if op == 'AND':
+            bits = self.all_rows
+            for term in tree['terms']:
+                bits &= self.evaluate(term)
+            return bits
+        if op == 'OR':
+            bits = 0
+            for term in tree['terms']:
+                bits |= self.evaluate(term)
+            return bits
+        return self._evaluate_leaf(tree)
+
+    def matching_samples(self, tree):
+        '''the set of (id, version) addresses with at least one row matching 'tree' '''
+        return {self.sample_addresses[self.row_samples[row]]
+                for row in bitset_positions(self.evaluate(tree))}
+
+    def _evaluate_leaf(self, leaf):
+        comp_op = leaf['comp_op']
+        values = leaf['values']
+        column = self.column(leaf['field']) or self.null_column
+        if comp_op in ("==", "IN"):
+            return column.equal_rows(values)
+        if comp_op in ("!=", "NOT IN"):
+            return self.all_rows & ~column.equal_rows(values)
+        if comp_op in _RANGE_OPERATORS and len(values) == 1:
+            return column.range_rows(comp_op, values[0])
+        raise UnsupportedFilter(f"comparison operator {comp_op} with values {values!r}")
+
+
+class LocalFilterEngine:
+    '''
+    Evaluates filter expressions in process over SampleTables of recently filtered sample
+    sets. A set of up to 'max_samples' distinct sample versions is loaded with a single
+    Relation Engine query the first time it is filtered, and kept for the following
+    filters on the same set, 'cache_size' sets holding at most 'cache_samples' sample
+    versions in all are kept. The column indexes of all sets share 'index_memory' bytes.
+    If 'snapshot_dir' is given the metadata of every loaded sample version is added to a
+    snapshot file there holding at most 'snapshot_samples' sample versions, shared by all
+    worker processes, and sample versions found in it are not loaded again. The snapshot
+    is shared by all callers, so it must only be used
+    when the Relation Engine is queried with the same token for all of them.
+    '''
+    def __init__(cls, re_api_url, max_samples=10000, cache_size=20, cache_samples=None,
+                 index_memory=256 * 1024 * 1024, snapshot_dir=None, snapshot_samples=1000000):
+        cls.re_api_url = re_api_url
+        cls.max_samples = max_samples
+        cls.tables = LRUCache(maxsize=cache_size, max_weight=cache_samples,
+                              weigh=lambda table: len(table.addresses))
+        cls.index_budget = IndexBudget(max_bytes=index_memory)
+        cls.snapshot = SnapshotFile(
+            os.path.join(snapshot_dir, SAMPLE_SNAPSHOT_FILE), max_entries=snapshot_samples
+        ) if snapshot_dir else None
+
+    def get_table(self, samples, token):
+        '''
+        Returns the SampleTable of the given sample addresses, loading it if the set is
+        small enough, or None if the set has to be filtered by the Relation Engine.
+        '''
+        addresses = {(sample['id'], sample['version']) for sample in samples}
+        if not addresses or len(addresses) > self.max_samples:
+            return None
+        # tables loaded with one token are not shared with callers of another
+        key = (token, frozenset(addresses))
+        table = self.tables.get(key)
+        if table is None:
+            table = SampleTable(self._load_samples(addresses, token),
+                                budget=self.index_budget)
+            # a version that does not exist yet may be saved later, so it is not cached
+            if table.complete:
+                self.tables.set(key, table)
+        return table
+
+    def _load_samples(self, addresses, token):
+        '''the AQL_load_template results of the given sample addresses'''
+        sample_ids = [{'id': id_, 'version': ver} for id_, ver in addresses]
+        samples = []
+        if self.snapshot is not None:
+            shared = self.snapshot.get_many([f"{id_}/{ver}" for id_, ver in addresses])
+            uncached = []
+            for sample_id in sample_ids:
+                nodes = shared.get(f"{sample_id['id']}/{sample_id['version']}")
+                if nodes is None:
+                    uncached.append(sample_id)
+                else:
+                    samples.append(dict(sample_id, found=True, nodes=nodes))
+            sample_ids = uncached
+        if sample_ids:
+            new_samples = {}
+            for sample in iter_query_results(AQL_load_template, self.re_api_url, token,
+                                             {"sample_ids": sample_ids}):
+                samples.append(sample)
+                if sample['found']:
+                    new_samples[f"{sample['id']}/{sample['version']}"] = sample['nodes']
+            if new_samples and self.snapshot is not None:
+                self.snapshot.update(new_samples)
+        return samples
+
+    def stats(self):
+        stats = self.tables.stats()
+        stats.update(self.index_budget.stats())
+        return stats
@@ -1,47 +1,180 @@
-from utils.re_utils import execute_query
+import asyncio
+import itertools
+import os
+
+import utils.async_re_utils as async_re_utils
+from utils.cache import LRUCache
+from utils.chunking import ChunkedRunner
+from utils.re_utils import iter_query_results
+from utils.snapshot import SnapshotFile
+from utils.timing import span
 
 SAMPLE_NODE_COLLECTION = "samples_nodes"
 SAMPLE_SAMPLE_COLLECTION = "samples_sample"
 
+# name of the snapshot file the field sets are shared through in the cache directory
+FIELD_SNAPSHOT_FILE = "sample_field_sets.snapshot"
+
+# returns the metadata fields of every requested sample version separately, so the
+# field sets can be cached per (sample id, version), which never changes.
 META_AQL_TEMPLATE = f"""
-        let version_ids = (for sample_id in @sample_ids
-            let doc = DOCUMENT({SAMPLE_SAMPLE_COLLECTION}, sample_id.id)
+        for sample_id in @sample_ids
+            let version_id = DOCUMENT(
+                {SAMPLE_SAMPLE_COLLECTION}, sample_id.id
+            ).vers[sample_id.version - 1]
+            let fields = (for node in {SAMPLE_NODE_COLLECTION}
+                FILTER node.uuidver == version_id AND node.id == sample_id.id
+                for field in APPEND(
+                    node.cmeta[* RETURN CURRENT.ok],
+                    node.ucmeta[* RETURN CONCAT("custom:", CURRENT.ok)]
+                )
+                RETURN DISTINCT field
+            )
             RETURN {{
-                'id': doc.id,
-                'version_id': doc.vers[sample_id.version - 1],
-                'version': sample_id.version
+                "id": sample_id.id,
+                "version": sample_id.version,
+                "found": version_id != null,
+                "fields": fields
             }}
-        )
-        let node_metas = (for version_id in version_ids
-            for node in {SAMPLE_NODE_COLLECTION}
-                FILTER node.id == version_id.id AND node.uuidver == version_id.version_id
-                LIMIT @num_sample_ids
-                let cmeta_keys = (FOR meta IN node.cmeta
-                    RETURN meta.ok
-                )
-                let ucmeta_keys = (FOR meta IN node.ucmeta
-                    RETURN CONCAT("custom:", meta.ok)
-                )
-            RETURN APPEND(cmeta_keys, ucmeta_keys)
-        )
-        RETURN UNIQUE(FLATTEN(node_metas))
         """
 
-class MetadataManager:
 
-    def __init__(cls, re_api_url, re_admin_token=None):
+def _snapshot_key(sample_id):
+    return f"{sample_id['id']}/{sample_id['version']}"
+
+
+def _field_union(sample_ids, field_sets):
+    '''union of the field sets of the samples, in the order the fields are first seen'''
+    fields = {}
+    for sample_id in sample_ids:
+        for field in field_sets.get((sample_id['id'], sample_id['version']), []):
+            fields[field] = None
+    return list(fields)
+
+
+class MetadataManager:
+    '''
+    Looks up the metadata fields present in sets of samples. Field sets are cached per
+    sample version and Relation Engine token in a bounded LRU cache, so field sets read
+    with one user's token are not shared with callers of another. With a
+    're_admin_token' and a 'cache_dir' they are kept in a snapshot file instead, shared
+    by all worker processes and read in place, which survives service restarts. Either
+    cache holds at most 'cache_size' sample versions.
+    Uncached field sets of many samples are queried in concurrent chunks.
+    '''
+    def __init__(cls, re_api_url, re_admin_token=None, cache_size=100000, cache_dir=None,
+                 chunk_runner=None):
         cls.re_api_url = re_api_url
+        cls.chunk_runner = chunk_runner or ChunkedRunner()
         cls.re_admin_token = re_admin_token
+        # the snapshot is shared by all callers, so it needs a single token for all of them
+        cls.snapshot = SnapshotFile(
+            os.path.join(cache_dir, FIELD_SNAPSHOT_FILE), max_entries=cache_size
+        ) if cache_dir and re_admin_token else None
+        cls.field_sets = LRUCache(maxsize=cache_size) if cls.snapshot is None else None
 
     def get_sampleset_meta(self, sample_ids, user_token):
         # use the user token if an admin token is not provided
-        query_params = {"sample_ids": sample_ids, 'num_sample_ids': len(sample_ids)}
         run_token = self.re_admin_token if self.re_admin_token else user_token
-        ret = execute_query(
-            META_AQL_TEMPLATE,
-            self.re_api_url,
-            run_token,
-            query_params
+        with span('meta.cache'):
+            field_sets, uncached = self._cached_field_sets(sample_ids, run_token)
+        if uncached:
+            field_sets.update(self._query_field_sets(uncached, run_token))
+        with span('meta.union'):
+            return _field_union(sample_ids, field_sets)
+
+    def _cached_field_sets(self, sample_ids, token):
+        '''
+        Returns the field sets of the given samples cached for 'token' by (id, version),
+        and the list of sample addresses whose field sets are not cached.
+        '''
+        if self.snapshot is not None:
+            shared = self.snapshot.get_many([_snapshot_key(s) for s in sample_ids])
+        field_sets = {}
+        uncached = []
+        for sample_id in sample_ids:
+            key = (sample_id['id'], sample_id['version'])
+            if key in field_sets:
+                continue
+            if self.snapshot is not None:
+                fields = shared.get(_snapshot_key(sample_id))
+            else:
+                fields = self.field_sets.get((token,) + key)
+            if fields is None:
+                uncached.append({'id': sample_id['id'], 'version': sample_id['version']})
+            else:
+                field_sets[key] = fields
+        return field_sets, uncached
+
+    def _query_field_sets(self, sample_ids, token):
+        chunk_results = self.chunk_runner.map(
+            lambda chunk: list(iter_query_results(
+                META_AQL_TEMPLATE,
+                self.re_api_url,
+                token,
+                {"sample_ids": chunk}
+            )),
+            self.chunk_runner.split(sample_ids)
         )
+        with span('meta.store'):
+            return self._store_field_sets(itertools.chain.from_iterable(chunk_results), token)
+
+    def _store_field_sets(self, results, token):
+        '''
+        caches the META_AQL_TEMPLATE results queried with 'token', returns their field sets
+        by (id, version)
+        '''
+        field_sets = {}
+        shared = {}
+        for result in results:
+            key = (result['id'], result['version'])
+            field_sets[key] = result['fields']
+            # a version that does not exist yet may be saved later, so it is not cached
+            if not result['found']:
+                continue
+            if self.snapshot is not None:
+                shared[_snapshot_key(result)] = result['fields']
+            else:
+                self.field_sets.set((token,) + key, result['fields'])
+        if shared:
+            self.snapshot.update(shared)
+        return field_sets
+
+
+class AsyncMetadataManager(MetadataManager):
+    '''
+    asyncio counterpart of MetadataManager, used by the ASGI entry point. Field sets are
+    queried with utils.async_re_utils, the snapshot file is updated in the default
+    executor of the event loop.
+    '''
+    @classmethod
+    def from_manager(cls, meta_manager):
+        '''an AsyncMetadataManager sharing the configuration and caches of meta_manager'''
+        async_manager = cls.__new__(cls)
+        async_manager.__dict__.update(meta_manager.__dict__)
+        return async_manager
+
+    async def get_sampleset_meta(self, sample_ids, user_token):
+        # use the user token if an admin token is not provided
+        run_token = self.re_admin_token if self.re_admin_token else user_token
+        with span('meta.cache'):
+            field_sets, uncached = self._cached_field_sets(sample_ids, run_token)
+        if uncached:
+            async def query_chunk(chunk):
+                return [result async for result in async_re_utils.iter_query_results(
+                    META_AQL_TEMPLATE,
+                    self.re_api_url,
+                    run_token,
+                    {"sample_ids": chunk}
+                )]
 
-        return ret['results'][0]
+            chunk_results = await self.chunk_runner.map_async(
+                query_chunk, self.chunk_runner.split(uncached)
+            )
+            with span('meta.store'):
+                field_sets.update(await asyncio.get_running_loop().run_in_executor(
+                    None, self._store_field_sets, itertools.chain.from_iterable(chunk_results),
+                    run_token
+                ))
+        with span('meta.union'):
+            return _field_union(sample_ids, field_sets)
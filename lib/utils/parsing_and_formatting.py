@@ -18,6 +18,15 @@ AQL_comparison_operators = {
     *AQL_one_to_many_value_comparison_operators
 }
 AQL_logical_operators = {"AND", "OR"}
+# largest page of results a paged filter_samples call may request
+MAX_PAGE_SIZE = 10000
+# what filter_samples returns: the matching samples, their number or whether any match
+RETURN_MODES = ("ids", "count", "exists")
+# default and largest number of values and histogram buckets per get_sampleset_facets field
+DEFAULT_FACET_TOP_K = 10
+MAX_FACET_TOP_K = 1000
+DEFAULT_FACET_BUCKETS = 10
+MAX_FACET_BUCKETS = 100
 
 
 def _has_whitespace(s):
@@ -132,6 +141,32 @@ def parse_input(params):
     return samples, filter_conditions
 
 
+def unique_sample_ids(sample_ids):
+    '''the distinct sample addresses in sample_ids, in the order they first appear'''
+    addresses = {}
+    for sample_id in sample_ids:
+        addresses.setdefault((sample_id.get('id'), sample_id.get('version')), None)
+    return [{'id': id_, 'version': version} for id_, version in addresses]
+
+
+def parse_batch_input(params):
+    samples = params.get('sample_ids', [])
+    filter_groups = params.get('filter_condition_groups', [])
+    if not samples:
+        raise ValueError("Must provide 'sample_ids' as input")
+    if len(samples) < 2:
+        # must provide at least 2 samples
+        raise ValueError("Must provide at least two samples in 'sample_ids'")
+    if not filter_groups:
+        raise ValueError("Must provide at least one group of filter conditions in "
+                         "'filter_condition_groups' as input.")
+    for group_idx, filter_conditions in enumerate(filter_groups):
+        if not filter_conditions:
+            raise ValueError("Must provide at least one filter condition in group "
+                             f"{group_idx} of 'filter_condition_groups'.")
+    return samples, filter_groups
+
+
 def parse_field(field, idx):
     '''field cannot have any white space in it'''
     if not field:
@@ -188,9 +223,302 @@ def parse_logical_operator(logic_op, idx, num_filters):
     return logic_op.upper()
 
 
+def parse_paren_position(paren_position, idx):
+    '''
+    n > 0 opens n parentheses before the filter condition,
+    n < 0 closes n parentheses after it, None/0 is no operation
+    '''
+    if not paren_position:
+        return 0
+    try:
+        return int(paren_position)
+    except (TypeError, ValueError):
+        raise ValueError(f"paren_position in filter condition {idx} must be an integer, "
+                         f"got '{paren_position}'.")
+
+
+def parse_limit(limit):
+    '''page size for paged results, None when results are not paged'''
+    if limit is None:
+        return None
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValueError(f"'limit' must be an integer, got '{limit}'.")
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise ValueError(f"'limit' must be between 1 and {MAX_PAGE_SIZE}, got {limit}.")
+    return limit
+
+
+def _parse_facet_limit(value, name, default, maximum):
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"'{name}' must be an integer, got '{value}'.")
+    if value < 1 or value > maximum:
+        raise ValueError(f"'{name}' must be between 1 and {maximum}, got {value}.")
+    return value
+
+
+def parse_facet_input(params):
+    '''
+    the fields, top_k, num_buckets and approximate flag (None when not given) of a
+    get_sampleset_facets call
+    '''
+    if not params.get('sample_ids') and not params.get('sample_set_refs'):
+        raise ValueError("Must provide 'sample_ids' or 'sample_set_refs' as input")
+    fields = params.get('fields') or []
+    if not isinstance(fields, list) or \
+            not all(isinstance(field, str) and field.strip() for field in fields):
+        raise ValueError("'fields' must be a list of metadata field names.")
+    fields = [field.strip() for field in fields]
+    top_k = _parse_facet_limit(params.get('top_k'), 'top_k', DEFAULT_FACET_TOP_K,
+                               MAX_FACET_TOP_K)
+    num_buckets = _parse_facet_limit(params.get('num_buckets'), 'num_buckets',
+                                     DEFAULT_FACET_BUCKETS, MAX_FACET_BUCKETS)
+    approximate = params.get('approximate')
+    if approximate not in (None, 0, 1):
+        raise ValueError(f"'approximate' must be 0 or 1, got '{approximate}'.")
+    return fields, top_k, num_buckets, None if approximate is None else bool(approximate)
+
+
+def parse_return_mode(return_mode, limit):
+    '''the return mode of a filter_samples call, "ids" when not given'''
+    if return_mode is None:
+        return "ids"
+    if return_mode not in RETURN_MODES:
+        raise ValueError(f"'return_mode' must be one of {', '.join(RETURN_MODES)}, "
+                         f"got '{return_mode}'.")
+    if return_mode != "ids" and limit is not None:
+        raise ValueError(f"'limit' can not be used with the '{return_mode}' return mode.")
+    return return_mode
+
+
 def partition_controlled_parsed_filters(parsed_filters):
     # separates out controlled parsed_filters from uncontrolled for validation
     custom_filters = [pf for pf in parsed_filters if pf['field'].startswith('custom:')]
     controlled_filters = [cf for cf in parsed_filters if cf not in custom_filters]
 
     return controlled_filters, custom_filters
+
+
+# Filter expression trees
+# -----------------------
+# The flat list of filter conditions, combined by their logical operators and grouped
+# by their paren_positions, is parsed into a tree before any AQL is generated.
+# Leaves are the formatted filter dicts ('field', 'comp_op', 'values'), inner nodes
+# are {'op': 'AND' | 'OR', 'terms': [...]} and constants are {'op': 'TRUE' | 'FALSE'}.
+FILTER_TRUE = {'op': 'TRUE'}
+FILTER_FALSE = {'op': 'FALSE'}
+_POSITIVE_SET_OPERATORS = {"==", "IN"}
+_NEGATIVE_SET_OPERATORS = {"!=", "NOT IN"}
+
+
+def build_filter_tree(formatted_filters):
+    '''
+    Parses the formatted filters into a filter expression tree, "AND" binds tighter than
+    "OR" and parentheses opened and closed with 'paren_position' group conditions.
+    '''
+    tokens = []
+    depth = 0
+    for idx, formatted_filter in enumerate(formatted_filters):
+        paren = formatted_filter.get('paren_position') or 0
+        if paren > 0:
+            tokens.extend(['('] * paren)
+            depth += paren
+        tokens.append(formatted_filter)
+        if paren < 0:
+            if -paren > depth:
+                raise ValueError(f"filter condition at position {idx} closes {-paren} "
+                                 f"parentheses but only {depth} are open.")
+            tokens.extend([')'] * -paren)
+            depth += paren
+        if formatted_filter.get('logic_op'):
+            tokens.append(formatted_filter['logic_op'])
+    if depth:
+        raise ValueError(f"{depth} parentheses opened in 'filter_conditions' are never closed.")
+    tree, pos = _parse_or(tokens, 0)
+    return tree
+
+
+def _parse_or(tokens, pos):
+    terms = []
+    term, pos = _parse_and(tokens, pos)
+    terms.append(term)
+    while pos < len(tokens) and tokens[pos] == 'OR':
+        term, pos = _parse_and(tokens, pos + 1)
+        terms.append(term)
+    return (terms[0] if len(terms) == 1 else {'op': 'OR', 'terms': terms}), pos
+
+
+def _parse_and(tokens, pos):
+    terms = []
+    term, pos = _parse_term(tokens, pos)
+    terms.append(term)
+    while pos < len(tokens) and tokens[pos] == 'AND':
+        term, pos = _parse_term(tokens, pos + 1)
+        terms.append(term)
+    return (terms[0] if len(terms) == 1 else {'op': 'AND', 'terms': terms}), pos
+
+
+def _parse_term(tokens, pos):
+    if tokens[pos] == '(':
+        term, pos = _parse_or(tokens, pos + 1)
+        # balanced parentheses are checked while tokenizing
+        return term, pos + 1
+    return tokens[pos], pos + 1
+
+
+def _value_key(value):
+    '''hashable key under which two values are equal exactly when they are equal in AQL'''
+    if isinstance(value, bool):
+        return ('bool', value)
+    if isinstance(value, (int, float)):
+        return ('number', float(value))
+    return (type(value).__name__, value)
+
+
+def _leaf_key(leaf):
+    return (leaf['field'], leaf['comp_op'], tuple(_value_key(v) for v in leaf['values']))
+
+
+def _unique(values):
+    seen = set()
+    unique = []
+    for value in values:
+        key = _value_key(value)
+        if key not in seen:
+            seen.add(key)
+            unique.append(value)
+    return unique
+
+
+def _set_leaf(field, positive, values):
+    '''== / != for a single value, IN / NOT IN otherwise'''
+    if len(values) == 1:
+        return {'field': field, 'comp_op': "==" if positive else "!=", 'values': values}
+    return {'field': field, 'comp_op': "IN" if positive else "NOT IN", 'values': values}
+
+
+def _merge_set_terms(op, terms):
+    '''
+    Combines the equality and membership tests on the same field. Under "OR", equalities
+    are merged into a single IN, under "AND" the allowed value sets are intersected.
+    Returns the merged terms or a constant when the tests on a field cannot be satisfied
+    ("AND") or always hold ("OR").
+    '''
+    positives = {}
+    negatives = {}
+    other_terms = []
+    for term in terms:
+        comp_op = term.get('comp_op')
+        if comp_op in _POSITIVE_SET_OPERATORS:
+            positives.setdefault(term['field'], []).append(term['values'])
+        elif comp_op in _NEGATIVE_SET_OPERATORS:
+            negatives.setdefault(term['field'], []).append(term['values'])
+        else:
+            other_terms.append(term)
+    merged = []
+    for field in list(positives) + [f for f in negatives if f not in positives]:
+        pos_sets = positives.get(field)
+        neg_sets = negatives.get(field)
+        if op == 'AND':
+            # x IN A AND x IN B == x IN (A & B), x IN A AND x NOT IN B == x IN (A - B)
+            allowed = _intersection(pos_sets) if pos_sets else None
+            excluded = _unique([v for vs in neg_sets for v in vs]) if neg_sets else []
+            if allowed is None:
+                merged.append(_set_leaf(field, False, excluded))
+                continue
+            allowed = _difference(allowed, excluded)
+            if not allowed:
+                return FILTER_FALSE
+            merged.append(_set_leaf(field, True, allowed))
+        else:
+            # x IN A OR x IN B == x IN (A | B), x NOT IN A OR x NOT IN B == x NOT IN (A & B)
+            allowed = _unique([v for vs in pos_sets for v in vs]) if pos_sets else []
+            excluded = _intersection(neg_sets) if neg_sets else None
+            if excluded is None:
+                merged.append(_set_leaf(field, True, allowed))
+                continue
+            # x IN A OR x NOT IN B == x NOT IN (B - A)
+            excluded = _difference(excluded, allowed)
+            if not excluded:
+                return FILTER_TRUE
+            merged.append(_set_leaf(field, False, excluded))
+    return merged + other_terms
+
+
+def _intersection(value_sets):
+    common = _unique(value_sets[0])
+    for values in value_sets[1:]:
+        keys = {_value_key(v) for v in values}
+        common = [v for v in common if _value_key(v) in keys]
+    return common
+
+
+def _difference(values, excluded):
+    keys = {_value_key(v) for v in excluded}
+    return [v for v in values if _value_key(v) not in keys]
+
+
+def simplify_filter_tree(tree):
+    '''
+    Normalizes a filter expression tree: nested operators of the same kind are flattened,
+    duplicate terms removed, equality tests on the same field merged and constant
+    sub-expressions folded.
+    '''
+    op = tree.get('op')
+    if op not in AQL_logical_operators:
+        return tree
+    absorbing, neutral = (FILTER_FALSE, FILTER_TRUE) if op == 'AND' else \
+        (FILTER_TRUE, FILTER_FALSE)
+    terms = []
+    for term in tree['terms']:
+        term = simplify_filter_tree(term)
+        if term is absorbing:
+            return absorbing
+        if term is neutral:
+            continue
+        if term.get('op') == op:
+            terms.extend(term['terms'])
+        else:
+            terms.append(term)
+    merged = _merge_set_terms(op, terms)
+    if merged is absorbing:
+        return absorbing
+    # remove duplicate terms, keeping the first occurrence
+    seen = set()
+    unique_terms = []
+    for term in merged:
+        key = _leaf_key(term) if 'field' in term else repr(term)
+        if key not in seen:
+            seen.add(key)
+            unique_terms.append(term)
+    if not unique_terms:
+        return neutral
+    if len(unique_terms) == 1:
+        return unique_terms[0]
+    return {'op': op, 'terms': unique_terms}
+
+
+def filter_tree_leaves(tree):
+    '''the filter conditions of a filter expression tree, in expression order'''
+    if 'terms' in tree:
+        for term in tree['terms']:
+            yield from filter_tree_leaves(term)
+    elif 'field' in tree:
+        yield tree
+
+
+def filter_tree_shape(tree):
+    '''
+    Hashable description of a filter expression tree without its field names and values,
+    two trees with the same shape compile to the same AQL text.
+    '''
+    if 'terms' in tree:
+        return (tree['op'], tuple(filter_tree_shape(term) for term in tree['terms']))
+    if 'field' in tree:
+        return (tree['field'].startswith('custom:'), tree['comp_op'])
+    return tree['op']
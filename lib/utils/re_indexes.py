@@ -0,0 +1,49 @@
+# Relation Engine index requirements for the sample search queries
+import logging
+
+from utils.re_utils import get_collection_spec
+from utils.filter_samples import SAMPLE_NODE_COLLECTION
+
+# Indexes the generated AQL relies on. Documents in the samples collection are
+# resolved by '_key' (always indexed), sample nodes are resolved by their version
+# uuid, which must be backed by a persistent index or every requested sample
+# turns into a full scan of the nodes collection.
+REQUIRED_INDEXES = [
+    {
+        'collection': SAMPLE_NODE_COLLECTION,
+        'type': 'persistent',
+        'fields': ['uuidver']
+    }
+]
+
+# legacy index types that ArangoDB treats as persistent indexes
+_PERSISTENT_INDEX_TYPES = {'persistent', 'hash', 'skiplist'}
+
+
+def _index_satisfies(index, required):
+    '''an index satisfies the requirement if the required fields are a prefix of its fields'''
+    if index.get('type') not in _PERSISTENT_INDEX_TYPES:
+        return False
+    fields = index.get('fields', [])
+    return fields[:len(required['fields'])] == required['fields']
+
+
+def check_required_indexes(re_api_url, token=None):
+    '''
+    Checks the Relation Engine collection specs for the indexes in REQUIRED_INDEXES.
+    Returns the list of requirements that could not be verified.
+    '''
+    missing = []
+    for required in REQUIRED_INDEXES:
+        try:
+            spec = get_collection_spec(required['collection'], re_api_url, token)
+        except Exception as error:
+            logging.warning(f"Unable to fetch Relation Engine spec for collection "
+                            f"'{required['collection']}': {error}")
+            missing.append(required)
+            continue
+        if isinstance(spec, list):
+            spec = spec[0] if spec else {}
+        if not any(_index_satisfies(index, required) for index in spec.get('indexes', [])):
+            missing.append(required)
+    return missing
@@ -4,8 +4,16 @@
 Relation engine API client functions.
 """
 import json
+import os
 import re
+import threading
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
+
+from utils.timing import span
 
 # see https://www.arangodb.com/2018/07/time-traveling-with-graph-databases/
 # in unix epoch ms this is 2255/6/5
@@ -13,6 +21,27 @@ import requests
 
 _ADB_KEY_DISALLOWED_CHARS_REGEX = re.compile(r"[^a-zA-Z0-9_\-:\.@\(\)\+,=;\$!\*'%]")
 
+# Keep-alive connection pool shared by every Relation Engine request made by this
+# process. Overridden at startup from deploy.cfg through configure_session. A forked
+# process (e.g. a uWSGI worker) builds a pool of its own on first use, so no two
+# processes read responses from the same connection.
+_SESSION_CONFIG = {
+    'pool_size': 10,
+    'max_retries': 3,
+    'backoff_factor': 0.5,
+    'timeout': 300
+}
+# only transient gateway errors are retried, RE queries are read only so POST is safe.
+# Fetching a cursor batch advances the cursor, so it is only retried when the
+# connection could not be opened.
+_RETRY_STATUSES = (502, 503, 504)
+_session = None
+# the process the session was built in
+_session_pid = None
+_session_lock = threading.Lock()
+_request_count = 0
+_retry_count = 0
+
 
 def clean_key(key):
     """
@@ -22,35 +51,198 @@ def clean_key(key):
     return _ADB_KEY_DISALLOWED_CHARS_REGEX.sub('_', key)
 
 
+class _CountingAdapter(HTTPAdapter):
+    """HTTPAdapter that counts the requests sent through it."""
+
+    def send(self, request, **kwargs):
+        global _request_count
+        with _session_lock:
+            _request_count += 1
+        return super().send(request, **kwargs)
+
+
+class _RelationEngineRetry(Retry):
+    """
+    Retry policy that counts the retries it allows and does not retry cursor fetches
+    the RE may have served, a retry would skip the batch of the failed request.
+    """
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None,
+                  _stacktrace=None):
+        global _retry_count
+        if url and 'cursor_id=' in url and not isinstance(error, ConnectTimeoutError):
+            reason = error or ResponseError('cursor fetch failed with status %s'
+                                            % (response.status if response else None))
+            raise MaxRetryError(_pool, url, reason)
+        retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        with _session_lock:
+            _retry_count += 1
+        return retry
+
+
+def _retry_policy(max_retries, backoff_factor):
+    retry_args = {
+        'total': max_retries,
+        'backoff_factor': backoff_factor,
+        'status_forcelist': _RETRY_STATUSES,
+        'raise_on_status': False
+    }
+    try:
+        return _RelationEngineRetry(allowed_methods=frozenset(['GET', 'POST']), **retry_args)
+    except TypeError:
+        # urllib3 < 1.26
+        return _RelationEngineRetry(method_whitelist=frozenset(['GET', 'POST']), **retry_args)
+
+
+def configure_session(pool_size=None, max_retries=None, backoff_factor=None, timeout=None):
+    """
+    Sets the pool size, retry policy and timeout (seconds) used for Relation Engine
+    requests. The pooled session is rebuilt on its next use.
+    """
+    global _session
+    new_config = {
+        'pool_size': pool_size,
+        'max_retries': max_retries,
+        'backoff_factor': backoff_factor,
+        'timeout': timeout
+    }
+    with _session_lock:
+        _SESSION_CONFIG.update({k: v for k, v in new_config.items() if v is not None})
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def get_session():
+    """Returns the process wide keep-alive session for Relation Engine requests."""
+    global _session, _session_pid, _request_count, _retry_count
+    pid = os.getpid()
+    with _session_lock:
+        if _session is None or _session_pid != pid:
+            if _session_pid != pid:
+                # a session built before a fork is dropped without closing it, its
+                # connections belong to the parent process
+                _request_count = 0
+                _retry_count = 0
+            adapter = _CountingAdapter(
+                pool_connections=_SESSION_CONFIG['pool_size'],
+                pool_maxsize=_SESSION_CONFIG['pool_size'],
+                max_retries=_retry_policy(_SESSION_CONFIG['max_retries'],
+                                          _SESSION_CONFIG['backoff_factor'])
+            )
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+            _session_pid = pid
+        return _session
+
+
+def get_session_stats():
+    """
+    Counters of the pooled session of this process: the number of requests sent,
+    connections opened, requests served over an already open connection and retries
+    of failed requests.
+    """
+    with _session_lock:
+        if _session_pid == os.getpid():
+            session, requests_sent, retries = _session, _request_count, _retry_count
+        else:
+            session, requests_sent, retries = None, 0, 0
+    connections_opened = 0
+    if session is not None:
+        pools = session.get_adapter('https://').poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections_opened += pool.num_connections
+    return {
+        'requests': requests_sent,
+        'connections_opened': connections_opened,
+        'connections_reused': max(requests_sent - connections_opened, 0),
+        'retries': retries
+    }
+
+
 def get_doc(coll, key, re_api_url, token):
     """Fetch a doc in a collection by key."""
-    resp = requests.post(
+    resp = get_session().post(
         re_api_url + '/api/v1/query_results',
         data=json.dumps({
             'query': "for v in @@coll filter v._key == @key limit 1 return v",
             '@coll': coll,
             'key': clean_key(key)
         }),
-        headers={'Authorization': token}
+        headers={'Authorization': token},
+        timeout=_SESSION_CONFIG['timeout']
     )
     if not resp.ok:
         raise RuntimeError(resp.text)
     return resp.json()
 
 
-def execute_query(query, re_api_url, token, params=None):
+def execute_query(query, re_api_url, token, params=None, batch_size=None):
     """
     Execute an arbitrary query in the database.
     NOTE: be sure to guard against AQL injection when using this function.
     NOTE: token must be Relation Engine Admin token.
+    batch_size - if given, at most this many results are returned and the response
+        carries a 'cursor_id' to fetch the rest with fetch_cursor while 'has_more' is true.
     """
     if not params:
         params = {}
     params['query'] = query
-    resp = requests.post(
-        re_api_url + '/api/v1/query_results',
-        data=json.dumps(params),
-        headers={'Authorization': token},
+    with span('re.execute_query'):
+        resp = get_session().post(
+            re_api_url + '/api/v1/query_results',
+            data=json.dumps(params),
+            params={'batch_size': batch_size} if batch_size else None,
+            headers={'Authorization': token},
+            timeout=_SESSION_CONFIG['timeout']
+        )
+        if not resp.ok:
+            raise RuntimeError(resp.text)
+        return resp.json()
+
+
+def fetch_cursor(cursor_id, re_api_url, token):
+    """
+    Fetch the next batch of results of a query run with a batch_size. A failed fetch is
+    not retried, the RE may have advanced the cursor past the batch it lost.
+    """
+    with span('re.fetch_cursor'):
+        resp = get_session().post(
+            re_api_url + '/api/v1/query_results',
+            params={'cursor_id': cursor_id},
+            headers={'Authorization': token},
+            timeout=_SESSION_CONFIG['timeout']
+        )
+        if not resp.ok:
+            raise RuntimeError(resp.text)
+        return resp.json()
+
+
+def iter_query_results(query, re_api_url, token, params=None, batch_size=1000):
+    """
+    Generator over the results of a query, fetched and decoded one batch of at most
+    batch_size results at a time so large result sets are never held in memory at once.
+    """
+    resp = execute_query(query, re_api_url, token, params, batch_size=batch_size)
+    while True:
+        yield from resp['results']
+        if not resp.get('has_more'):
+            return
+        resp = fetch_cursor(resp['cursor_id'], re_api_url, token)
+
+
+def get_collection_spec(coll, re_api_url, token=None):
+    """Fetch the Relation Engine spec (schema and declared indexes) for a collection."""
+    headers = {'Authorization': token} if token else {}
+    resp = get_session().get(
+        re_api_url + '/api/v1/specs/collections',
+        params={'name': coll},
+        headers=headers,
+        timeout=_SESSION_CONFIG['timeout']
     )
     if not resp.ok:
         raise RuntimeError(resp.text)
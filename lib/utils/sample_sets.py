@@ -0,0 +1,51 @@
+# resolution of workspace SampleSet objects to the sample addresses they contain
+import re
+
+from installed_clients.WorkspaceClient import Workspace
+from utils.cache import LRUCache
+
+# only the sample addresses are downloaded from the SampleSet objects
+SAMPLE_SET_INCLUDED_PATHS = ['samples/[*]/id', 'samples/[*]/version']
+
+# ws_id/obj_id/version references always point at the same object data
+_IMMUTABLE_REF_REGEX = re.compile(r"^\d+/\d+/\d+$")
+
+
+class SampleSetResolver:
+    '''
+    Resolves SampleSet object references to lists of {'id', 'version'} sample addresses.
+    Addresses for fully versioned numeric references are cached, a cache hit still
+    checks that the caller can read the object, but does not download its data.
+    '''
+    def __init__(cls, ws_url, cache_size=1000):
+        cls.ws_url = ws_url
+        cls.sample_sets = LRUCache(maxsize=cache_size)
+
+    def get_sample_ids(self, sample_set_refs, token):
+        # the client only carries the caller's token, connections come from the shared pool
+        ws = Workspace(self.ws_url, token=token)
+        resolved = {}
+        for ref in sample_set_refs:
+            if _IMMUTABLE_REF_REGEX.match(ref):
+                sample_ids = self.sample_sets.get(ref)
+                if sample_ids is not None:
+                    resolved[ref] = sample_ids
+        if resolved:
+            # raises the same workspace error as get_objects2 for unreadable objects
+            ws.get_object_info3({'objects': [{'ref': ref} for ref in resolved]})
+        uncached = [ref for ref in sample_set_refs if ref not in resolved]
+        if uncached:
+            ws_input = {'objects': [{'ref': ref, 'included': SAMPLE_SET_INCLUDED_PATHS}
+                                    for ref in uncached]}
+            for ref, sample_set in zip(uncached, ws.get_objects2(ws_input)['data']):
+                sample_ids = [{
+                    'id': sample['id'],
+                    'version': sample['version']
+                } for sample in sample_set['data']['samples']]
+                if _IMMUTABLE_REF_REGEX.match(ref):
+                    self.sample_sets.set(ref, sample_ids)
+                resolved[ref] = sample_ids
+        samples = []
+        for ref in sample_set_refs:
+            samples.extend(resolved[ref])
+        return samples
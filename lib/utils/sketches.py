@@ -0,0 +1,244 @@
+# mergeable approximate summaries of large streams of metadata values
+import hashlib
+import json
+import math
+
+
+def _canonical(value):
+    '''the JSON text values equal in AQL share, integral floats are written as integers'''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def interpolate(low, high, fraction):
+    '''the number a 'fraction' of the way from low to high, for any finite low and high'''
+    if math.isinf(high - low):
+        # halve the span so it does not overflow, the halves each stay within it
+        half_step = (high / 2 - low / 2) * fraction
+        return low + half_step + half_step
+    return low + (high - low) * fraction
+
+
+def fraction_between(value, low, high):
+    '''the fraction of the way from low to high 'value' lies at, for any finite numbers'''
+    if math.isinf(high - low):
+        return (value / 2 - low / 2) / (high / 2 - low / 2)
+    return (value - low) / (high - low)
+
+
+class HyperLogLog:
+    '''
+    Distinct count estimate of the values added to it, using 2 ** precision one byte
+    registers. The relative standard error of the estimate is about
+    1.04 / sqrt(2 ** precision), sketches of the same precision merge losslessly.
+    '''
+    def __init__(cls, precision=12):
+        if precision < 4 or precision > 18:
+            raise ValueError(f"HyperLogLog precision must be between 4 and 18, got {precision}")
+        cls.precision = precision
+        cls.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        digest = hashlib.blake2b(_canonical(value).encode('utf-8'), digest_size=8).digest()
+        hashed = int.from_bytes(digest, 'big')
+        bits = 64 - self.precision
+        idx = hashed >> bits
+        rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("Only HyperLogLog sketches of the same precision can be merged")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def merge_registers(self, registers):
+        '''
+        merges (register, rank) pairs computed elsewhere, all the values of a sketch must
+        be hashed the same way
+        '''
+        for idx, rank in registers:
+            if rank > self.registers[idx]:
+                self.registers[idx] = rank
+
+    def estimate(self):
+        num_registers = len(self.registers)
+        if num_registers >= 128:
+            alpha = 0.7213 / (1 + 1.079 / num_registers)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[num_registers]
+        estimate = alpha * num_registers * num_registers / \
+            sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * num_registers and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = num_registers * math.log(num_registers / zeros)
+        return int(round(estimate))
+
+
+class TDigest:
+    '''
+    Merging t-digest of weighted numbers (Dunning, "Computing extremely accurate
+    quantiles using t-digests"). At most about 'compression' centroids are kept,
+    concentrated at the tails, the quantile error is roughly 1 / compression and
+    smallest near the extremes. The minimum and maximum are exact.
+    '''
+    def __init__(cls, compression=100):
+        cls.compression = compression
+        cls.centroids = []
+        cls.total = 0
+        cls.min = math.inf
+        cls.max = -math.inf
+        cls._buffer = []
+
+    def add(self, value, weight=1):
+        self._buffer.append((value, weight))
+        self.total += weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self._buffer) > 5 * self.compression:
+            self._compress()
+
+    def add_centroids(self, centroids, minimum, maximum):
+        '''adds (mean, weight) centroids of numbers ranging from minimum to maximum'''
+        for mean, weight in centroids:
+            self._buffer.append((mean, weight))
+            self.total += weight
+        self.min = min(self.min, minimum)
+        self.max = max(self.max, maximum)
+        if len(self._buffer) > 5 * self.compression:
+            self._compress()
+
+    def merge(self, other):
+        other._compress()
+        self._buffer.extend(other.centroids)
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+
+    def quantile(self, q):
+        '''estimate of the value below which a q fraction of the weight lies'''
+        self._compress()
+        if not self.centroids:
+            return None
+        target = q * self.total
+        # interpolate between the centers of the centroids, anchored at the exact extremes
+        previous_position, previous_mean = 0, self.min
+        cumulative = 0
+        for mean, weight in self.centroids:
+            position = cumulative + weight / 2
+            if target < position:
+                fraction = (target - previous_position) / (position - previous_position)
+                return interpolate(previous_mean, mean, fraction)
+            previous_position, previous_mean = position, mean
+            cumulative += weight
+        if self.total == previous_position:
+            return self.max
+        fraction = (target - previous_position) / (self.total - previous_position)
+        return interpolate(previous_mean, self.max, min(fraction, 1))
+
+    def cdf(self, value):
+        '''estimate of the fraction of the weight at or below 'value' '''
+        self._compress()
+        if not self.centroids or value < self.min:
+            return 0.0
+        if value >= self.max:
+            return 1.0
+        previous_position, previous_mean = 0, self.min
+        cumulative = 0
+        for mean, weight in self.centroids:
+            position = cumulative + weight / 2
+            if value < mean:
+                fraction = fraction_between(value, previous_mean, mean)
+                return (previous_position + fraction * (position - previous_position)) / \
+                    self.total
+            previous_position, previous_mean = position, mean
+            cumulative += weight
+        fraction = fraction_between(value, previous_mean, self.max)
+        return (previous_position + fraction * (self.total - previous_position)) / self.total
+
+    def _scale(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _inverse_scale(self, k):
+        angle = max(-math.pi / 2, min(math.pi / 2, k * 2 * math.pi / self.compression))
+        return (math.sin(angle) + 1) / 2
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        points = sorted(self.centroids + self._buffer)
+        self._buffer = []
+        centroids = []
+        merged_weight = 0
+        mean, weight = points[0]
+        limit = self.total * self._inverse_scale(self._scale(0) + 1)
+        for point_mean, point_weight in points[1:]:
+            if merged_weight + weight + point_weight <= limit:
+                weight += point_weight
+                mean = interpolate(mean, point_mean, point_weight / weight)
+            else:
+                centroids.append((mean, weight))
+                merged_weight += weight
+                limit = self.total * self._inverse_scale(
+                    self._scale(merged_weight / self.total) + 1
+                )
+                mean, weight = point_mean, point_weight
+        centroids.append((mean, weight))
+        self.centroids = centroids
+
+
+class FrequentValues:
+    '''
+    Misra-Gries summary of the most frequent of a stream of weighted values, keeping
+    at most 'max_values' counters. Counts are lower bounds, too low by at most
+    total / (max_values + 1), summaries merge with the same guarantee.
+    '''
+    def __init__(cls, max_values=1000):
+        cls.max_values = max_values
+        cls.counts = {}
+        cls.total = 0
+
+    def add(self, key, value, weight=1):
+        count, _ = self.counts.get(key, (0, None))
+        self.counts[key] = (count + weight, value)
+        self.total += weight
+        if len(self.counts) > 2 * self.max_values:
+            self._reduce()
+
+    def add_top(self, top_values, total):
+        '''
+        adds the (key, value, count) of the most frequent values of a stream of 'total'
+        weight, none of the values left out being more frequent than the least of them
+        '''
+        for key, value, count in top_values:
+            own_count, _ = self.counts.get(key, (0, None))
+            self.counts[key] = (own_count + count, value)
+        self.total += total
+        self._reduce()
+
+    def merge(self, other):
+        for key, (count, value) in other.counts.items():
+            own_count, _ = self.counts.get(key, (0, None))
+            self.counts[key] = (own_count + count, value)
+        self.total += other.total
+        self._reduce()
+
+    def most_frequent(self, num_values):
+        '''the (value, count) pairs of the num_values most frequent values'''
+        self._reduce()
+        counts = sorted(self.counts.values(), key=lambda count_value: (
+            -count_value[0], str(count_value[1])
+        ))
+        return [(value, count) for count, value in counts[:num_values]]
+
+    def _reduce(self):
+        if len(self.counts) <= self.max_values:
+            return
+        # every counter loses the count of the largest counter that does not fit
+        cutoff = sorted((count for count, _ in self.counts.values()),
+                        reverse=True)[self.max_values]
+        self.counts = {key: (count - cutoff, value)
+                       for key, (count, value) in self.counts.items() if count > cutoff}
@@ -0,0 +1,242 @@
+# memory-mapped snapshot files shared by the worker processes of the service
+import atexit
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+# File layout, all integers little endian:
+#   header - magic, number of entries
+#   table  - one fixed width entry per key, sorted by key: key padded with zero bytes,
+#            offset of the value from the start of the file, length of the value and
+#            the time the entry was written in milliseconds
+#   values - the JSON encoded values
+_MAGIC = b"SSNAP002"
+_HEADER = struct.Struct("<8sQ")
+KEY_WIDTH = 64
+_ENTRY = struct.Struct(f"<{KEY_WIDTH}sQIQ")
+
+
+def _encode_key(key):
+    '''the padded table key of 'key', None for keys that do not fit in the table'''
+    encoded = key.encode('utf-8')
+    if len(encoded) > KEY_WIDTH or b"\0" in encoded:
+        return None
+    return encoded.ljust(KEY_WIDTH, b"\0")
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+class SnapshotFile:
+    '''
+    Read-mostly key value store of JSON values in a single file. Readers map the file
+    into memory, so every process reading the same file shares one copy of it through
+    the page cache, and look keys up by binary search of the sorted key table. Values
+    are read in place and only decoded on request.
+    Updates are buffered and written by a background thread, at most every
+    'flush_interval' seconds or as soon as 'flush_entries' are buffered: the writer
+    rebuilds the file under an exclusive lock and atomically replaces it, keeping the
+    'max_entries' most recently written entries. Readers map the new file the next time
+    they notice it changed, and see their own buffered updates until then.
+    '''
+    def __init__(cls, path, max_entries=1000000, flush_interval=5.0, flush_entries=10000):
+        cls.path = path
+        cls.lock_path = f"{path}.lock"
+        cls.max_entries = max_entries
+        cls.flush_interval = flush_interval
+        cls.flush_entries = flush_entries
+        cls._lock = threading.Lock()
+        cls._map = None
+        cls._count = 0
+        cls._stat = None
+        # encoded key to (encoded value, write time) of the updates not written yet
+        cls._pending = {}
+        cls._flush_lock = threading.Lock()
+        cls._wake = threading.Condition(cls._lock)
+        cls._writer = None
+
+    def get_raw_many(self, keys):
+        '''
+        returns a dict of read-only memoryviews of the JSON encoded values of the keys
+        found in the snapshot, the file is not copied
+        '''
+        data, count = self._current()
+        with self._lock:
+            pending = self._pending
+            found = {}
+            for key in keys:
+                encoded = _encode_key(key)
+                if encoded is None:
+                    continue
+                entry = pending.get(encoded)
+                if entry is not None:
+                    found[key] = memoryview(entry[0])
+                elif count:
+                    raw = self._find(data, count, encoded)
+                    if raw is not None:
+                        found[key] = raw
+        return found
+
+    def get_many(self, keys):
+        '''returns a dict of the values of the keys found in the snapshot'''
+        decoded = {}
+        found = {}
+        for key, raw in self.get_raw_many(keys).items():
+            # many keys share the same value, each distinct value is decoded once
+            value = decoded.get(raw)
+            if value is None:
+                value = decoded[raw] = json.loads(raw.tobytes())
+            found[key] = value
+        return found
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def update(self, entries):
+        '''
+        Adds the key value pairs in 'entries' to the snapshot, replacing the values of
+        existing keys. Keys longer than KEY_WIDTH bytes are not stored. The entries are
+        written to the file in the background.
+        '''
+        written = _now_ms()
+        new_values = {}
+        for key, value in entries.items():
+            encoded = _encode_key(key)
+            if encoded is not None:
+                new_values[encoded] = (
+                    json.dumps(value, separators=(',', ':')).encode('utf-8'), written
+                )
+        if not new_values:
+            return
+        with self._lock:
+            self._pending.update(new_values)
+            # the buffer is bounded like the file, if the writer falls behind
+            while len(self._pending) > self.max_entries:
+                del self._pending[next(iter(self._pending))]
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, daemon=True)
+                self._writer.start()
+                atexit.register(self.flush)
+            if len(self._pending) >= self.flush_entries:
+                self._wake.notify()
+
+    def flush(self):
+        '''writes the buffered updates to the file now'''
+        with self._flush_lock:
+            with self._lock:
+                pending = dict(self._pending)
+            if not pending:
+                return
+            replaced = False
+            tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(self.lock_path, 'a') as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    try:
+                        # re-read the snapshot under the lock, other workers may have updated it
+                        values = {key: (raw.tobytes(), written) for key, raw, written
+                                  in self._entries(*self._current())}
+                        values.update(pending)
+                        self._write(tmp_path, values)
+                        os.replace(tmp_path, self.path)
+                        replaced = True
+                    finally:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+            except OSError as error:
+                logging.warning(f"Unable to update the snapshot file {self.path}: {error}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            if not replaced:
+                return
+            # map the new file before dropping the updates it holds, so they stay visible
+            self._current()
+            with self._lock:
+                # keep the updates made while the file was written
+                self._pending = {key: entry for key, entry in self._pending.items()
+                                 if pending.get(key) is not entry}
+
+    def __len__(self):
+        return self._current()[1]
+
+    def _write_loop(self):
+        while True:
+            with self._lock:
+                if len(self._pending) < self.flush_entries:
+                    self._wake.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception(f"Unable to write the snapshot file {self.path}")
+
+    def _current(self):
+        '''the mapped snapshot and its number of entries, remapped if the file changed'''
+        try:
+            stat = os.stat(self.path)
+            stat = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            stat = None
+        with self._lock:
+            if stat != self._stat:
+                self._map, self._count = self._open() if stat else (None, 0)
+                self._stat = stat
+            return self._map, self._count
+
+    def _open(self):
+        try:
+            with open(self.path, 'rb') as f:
+                # the mapping stays valid after the file is closed or replaced
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as error:
+            logging.warning(f"Unable to map the snapshot file {self.path}: {error}")
+            return None, 0
+        magic, count = _HEADER.unpack_from(data, 0) if len(data) >= _HEADER.size else (None, 0)
+        if magic != _MAGIC or len(data) < _HEADER.size + count * _ENTRY.size:
+            logging.warning(f"Ignoring the invalid snapshot file {self.path}")
+            return None, 0
+        return memoryview(data), count
+
+    def _find(self, data, count, encoded):
+        low, high = 0, count
+        while low < high:
+            mid = (low + high) // 2
+            entry_key, offset, length, _ = _ENTRY.unpack_from(
+                data, _HEADER.size + mid * _ENTRY.size
+            )
+            if entry_key < encoded:
+                low = mid + 1
+            elif entry_key > encoded:
+                high = mid
+            else:
+                return data[offset:offset + length]
+        return None
+
+    def _entries(self, data, count):
+        for idx in range(count):
+            entry_key, offset, length, written = _ENTRY.unpack_from(
+                data, _HEADER.size + idx * _ENTRY.size
+            )
+            yield entry_key, data[offset:offset + length], written
+
+    def _write(self, path, values):
+        keys = sorted(values)
+        if len(keys) > self.max_entries:
+            # drop the entries written longest ago
+            newest = sorted(keys, key=lambda key: values[key][1])[-self.max_entries:]
+            keys = sorted(newest)
+        offset = _HEADER.size + len(keys) * _ENTRY.size
+        with open(path, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, len(keys)))
+            for key in keys:
+                value, written = values[key]
+                f.write(_ENTRY.pack(key, offset, len(value), written))
+                offset += len(value)
+            for key in keys:
+                f.write(values[key][0])
+            f.flush()
+            os.fsync(f.fileno())
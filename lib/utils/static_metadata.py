@@ -0,0 +1,174 @@
+# cached access to the SampleService controlled vocabulary static metadata
+import logging
+import os
+import threading
+
+from utils.cache import LRUCache
+from utils.executors import ProcessLocalExecutor
+from utils.timing import bind, span
+
+# cached marker for keys the SampleService could not resolve with a given prefix mode
+_NOT_FOUND = object()
+_MISSING = object()
+
+
+def _error_keys(error):
+    '''parses the unresolvable keys out of a SampleService static metadata error'''
+    err_message = getattr(error, 'message', None) or str(error)
+    err_keys = err_message.split(':')[-1]
+    return {k.strip() for k in err_keys.strip().split(',') if k.strip()}
+
+
+class StaticMetadataCache:
+    '''
+    Caches the SampleService static metadata for controlled metadata keys. The static
+    metadata only changes when the SampleService is redeployed, so entries are kept for
+    'ttl' seconds and keys the SampleService fails to resolve are cached as well.
+    Entries are keyed by (key, prefix) where prefix is the SampleService prefix mode,
+    0 for exact keys and 1 for prefix validated keys. Keys that are not known to be exact
+    keys are looked up in both modes at once, with up to 'max_workers' concurrent
+    SampleService calls. The first lookup of each process warms up the cache with
+    'warm_keys' in the background.
+    '''
+    def __init__(cls, sample_service, maxsize=2000, ttl=3600, max_workers=4, warm_keys=()):
+        cls.sample_service = sample_service
+        cls._cache = LRUCache(maxsize=maxsize, ttl=ttl)
+        cls._executor = ProcessLocalExecutor(max_workers=max_workers)
+        cls.negative_hits = 0
+        cls._stats_lock = threading.Lock()
+        cls.warm_keys = list(warm_keys)
+        # the process the warm up was started in
+        cls._warm_pid = None
+        cls._warm_lock = threading.Lock()
+
+    def get_static_metadata(self, keys):
+        '''
+        Returns a dict of key to static metadata for the given controlled keys, raises a
+        ValueError listing the keys that are neither exact nor prefix validated keys.
+        '''
+        self._start_warm_up()
+        static_metadata, unresolved = self._lookup(keys)
+        if unresolved:
+            message = "Unable to resolve metadata fields or prefix metadata fields: " + \
+                      ", ".join(sorted(unresolved))
+            raise ValueError(message)
+        return static_metadata
+
+    def warm_up(self, keys):
+        '''
+        Fetches the static metadata for 'keys' ahead of the first request using them.
+        Failures are logged, the keys are then fetched by the requests using them.
+        '''
+        try:
+            _, unresolved = self._lookup(keys)
+        except Exception:
+            logging.exception("Unable to warm up static metadata")
+            return
+        if unresolved:
+            logging.warning("Unable to warm up static metadata for metadata fields: " +
+                            ", ".join(sorted(unresolved)))
+
+    def _start_warm_up(self):
+        # runs once per process, so the SampleService calls and pool threads of the warm
+        # up are never started in a uWSGI master before it forks the workers
+        pid = os.getpid()
+        if not self.warm_keys or self._warm_pid == pid:
+            return
+        with self._warm_lock:
+            if self._warm_pid == pid:
+                return
+            self._warm_pid = pid
+        # not bound to the timings of the request that happens to start it
+        self._executor.submit(self.warm_up, self.warm_keys)
+
+    def stats(self):
+        stats = self._cache.stats()
+        with self._stats_lock:
+            stats['negative_hits'] = self.negative_hits
+        return stats
+
+    def _lookup(self, keys):
+        '''
+        Returns the static metadata of the keys resolvable as exact keys or else as
+        prefix keys, and the set of keys that are neither.
+        '''
+        exact, exact_unresolved, exact_fetch = self._cached(keys, 0)
+        # keys that may not be exact keys are looked up as prefix keys at the same time,
+        # so resolving a prefix key takes one round trip to the SampleService, not two
+        prefixed, prefix_unresolved, prefix_fetch = self._cached(
+            exact_unresolved | exact_fetch, 1
+        )
+        exact_future = self._executor.submit(bind(self._fetch), exact_fetch, 0) \
+            if exact_fetch else None
+        if prefix_fetch:
+            fetched, unresolved = self._fetch(prefix_fetch, 1)
+            prefixed.update(fetched)
+            prefix_unresolved.update(unresolved)
+        if exact_future is not None:
+            fetched, unresolved = exact_future.result()
+            exact.update(fetched)
+            exact_unresolved.update(unresolved)
+        # exact keys take precedence over prefix keys
+        static_metadata = {key: prefixed[key] for key in exact_unresolved if key in prefixed}
+        static_metadata.update(exact)
+        return static_metadata, exact_unresolved & prefix_unresolved
+
+    def _cached(self, keys, prefix):
+        '''
+        Splits the keys by their cached lookup with 'prefix', returns the cached static
+        metadata, the set of keys cached as unresolvable and the set of uncached keys.
+        '''
+        static_metadata = {}
+        unresolved = set()
+        to_fetch = set()
+        for key in keys:
+            cached = self._cache.get((key, prefix), _MISSING)
+            if cached is _MISSING:
+                to_fetch.add(key)
+            elif cached is _NOT_FOUND:
+                unresolved.add(key)
+            else:
+                static_metadata[key] = cached
+        if unresolved:
+            # lookups run concurrently in request threads and the executor
+            with self._stats_lock:
+                self.negative_hits += len(unresolved)
+        return static_metadata, unresolved, to_fetch
+
+    def _fetch(self, keys, prefix):
+        '''
+        Fetches and caches the static metadata of the keys with 'prefix', returns the
+        static metadata of the keys that resolved and the set of keys that did not.
+        '''
+        static_metadata = {}
+        unresolved = set()
+        to_fetch = set(keys)
+        while to_fetch:
+            try:
+                with span('sample_service.static_metadata'):
+                    fetched = self.sample_service.get_metadata_key_static_metadata({
+                        'prefix': prefix,
+                        'keys': sorted(to_fetch)
+                    })['static_metadata']
+            except Exception as error:
+                bad_keys = _error_keys(error).intersection(to_fetch)
+                if not bad_keys:
+                    # the error does not name any requested key (e.g. the service is
+                    # unreachable), so nothing is cached and none of the keys resolve
+                    unresolved.update(to_fetch)
+                    break
+                for key in bad_keys:
+                    self._cache.set((key, prefix), _NOT_FOUND)
+                unresolved.update(bad_keys)
+                # retry the rest, they may only have failed alongside the bad keys
+                to_fetch.difference_update(bad_keys)
+                continue
+            for key in to_fetch:
+                if key in fetched:
+                    self._cache.set((key, prefix), fetched[key])
+                    static_metadata[key] = fetched[key]
+                else:
+                    self._cache.set((key, prefix), _NOT_FOUND)
+                    unresolved.add(key)
+            to_fetch = set()
+        return static_metadata, unresolved
@@ -0,0 +1,128 @@
+# per request timing spans of the stages of a call
+"""
+Records how long each stage of a request takes: the server makes a RequestTimings the
+current recorder while it handles a request, and the code on the hot path wraps its
+stages in span(name). Spans are only recorded while a recorder is current, so the
+helpers cost next to nothing outside of a request.
+
+The recorder follows asyncio tasks, threads started by the code of the request have to
+be handed it with bind(). Without contextvars (Python 3.6) it is kept per thread, which
+does not tell apart the calls interleaved on the event loop of the ASGI entry point.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # Python 3.6, the recorder is kept per thread
+    ContextVar = None
+
+# spans beyond this many are only added to the per stage totals
+MAX_SPANS = 500
+
+
+class _ThreadLocalVar(threading.local):
+    '''the part of the ContextVar interface used here, per thread'''
+    value = None
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        previous, self.value = self.value, value
+        return previous
+
+    def reset(self, previous):
+        self.value = previous
+
+
+_current = ContextVar('request_timings', default=None) if ContextVar else _ThreadLocalVar()
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+class RequestTimings:
+    '''
+    The timing spans recorded while serving one request. A span is the name of a stage,
+    its start relative to the start of the request and its duration. Spans of stages run
+    concurrently, like the chunks of a query, overlap. The per stage totals cover every
+    span, the list of spans only the first MAX_SPANS.
+    '''
+    def __init__(cls):
+        cls.start = time.monotonic()
+        cls.spans = []
+        cls.stages = {}
+        cls.dropped_spans = 0
+        cls._lock = threading.Lock()
+
+    def add(self, name, start, end):
+        '''records a span of stage 'name' from 'start' to 'end', in time.monotonic() seconds'''
+        with self._lock:
+            count, seconds = self.stages.get(name, (0, 0.0))
+            self.stages[name] = (count + 1, seconds + end - start)
+            if len(self.spans) < MAX_SPANS:
+                self.spans.append((name, start - self.start, end - start))
+            else:
+                self.dropped_spans += 1
+
+    def summary(self):
+        '''the milliseconds since the start of the request, and the spans of every stage'''
+        with self._lock:
+            stages = {name: {'count': count, 'ms': _ms(seconds)}
+                      for name, (count, seconds) in self.stages.items()}
+        return {'total_ms': _ms(time.monotonic() - self.start), 'stages': stages}
+
+    def to_json(self):
+        '''the summary with the list of spans in the order they ended'''
+        timings = self.summary()
+        with self._lock:
+            timings['spans'] = [{'name': name, 'start_ms': _ms(start), 'ms': _ms(seconds)}
+                                for name, start, seconds in self.spans]
+            if self.dropped_spans:
+                timings['dropped_spans'] = self.dropped_spans
+        return timings
+
+
+def current():
+    '''the RequestTimings of the request being served, None outside of a request'''
+    return _current.get()
+
+
+@contextmanager
+def recording(timings):
+    '''makes 'timings' the current recorder within the block'''
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def span(name):
+    '''records the time spent in the block as a span of stage 'name' '''
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings.add(name, start, time.monotonic())
+
+
+def bind(func):
+    '''func, recording its spans with the current recorder in whatever thread it runs'''
+    timings = _current.get()
+    if timings is None:
+        return func
+
+    def run(*args, **kwargs):
+        with recording(timings):
+            return func(*args, **kwargs)
+    return run
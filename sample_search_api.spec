@@ -6,7 +6,6 @@ A KBase module: sample_search_api
 
 TODO:
     Ontology type queries
-    more complex lexicographical queries (nested or parenthesis)
 
 */
 
@@ -22,6 +21,9 @@ module sample_search_api {
         int version;
     } SampleAddress;
 
+    /* A boolean - 0 for false, 1 for true. */
+    typedef int boolean;
+
     /*
     Args:
         metadata_field - should only be a controlled_metadata field, if not will error.
@@ -30,12 +32,12 @@ module sample_search_api {
         metadata_values - list of values on which to constrain metadata_field with the input operator.
         logical_operator - accepted values for the operators are:
             "and", "or"
-
-    potential future args:
-        paren_position -
+        paren_position - groups conditions with parentheses, "and" binds tighter than "or"
             None/0 - no operation
             n - add "n" open parenthesis to the beginning of the statement
             -n - add "n" closed paranthesis to the end of statement
+
+    @optional paren_position
     */
 
     typedef structure{
@@ -43,15 +45,49 @@ module sample_search_api {
         string comparison_operator;
         list<string> metadata_values;
         string logical_operator;
+        int paren_position;
     } filter_condition;
 
+    /*
+    Args:
+        sample_ids - samples to filter.
+        filter_conditions - conditions the returned samples must satisfy.
+        limit - page size, if provided at most this many samples are returned along with
+            a cursor for the next page.
+        cursor - cursor returned by a previous paged call, returns the next page. When a cursor
+            is provided all other arguments are ignored.
+        return_mode - what to return, one of:
+            "ids" - the matching samples (the default)
+            "count" - the number of distinct matching samples
+            "exists" - whether any sample matches
+            limit may only be used with "ids".
+
+    @optional limit cursor return_mode
+    */
     typedef structure{
         list<SampleAddress> sample_ids;
         list<filter_condition> filter_conditions;
+        int limit;
+        string cursor;
+        string return_mode;
     } FilterSamplesParams;
 
+    /*
+    Results:
+        sample_ids - samples that satisfy the filter conditions, in the order of the input
+            sample_ids and as many times as they are listed there. Paged calls return every
+            matching sample once.
+        cursor - for paged calls, the cursor for the next page, null on the last page.
+        count - the number of distinct matching samples, for the "count" return mode.
+        exists - whether any sample matches, for the "exists" return mode.
+
+    @optional sample_ids cursor count exists
+    */
     typedef structure {
         list<SampleAddress> sample_ids;
+        string cursor;
+        int count;
+        boolean exists;
     } FilterSamplesResults;
 
     /*
@@ -59,6 +95,40 @@ module sample_search_api {
     */
     funcdef filter_samples(FilterSamplesParams params) returns (FilterSamplesResults results) authentication required;
 
+    /*
+    Args:
+        sample_ids - samples to filter.
+        filter_condition_groups - groups of filter conditions, each group is evaluated
+            independently against sample_ids, like the filter_conditions of filter_samples.
+    */
+    typedef structure{
+        list<SampleAddress> sample_ids;
+        list<list<filter_condition>> filter_condition_groups;
+    } BatchFilterSamplesParams;
+
+    /*
+    Results:
+        sample_ids - samples that satisfy the group's filter conditions.
+        count - number of samples that satisfy the group's filter conditions.
+    */
+    typedef structure {
+        list<SampleAddress> sample_ids;
+        int count;
+    } FilterGroupResult;
+
+    /*
+    Results:
+        results - one result per filter condition group, in the order of the groups.
+    */
+    typedef structure {
+        list<FilterGroupResult> results;
+    } BatchFilterSamplesResults;
+
+    /*
+    Runs several groups of filter conditions against the same samples in one query.
+    */
+    funcdef batch_filter_samples(BatchFilterSamplesParams params) returns (BatchFilterSamplesResults results) authentication required;
+
     typedef structure {
         list<string> sample_set_refs;
     } GetSamplesetMetaParams;
@@ -73,4 +143,91 @@ module sample_search_api {
     filter_samplesets dynamic dropdown.
     */
     funcdef get_sampleset_meta(GetSamplesetMetaParams params) returns (list<GetSamplesetMetaResult> results) authentication required;
+
+    /*
+    Args:
+        sample_ids - samples to describe.
+        sample_set_refs - SampleSets whose samples are described, together with sample_ids.
+            At least one of sample_ids and sample_set_refs is required.
+        fields - metadata fields to describe, "custom:" prefixed for uncontrolled fields.
+            Every field present in the samples when not given.
+        top_k - number of most frequent values returned for non numeric fields,
+            10 by default, at most 1000.
+        num_buckets - number of histogram buckets for numeric fields, 10 by default,
+            at most 100.
+        approximate - 1 to describe the samples with fixed size sketches, 0 for exact results.
+            By default large sets are described approximately.
+
+    @optional sample_ids sample_set_refs fields top_k num_buckets approximate
+    */
+    typedef structure {
+        list<SampleAddress> sample_ids;
+        list<string> sample_set_refs;
+        list<string> fields;
+        int top_k;
+        int num_buckets;
+        boolean approximate;
+    } GetSamplesetFacetsParams;
+
+    typedef structure {
+        UnspecifiedObject value;
+        int count;
+    } FacetValue;
+
+    typedef structure {
+        float quantile;
+        float value;
+    } FacetQuantile;
+
+    typedef structure {
+        float lower;
+        float upper;
+        int count;
+    } FacetBucket;
+
+    /*
+    Results:
+        field - metadata field name.
+        type - "number" if every value of the field is a number, "string" otherwise.
+        count - number of samples with a value for the field.
+        distinct_count - number of distinct values of the field.
+        values - for "string" fields, the top_k most frequent values and the number of
+            samples with each, most frequent first.
+        min, max - for "number" fields, the smallest and largest value.
+        quantiles - for "number" fields, the 5th, 25th, 50th, 75th and 95th percentiles of
+            the sample values.
+        buckets - for "number" fields, num_buckets equal width buckets between min and max,
+            with the number of sample values in each.
+
+    @optional values min max quantiles buckets
+    */
+    typedef structure {
+        string field;
+        string type;
+        int count;
+        int distinct_count;
+        list<FacetValue> values;
+        float min;
+        float max;
+        list<FacetQuantile> quantiles;
+        list<FacetBucket> buckets;
+    } FieldFacet;
+
+    /*
+    Results:
+        facets - one facet per field present in the samples, sorted by field.
+        approximate - 1 if the facets are estimates: distinct counts, quantiles and bucket
+            counts are approximate and value counts are lower bounds, values too rare to be
+            told apart from the error are left out.
+    */
+    typedef structure {
+        list<FieldFacet> facets;
+        boolean approximate;
+    } GetSamplesetFacetsResults;
+
+    /*
+    Gets the distribution of the values of metadata fields over a set of samples in one
+    aggregation, for rendering the facet panels of the filter_samplesets dropdowns.
+    */
+    funcdef get_sampleset_facets(GetSamplesetFacetsParams params) returns (GetSamplesetFacetsResults results) authentication required;
 };
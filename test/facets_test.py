@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import math
+import re
+import unittest
+from unittest import mock
+
+from utils.chunking import ChunkedRunner
+from utils.facets import AQL_facet_sketch_query, FacetCounter, FieldSketch, build_facets
+
+
+def _rows(field, value_counts):
+    '''AQL_facet_query result rows of a field whose values each belong to one sample'''
+    rows = [{'field': field, 'count': sum(count for _, count in value_counts)}]
+    rows.extend({'field': field, 'value': value, 'count': count}
+                for value, count in value_counts)
+    return rows
+
+
+class FacetsTest(unittest.TestCase):
+
+    def test_number_facet(self):
+        facet, = build_facets(_rows('depth', [(0, 1), (1, 2), (4, 1)]), 10, 2)
+        self.assertEqual(facet['type'], 'number')
+        self.assertEqual((facet['min'], facet['max'], facet['distinct_count']), (0, 4, 3))
+        self.assertEqual(facet['buckets'], [
+            {'lower': 0, 'upper': 2, 'count': 3},
+            {'lower': 2, 'upper': 4, 'count': 1}
+        ])
+
+    def test_number_facet_of_extreme_values(self):
+        # the span of the values does not fit in a float
+        values = [(-1.5e308, 1), (0, 1), (1e308, 2)]
+        facet, = build_facets(_rows('x', values), 10, 4)
+        self.assertEqual([bucket['count'] for bucket in facet['buckets']], [1, 0, 1, 2])
+        edges = [facet['buckets'][0]['lower']] + [b['upper'] for b in facet['buckets']]
+        self.assertTrue(all(math.isfinite(edge) for edge in edges))
+        self.assertEqual((edges[0], edges[-1]), (-1.5e308, 1e308))
+        self.assertEqual(edges, sorted(edges))
+
+    def test_sketch_facet_of_extreme_values(self):
+        sketch = FieldSketch(precision=4, compression=20)
+        sketch.add_summary({
+            'count': 4, 'value_count': 4, 'values': [[1e308, 2], [-1.5e308, 1], [0, 1]],
+            'registers': [[0, 1], [3, 2], [9, 1]], 'numbers': 4, 'min': -1.5e308, 'max': 1e308,
+            'centroids': [[-1.5e308, 1], [0, 1], [1e308, 2]]
+        })
+        facet = sketch.facet('x', 10, 4)
+        self.assertEqual(facet['type'], 'number')
+        self.assertEqual((facet['min'], facet['max']), (-1.5e308, 1e308))
+        self.assertEqual(sum(bucket['count'] for bucket in facet['buckets']), 4)
+        self.assertTrue(all(math.isfinite(bucket['lower']) for bucket in facet['buckets']))
+        self.assertTrue(all(math.isfinite(q['value']) for q in facet['quantiles']))
+
+    def test_approximate_facets_merge_chunk_summaries(self):
+        chunk_rows = [[{
+            'field': 'city', 'count': 3, 'value_count': 3, 'values': [['a', 2], ['b', 1]],
+            'registers': [[1, 3], [2, 1]], 'numbers': 0, 'min': None, 'max': None,
+            'centroids': []
+        }, {
+            'field': 'depth', 'count': 2, 'value_count': 2, 'values': [[1, 1], [2.5, 1]],
+            'registers': [[5, 2], [6, 1]], 'numbers': 2, 'min': 1, 'max': 2.5,
+            'centroids': [[1, 1], [2.5, 1]]
+        }], [{
+            'field': 'city', 'count': 2, 'value_count': 2, 'values': [['b', 1], [7, 1]],
+            'registers': [[1, 1], [2, 4], [3, 1]], 'numbers': 1, 'min': 7, 'max': 7,
+            'centroids': [[7, 1]]
+        }]]
+        queries = []
+
+        def query_results(query, re_api_url, token, params):
+            queries.append((query, params))
+            return iter(chunk_rows[len(queries) - 1])
+
+        counter = FacetCounter('url', chunk_runner=ChunkedRunner(chunk_size=2, max_workers=1),
+                               precision=4)
+        samples = [{'id': str(idx), 'version': 1} for idx in range(4)]
+        with mock.patch('utils.facets.iter_query_results', query_results):
+            result = counter.get_sampleset_facets(samples, [], 2, 2, 'token', approximate=True)
+        for query, params in queries:
+            self.assertEqual(query, AQL_facet_sketch_query)
+            self.assertEqual(set(re.findall(r"@(\w+)", query)), set(params))
+        self.assertEqual(result['approximate'], 1)
+        city, depth = result['facets']
+        self.assertEqual((city['field'], city['count'], city['type']), ('city', 5, 'string'))
+        self.assertEqual(city['values'], [{'value': 'a', 'count': 2},
+                                          {'value': 'b', 'count': 2}])
+        self.assertEqual((depth['count'], depth['min'], depth['max']), (2, 1, 2.5))
+        self.assertEqual([bucket['count'] for bucket in depth['buckets']], [1, 1])
+
+    def test_string_facet(self):
+        facet, = build_facets(_rows('city', [('a', 1), ('b', 3), (1, 2)]), 2, 4)
+        self.assertEqual(facet['type'], 'string')
+        self.assertEqual(facet['values'], [{'value': 'b', 'count': 3},
+                                           {'value': 1, 'count': 2}])
+
+
+if __name__ == '__main__':
+    unittest.main()
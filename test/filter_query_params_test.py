@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import re
+import unittest
+from unittest import mock
+
+from utils.chunking import ChunkedRunner
+from utils.filter_samples import SampleFilterer
+
+STATIC_METADATA = {
+    'latitude': {'type': 'number'},
+    'state_province': {'type': 'string'}
+}
+
+SAMPLES = [{'id': f"sample{idx}", 'version': 1} for idx in range(5)]
+
+
+class _StaticMetadata:
+
+    def get_static_metadata(self, keys):
+        return {key: STATIC_METADATA[key] for key in keys}
+
+
+def _condition(field, comp_op, values, logical_op=None, paren_position=None):
+    condition = {'metadata_field': field, 'comparison_operator': comp_op,
+                 'metadata_values': values}
+    if logical_op:
+        condition['logical_operator'] = logical_op
+    if paren_position:
+        condition['paren_position'] = paren_position
+    return condition
+
+
+CONDITIONS = [
+    _condition('latitude', '>', ['10'], 'AND'),
+    _condition('state_province', '==', ['Georgia'], 'OR', 1),
+    _condition('custom:depth', '<', ['5'], paren_position=-1)
+]
+
+
+class FilterQueryParamsTest(unittest.TestCase):
+    '''the bind parameters sent with every filter query are exactly the ones it uses'''
+
+    def setUp(self):
+        self.queries = []
+        self.sample_filter = SampleFilterer(None, 'http://re', None,
+                                            static_metadata=_StaticMetadata(),
+                                            chunk_runner=ChunkedRunner(chunk_size=2))
+
+    def _execute_query(self, query, re_api_url, token, params=None, batch_size=None):
+        self.queries.append((query, dict(params)))
+        if 'num_groups' in params:
+            return {'results': [{'missing_custom_fields': [],
+                                 'groups': [[] for _ in range(params['num_groups'])]}]}
+        if query.rstrip().endswith('RETURN count'):
+            return {'results': [0]}
+        return {'results': [], 'has_more': False}
+
+    def assertBindParameters(self):
+        self.assertTrue(self.queries)
+        for query, params in self.queries:
+            self.assertEqual(set(re.findall(r"@(\w+)", query)), set(params))
+
+    def _filter(self, method, params):
+        with mock.patch('utils.filter_samples.execute_query', self._execute_query):
+            return getattr(self.sample_filter, method)(params, 'token')
+
+    def test_filter_with_custom_fields(self):
+        self._filter('filter_samples', {'sample_ids': SAMPLES, 'filter_conditions': CONDITIONS})
+        self.assertBindParameters()
+
+    def test_filter_without_custom_fields(self):
+        self._filter('filter_samples', {'sample_ids': SAMPLES, 'filter_conditions': [
+            _condition('latitude', '>', ['10'], 'OR'),
+            _condition('state_province', 'in', ['Georgia', 'Tennessee'])
+        ]})
+        self.assertBindParameters()
+
+    def test_counted_and_paged_filters(self):
+        with mock.patch.object(SampleFilterer, '_validate_custom_fields'):
+            self._filter('filter_samples', {'sample_ids': SAMPLES,
+                                            'filter_conditions': CONDITIONS,
+                                            'return_mode': 'count'})
+            self._filter('filter_samples', {'sample_ids': SAMPLES,
+                                            'filter_conditions': CONDITIONS, 'limit': 2})
+        self.assertBindParameters()
+
+    def test_batch_filter(self):
+        self._filter('batch_filter_samples', {
+            'sample_ids': SAMPLES,
+            'filter_condition_groups': [CONDITIONS, [
+                _condition('latitude', '<=', ['0'])
+            ], [
+                _condition('custom:depth', 'in', ['1', '2'])
+            ]]
+        })
+        self.assertBindParameters()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from utils.parsing_and_formatting import (
+    FILTER_FALSE,
+    FILTER_TRUE,
+    build_filter_tree,
+    simplify_filter_tree
+)
+
+
+def _condition(field, comp_op, values, logic_op=None, paren_position=None):
+    condition = {'field': field, 'comp_op': comp_op, 'values': values}
+    if logic_op:
+        condition['logic_op'] = logic_op
+    if paren_position:
+        condition['paren_position'] = paren_position
+    return condition
+
+
+def _describe(tree):
+    '''the tree as nested tuples, leaving out the logical operators of the leaves'''
+    if 'terms' in tree:
+        return (tree['op'],) + tuple(_describe(term) for term in tree['terms'])
+    if 'field' in tree:
+        return (tree['field'], tree['comp_op'], tuple(tree['values']))
+    return tree['op']
+
+
+def _simplified(*conditions):
+    return _describe(simplify_filter_tree(build_filter_tree(list(conditions))))
+
+
+class FilterTreeTest(unittest.TestCase):
+
+    def test_and_binds_tighter_than_or(self):
+        tree = build_filter_tree([
+            _condition('a', '>', [1], 'AND'),
+            _condition('b', '>', [2], 'OR'),
+            _condition('c', '<', [3])
+        ])
+        self.assertEqual(_describe(tree), (
+            'OR', ('AND', ('a', '>', (1,)), ('b', '>', (2,))), ('c', '<', (3,))
+        ))
+
+    def test_parentheses(self):
+        tree = build_filter_tree([
+            _condition('a', '>', [1], 'AND'),
+            _condition('b', '>', [2], 'OR', 1),
+            _condition('c', '<', [3], paren_position=-1)
+        ])
+        self.assertEqual(_describe(tree), (
+            'AND', ('a', '>', (1,)), ('OR', ('b', '>', (2,)), ('c', '<', (3,)))
+        ))
+        tree = build_filter_tree([
+            _condition('a', '>', [1], 'OR', 2),
+            _condition('b', '>', [2], 'AND', -1),
+            _condition('c', '<', [3], paren_position=-1)
+        ])
+        self.assertEqual(_describe(tree), (
+            'AND', ('OR', ('a', '>', (1,)), ('b', '>', (2,))), ('c', '<', (3,))
+        ))
+
+    def test_unbalanced_parentheses(self):
+        with self.assertRaises(ValueError) as context:
+            build_filter_tree([
+                _condition('a', '>', [1], 'AND', 2),
+                _condition('b', '>', [2], paren_position=-1)
+            ])
+        self.assertEqual(str(context.exception),
+                         "1 parentheses opened in 'filter_conditions' are never closed.")
+        with self.assertRaises(ValueError) as context:
+            build_filter_tree([
+                _condition('a', '>', [1], 'AND', 1),
+                _condition('b', '>', [2], paren_position=-2)
+            ])
+        self.assertEqual(str(context.exception),
+                         "filter condition at position 1 closes 2 parentheses but only 1 "
+                         "are open.")
+
+    def test_flatten_and_remove_duplicates(self):
+        self.assertEqual(_simplified(
+            _condition('a', '>', [1], 'AND'),
+            _condition('b', '<', [2], 'AND', 1),
+            _condition('a', '>', [1], paren_position=-1)
+        ), ('AND', ('a', '>', (1,)), ('b', '<', (2,))))
+        self.assertEqual(_simplified(
+            _condition('a', '>', [1], 'OR'),
+            _condition('a', '>', [1.0])
+        ), ('a', '>', (1,)))
+
+    def test_merge_equalities_into_in(self):
+        self.assertEqual(_simplified(
+            _condition('a', '==', ['x'], 'OR'),
+            _condition('b', '>', [1], 'OR'),
+            _condition('a', '==', ['y'], 'OR'),
+            _condition('a', 'IN', ['x', 'z'])
+        ), ('OR', ('a', 'IN', ('x', 'y', 'z')), ('b', '>', (1,))))
+        self.assertEqual(_simplified(
+            _condition('a', 'IN', ['x', 'y', 'z'], 'AND'),
+            _condition('a', 'NOT IN', ['y'], 'AND'),
+            _condition('a', 'IN', ['x', 'y'])
+        ), ('a', '==', ('x',)))
+        self.assertEqual(_simplified(
+            _condition('a', '!=', ['x'], 'AND'),
+            _condition('a', '!=', ['y'])
+        ), ('a', 'NOT IN', ('x', 'y')))
+
+    def test_constant_folding(self):
+        # a field can not equal two different values
+        self.assertEqual(_simplified(
+            _condition('a', '==', ['x'], 'AND'),
+            _condition('a', '==', ['y'])
+        ), FILTER_FALSE['op'])
+        # a field either is or is not one of the values
+        self.assertEqual(_simplified(
+            _condition('a', 'IN', ['x', 'y'], 'OR'),
+            _condition('a', 'NOT IN', ['x'])
+        ), FILTER_TRUE['op'])
+        # false terms drop out of "OR", true terms out of "AND"
+        self.assertEqual(_simplified(
+            _condition('a', '==', ['x'], 'AND', 1),
+            _condition('a', '==', ['y'], 'OR', -1),
+            _condition('b', '<', [2])
+        ), ('b', '<', (2,)))
+        self.assertEqual(_simplified(
+            _condition('a', '==', ['x'], 'OR', 1),
+            _condition('a', '!=', ['x'], 'AND', -1),
+            _condition('b', '<', [2])
+        ), ('b', '<', (2,)))
+        # a false term makes the whole "AND" false
+        self.assertEqual(_simplified(
+            _condition('b', '<', [2], 'AND'),
+            _condition('a', '==', ['x'], 'AND', 1),
+            _condition('a', '==', ['y'], paren_position=-1)
+        ), FILTER_FALSE['op'])
+
+    def test_numbers_and_booleans_stay_apart(self):
+        self.assertEqual(_simplified(
+            _condition('a', '==', [1], 'OR'),
+            _condition('a', '==', [True])
+        ), ('a', 'IN', (1, True)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ReadTimeoutError
+
+from utils.re_utils import _retry_policy
+
+
+class _Response:
+    status = 503
+
+    def get_redirect_location(self):
+        return False
+
+
+class REUtilsTest(unittest.TestCase):
+
+    def test_queries_are_retried(self):
+        retry = _retry_policy(3, 0)
+        retry = retry.increment('POST', '/api/v1/query_results?batch_size=1000',
+                                response=_Response())
+        self.assertEqual(retry.total, 2)
+
+    def test_cursor_fetches_are_not_retried(self):
+        url = '/api/v1/query_results?cursor_id=abc'
+        for failure in [{'response': _Response()},
+                        {'error': ReadTimeoutError(None, url, 'read timed out')}]:
+            with self.assertRaises(MaxRetryError):
+                _retry_policy(3, 0).increment('POST', url, **failure)
+
+    def test_cursor_fetches_are_retried_when_not_connected(self):
+        url = '/api/v1/query_results?cursor_id=abc'
+        error = NewConnectionError(None, 'connection refused')
+        retry = _retry_policy(3, 0).increment('POST', url, error=error)
+        self.assertEqual(retry.total, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
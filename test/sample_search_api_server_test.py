@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import os
 import time
 import unittest
@@ -7,7 +8,10 @@ from configparser import ConfigParser
 from sample_search_api.sample_search_apiImpl import sample_search_api
 from sample_search_api.sample_search_apiServer import MethodContext
 from sample_search_api.authclient import KBaseAuth as _KBaseAuth
-from utils.filter_samples import SampleFilterer
+from utils.async_re_utils import aiohttp, close_async_session
+from utils.filter_samples import AsyncSampleFilterer, SampleFilterer
+from utils.local_filter import LocalFilterEngine
+from utils.timing import RequestTimings, recording
 
 from installed_clients.WorkspaceClient import Workspace
 from installed_clients.SampleServiceClient import SampleService
@@ -106,6 +110,24 @@ class sample_search_apiTest(unittest.TestCase):
         print('filter samples test_filter_with_one_condition_and_value_has_whitespace takes '
               f'{end - start} seconds to run')
 
+    # @unittest.skip('x')
+    def test_filter_with_repeated_samples(self):
+        samples = list(reversed(self.valid_sample_ids)) + self.valid_sample_ids[:2]
+        params = {
+            'sample_ids': samples,
+            'filter_conditions': [{
+                'metadata_field': "name",
+                'comparison_operator': "!=",
+                'metadata_values': ["    this has spaces and thats okay!  "]
+            }]
+        }
+        ret = self.serviceImpl.filter_samples(self.ctx, params)[0]
+        self.assertEqual(ret['sample_ids'], samples)
+        params['filter_condition_groups'] = [params.pop('filter_conditions')]
+        ret = self.serviceImpl.batch_filter_samples(self.ctx, params)[0]
+        self.assertEqual(ret['results'][0]['sample_ids'], samples)
+        self.assertEqual(ret['results'][0]['count'], len(samples))
+
     # @unittest.skip('x')
     def test_multi_condition_filter_from_same_sample_set(self):
         # retrieve a list of samples
@@ -148,6 +170,78 @@ class sample_search_apiTest(unittest.TestCase):
         print('filter samples test_multi_condition_filter_from_same_sample_set '
               f'takes {end - start} seconds to run')
 
+    # @unittest.skip('x')
+    def test_nested_filter_conditions(self):
+        # latitude > 0.0 AND (longitude > 0.0 OR state_province == Georgia)
+        params = {
+            'sample_ids': self.valid_sample_ids,
+            'filter_conditions': [
+                {
+                    'metadata_field': "latitude",
+                    'comparison_operator': ">",
+                    'metadata_values': ["0.0"],
+                    'logical_operator': "AND"
+                },
+                {
+                    'metadata_field': "longitude",
+                    'comparison_operator': ">",
+                    'metadata_values': ["0.0"],
+                    'logical_operator': "OR",
+                    'paren_position': 1
+                },
+                {
+                    'metadata_field': "state_province",
+                    'comparison_operator': "==",
+                    'metadata_values': ["Georgia"],
+                    'paren_position': -1
+                }
+            ]
+        }
+        expected = [
+            {'id': 'c9daec72-348e-426b-bef6-04bcdd0e01fa', 'version': 1},
+            {'id': 'efffc90e-64bb-48fb-97c9-c2db3f37f7fc', 'version': 1},
+            {'id': '3d108e8a-d583-4aa4-a2b8-0ae592abf066', 'version': 1},
+            {'id': 'b969c622-ea18-4dda-9943-bf1692e526dd', 'version': 1}
+        ]
+        nested = self.serviceImpl.filter_samples(self.ctx, params)[0]['sample_ids']
+        self.assertEqual(nested, expected)
+        # latitude < 0.0 AND (longitude > 0.0 OR state_province == Georgia) matches none of
+        # the samples, without the parentheses the Georgia samples match
+        params['filter_conditions'][0]['comparison_operator'] = "<"
+        nested = self.serviceImpl.filter_samples(self.ctx, params)[0]['sample_ids']
+        self.assertEqual(nested, [])
+        for condition in params['filter_conditions']:
+            del condition['paren_position']
+        flat = self.serviceImpl.filter_samples(self.ctx, params)[0]['sample_ids']
+        self.assertTrue(flat)
+        self.assertLessEqual({s['id'] for s in flat}, {s['id'] for s in expected[:2]})
+
+    # @unittest.skip('x')
+    def test_unbalanced_parentheses(self):
+        params = {
+            'sample_ids': self.valid_sample_ids,
+            'filter_conditions': [
+                {
+                    'metadata_field': "latitude",
+                    'comparison_operator': ">",
+                    'metadata_values': ["0.0"],
+                    'logical_operator': "AND",
+                    'paren_position': 1
+                },
+                {
+                    'metadata_field': "longitude",
+                    'comparison_operator': ">",
+                    'metadata_values': ["0.0"]
+                }
+            ]
+        }
+        with self.assertRaises(ValueError) as context:
+            self.serviceImpl.filter_samples(self.ctx, params)
+        self.assertEqual(
+            "1 parentheses opened in 'filter_conditions' are never closed.",
+            str(context.exception)
+        )
+
     # @unittest.skip('x')
     def test_multi_value_filter_condition(self):
         # retrieve a list of samples
@@ -179,6 +273,179 @@ class sample_search_apiTest(unittest.TestCase):
         print('filter test_multi_value_filter_condition samples '
               f'takes {end - start} seconds to run')
 
+    # @unittest.skip('x')
+    def test_paged_filter(self):
+        params = {
+            'sample_ids': self.valid_sample_ids,
+            'filter_conditions': [{
+                'metadata_field': "name",
+                'comparison_operator': "!=",
+                'metadata_values': ["    this has spaces and thats okay!  "]
+            }],
+            'limit': 3
+        }
+        ret = self.serviceImpl.filter_samples(self.ctx, params)[0]
+        sample_ids = ret['sample_ids']
+        self.assertEqual(len(sample_ids), 3)
+        while ret['cursor']:
+            ret = self.serviceImpl.filter_samples(self.ctx, {'cursor': ret['cursor']})[0]
+            self.assertLessEqual(len(ret['sample_ids']), 3)
+            sample_ids.extend(ret['sample_ids'])
+        self.assertCountEqual(sample_ids, self.valid_sample_ids)
+
+    # @unittest.skip('x')
+    def test_filter_return_modes(self):
+        params = {
+            'sample_ids': self.valid_sample_ids + self.valid_sample_ids[:1],
+            'filter_conditions': [{
+                'metadata_field': "name",
+                'comparison_operator': "!=",
+                'metadata_values': ["    this has spaces and thats okay!  "]
+            }],
+            'return_mode': 'count'
+        }
+        ret = self.serviceImpl.filter_samples(self.ctx, params)[0]
+        self.assertEqual(ret, {'count': len(self.valid_sample_ids)})
+        params['return_mode'] = 'exists'
+        ret = self.serviceImpl.filter_samples(self.ctx, params)[0]
+        self.assertEqual(ret, {'exists': 1})
+        params['filter_conditions'][0]['comparison_operator'] = "=="
+        ret = self.serviceImpl.filter_samples(self.ctx, params)[0]
+        self.assertEqual(ret, {'exists': 0})
+        params['limit'] = 3
+        with self.assertRaises(ValueError) as context:
+            self.serviceImpl.filter_samples(self.ctx, params)
+        self.assertEqual(
+            str(context.exception),
+            "'limit' can not be used with the 'exists' return mode."
+        )
+
+    # @unittest.skip('x')
+    def test_batch_filter_samples(self):
+        params = {
+            'sample_ids': self.valid_sample_ids,
+            'filter_condition_groups': [
+                [{
+                    'metadata_field': "state_province",
+                    'comparison_operator': "in",
+                    'metadata_values': ["Georgia", "Washington", "Tennessee"],
+                }],
+                [
+                    {
+                        'metadata_field': "latitude",
+                        'comparison_operator': ">",
+                        'metadata_values': ["0.0"],
+                        'logical_operator': "AND"
+                    },
+                    {
+                        'metadata_field': "longitude",
+                        'comparison_operator': ">",
+                        'metadata_values': ["0.0"],
+                        'logical_operator': "OR"
+                    },
+                    {
+                        'metadata_field': "state_province",
+                        'comparison_operator': "==",
+                        'metadata_values': ["Georgia"]
+                    }
+                ]
+            ]
+        }
+        ret = self.serviceImpl.batch_filter_samples(self.ctx, params)[0]
+        self.assertEqual(len(ret['results']), 2)
+        self.assertEqual(ret['results'][0]['count'], 5)
+        self.assertEqual(ret['results'][0]['sample_ids'], [
+            {'id': 'c9daec72-348e-426b-bef6-04bcdd0e01fa', 'version': 1},
+            {'id': 'efffc90e-64bb-48fb-97c9-c2db3f37f7fc', 'version': 1},
+            {'id': '1cd59e35-9057-427b-9b88-17077a5810e4', 'version': 1},
+            {'id': '6fc28cbd-39b3-4da6-a928-e56a680111b7', 'version': 1},
+            {'id': '3f272ea3-6e52-4e09-b5c5-525217ac5a49', 'version': 1}
+        ])
+        self.assertEqual(ret['results'][1]['count'], 4)
+        self.assertEqual(ret['results'][1]['sample_ids'], [
+            {'id': 'c9daec72-348e-426b-bef6-04bcdd0e01fa', 'version': 1},
+            {'id': 'efffc90e-64bb-48fb-97c9-c2db3f37f7fc', 'version': 1},
+            {'id': '3d108e8a-d583-4aa4-a2b8-0ae592abf066', 'version': 1},
+            {'id': 'b969c622-ea18-4dda-9943-bf1692e526dd', 'version': 1}
+        ])
+
+    # @unittest.skip('x')
+    def test_local_filter_matches_relation_engine(self):
+        filter_condition_groups = [
+            [{
+                'metadata_field': "latitude",
+                'comparison_operator': "<=",
+                'metadata_values': ["40"],
+                'logical_operator': "OR"
+            }, {
+                'metadata_field': "state_province",
+                'comparison_operator': "not in",
+                'metadata_values': ["Georgia", "Tennessee"]
+            }],
+            [{
+                'metadata_field': "custom:hazen_n2_mm",
+                'comparison_operator': ">",
+                'metadata_values': ["1"]
+            }]
+        ]
+        samples = self.valid_sample_ids + self.valid_enigma_sample_ids
+        remote = SampleFilterer(None, self.re_api_url, self.sample_service)
+        local = SampleFilterer(None, self.re_api_url, self.sample_service,
+                               local_engine=LocalFilterEngine(self.re_api_url))
+        for filter_conditions in filter_condition_groups:
+            params = {'sample_ids': samples, 'filter_conditions': filter_conditions}
+            self.assertEqual(local.filter_samples(params, self.ctx['token']),
+                             remote.filter_samples(params, self.ctx['token']))
+        params = {'sample_ids': samples, 'filter_condition_groups': filter_condition_groups}
+        self.assertEqual(local.batch_filter_samples(params, self.ctx['token']),
+                         remote.batch_filter_samples(params, self.ctx['token']))
+        self.assertEqual(local.local_engine.stats()['size'], 1)
+
+    @unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test_async_filter_samples(self):
+        params = {
+            'sample_ids': self.valid_sample_ids,
+            'filter_conditions': [{
+                'metadata_field': "state_province",
+                'comparison_operator': "in",
+                'metadata_values': ["Georgia", "Washington", "Tennessee"],
+            }]
+        }
+        sample_filter = SampleFilterer(None, self.re_api_url, self.sample_service)
+        async_filter = AsyncSampleFilterer.from_filterer(sample_filter)
+
+        async def filter_concurrently():
+            try:
+                return await asyncio.gather(*[
+                    async_filter.filter_samples(params, self.ctx['token']) for _ in range(5)
+                ])
+            finally:
+                await close_async_session()
+
+        expected = sample_filter.filter_samples(params, self.ctx['token'])
+        for ret in asyncio.get_event_loop().run_until_complete(filter_concurrently()):
+            self.assertEqual(ret, expected)
+
+    # @unittest.skip('x')
+    def test_request_timings(self):
+        params = {
+            'sample_ids': self.valid_sample_ids,
+            'filter_conditions': [{
+                'metadata_field': "latitude",
+                'comparison_operator': ">",
+                'metadata_values': ["30"]
+            }]
+        }
+        sample_filter = SampleFilterer(None, self.re_api_url, self.sample_service)
+        timings = RequestTimings()
+        with recording(timings):
+            sample_filter.filter_samples(params, self.ctx['token'])
+        stages = timings.summary()['stages']
+        for stage in ('filter.parse', 'filter.static_metadata', 're.execute_query'):
+            self.assertIn(stage, stages)
+        self.assertEqual(len(timings.to_json()['spans']),
+                         sum(stage['count'] for stage in stages.values()))
+
     # @unittest.skip('x')
     def test_not_enough_samples(self):
         params = {
@@ -345,6 +612,39 @@ class sample_search_apiTest(unittest.TestCase):
         self.assertIn({'field': 'sesar:igsn'}, results)
         self.assertIn({'field': 'purpose'}, results)
 
+    # @unittest.skip('x')
+    def test_get_sampleset_facets(self):
+        params = {
+            'sample_set_refs': [self.sampleset_object_ref],
+            'top_k': 2,
+            'num_buckets': 3
+        }
+        facets = self.serviceImpl.get_sampleset_facets(self.ctx, params)[0]['facets']
+        fields = [facet['field'] for facet in facets]
+        self.assertEqual(fields, sorted(fields))
+        meta = self.serviceImpl.get_sampleset_meta(
+            self.ctx, {'sample_set_refs': [self.sampleset_object_ref]}
+        )[0]
+        self.assertLessEqual(set(fields), {f['field'] for f in meta})
+        self.assertIn('purpose', fields)
+        for facet in facets:
+            self.assertGreater(facet['count'], 0)
+            if facet['type'] == 'number':
+                self.assertEqual(len(facet['buckets']), 1 if facet['min'] == facet['max'] else 3)
+            else:
+                self.assertLessEqual(len(facet['values']), 2)
+                self.assertLessEqual(len(facet['values']), facet['distinct_count'])
+
+        params['fields'] = ['purpose']
+        facets = self.serviceImpl.get_sampleset_facets(self.ctx, params)[0]['facets']
+        self.assertEqual([facet['field'] for facet in facets], ['purpose'])
+
+        params['approximate'] = 1
+        ret = self.serviceImpl.get_sampleset_facets(self.ctx, params)[0]
+        self.assertEqual(ret['approximate'], 1)
+        self.assertEqual([facet['field'] for facet in ret['facets']], ['purpose'])
+        self.assertEqual(ret['facets'][0]['count'], facets[0]['count'])
+
     # @unittest.skip('x')
     def test_get_sampleset_meta_uncontrolled_fields(self):
 
@@ -405,6 +705,31 @@ class sample_search_apiTest(unittest.TestCase):
             {'id': 'f02a03a7-0e5f-4517-b859-d6061956784f', 'version': 1}
         ])
 
+    # @unittest.skip('x')
+    def test_filter_samples_missing_uncontrolled_field(self):
+        params = {
+            'sample_ids': self.valid_enigma_sample_ids,
+            'filter_conditions': [
+                {
+                    'metadata_field': "custom:hazen_n2_mm",
+                    'comparison_operator': ">",
+                    'metadata_values': ["1"],
+                    'logical_operator': "OR"
+                },
+                {
+                    'metadata_field': "custom:AAAAAAA",
+                    'comparison_operator': "==",
+                    'metadata_values': ["1"]
+                }
+            ]
+        }
+        with self.assertRaises(ValueError) as context:
+            self.serviceImpl.filter_samples(self.ctx, params)
+        self.assertEqual(
+            "Unable to resolve uncontrolled custom metadata fields: custom:AAAAAAA",
+            str(context.exception)
+        )
+
     # @unittest.skip('x')
     def test_validate_filters_uncontrolled_fields(self):
 